@@ -0,0 +1,19 @@
+import logging
+import azure.functions as func
+from shared_code import export
+
+
+def main(timer: func.TimerRequest) -> None:
+    logging.info('Starting...')
+
+    # Rewrite the small part files appended to the Parquet export by
+    # ProcessInsights as one file per partition, daily at 02:30 UTC
+    if export.getExportFormat() == 'off':
+        logging.info('Completed. Export is off')
+        return
+
+    try:
+        report = export.compactExport()
+        logging.info('Completed. {0}'.format(report))
+    except Exception as e:
+        logging.info('Failed: Compact Insights export {0}'.format(e))
@@ -1,114 +1,181 @@
 import os
 import json
+import zlib
+import time
+import hashlib
 import logging
-import requests
-from azure.cosmosdb.table.tableservice import TableService
-from azure.storage.blob import BlobServiceClient
+from functools import partial
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 import azure.functions as func
+from shared_code import clients, tables, tracker, artifacts, metrics
+from shared_code.vi_client import (getViToken, getViMetrics, getViApiUrl,
+                                  getDeadlineTimeout, viRequest)
+from shared_code.partitioning import getJobPartitionKey
 
 
-def getTableEntity(entity_id):
+def hashChunks(chunks, digest):
     '''
     '''
-    try:
-        # Get subset of feature values for rows with State not 'Processed'
-        logging.info('Getting Azure Storage Table entity')
-
-        # Get Azure Storage Table connection
-        table_service = TableService(
-            connection_string=os.environ['SA_CONNX_STRING'])
-
-        tasks = table_service.query_entities(os.environ['SA_TABLE_TRACKER'],
-                                             filter="VideoIndexerId eq '{0}'".format(
-                                                 entity_id),
-                                             select='RowKey, PartitionKey, VideoIndexerId, VideoName, VideoPath, VideoUrl')
+    # Pass byte chunks through while hashing them
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
 
-        entity = [task for task in tasks][0]
 
-        return entity
-    except Exception as e:
-        logging.info('Get Table Video List failed: {0}.'.format(e))
-
-
-def getViToken():
+def deadlineChunks(chunks, deadline):
     '''
     '''
-    try:
-        # Attempt connection to VI for Access Token
-        logging.info('Creating Video Indexer access token')
-
-        # Format HTTPS Request
-        headers = {'Ocp-Apim-Subscription-Key': os.environ['VI_KEY']}
-        request_url = 'https://api.videoindexer.ai/Auth/{0}/Accounts/{1}/AccessToken?allowEdit=True'.format(
-            os.environ['VI_LOCATION'], os.environ['VI_ACCOUNT_ID'])
-
-        # Get Video Indexer access token
-        response = requests.get(request_url,
-                                headers=headers)
-        response.raise_for_status()
-
-        logging.info('Success: Created Azure Video Indexer access token')
-
-        # Return Video Indexer access token
-        return response.json()
-    except Exception as e:
-        logging.info(
-            'Failed: Create Azure Video Indexer access token: {0}'.format(e))
+    # Pass byte chunks through, stopping the stream once deadline has
+    # passed, each chunk read is bounded by the request timeout
+    for chunk in chunks:
+        if time.time() > deadline:
+            raise TimeoutError('Deadline exceeded')
+        yield chunk
 
 
-def getArtifact(access_token, video_id, artifact_type):
+def gzipChunks(chunks):
+    '''
+    '''
+    # Compress byte chunks on the fly into a single gzip stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@metrics.instrument('putBlob', failed=lambda result: not result)
+def putBlob(data, blob_path, sa_container, content_settings=None,
+            deadline=None, metadata=None):
     '''
     '''
     try:
-        # Attempt connection to VI for video JSON artifact
-        logging.info(
-            'Getting Video Indexer {0} artifact'.format(artifact_type))
-
-        # Format HTTPS Request
-        params = {'accessToken': access_token}
-        request_url = 'https://api.videoindexer.ai/{0}/Accounts/{1}/Videos/{2}/ArtifactUrl?type={3}'.format(
-            os.environ['VI_LOCATION'], os.environ['VI_ACCOUNT_ID'], video_id, artifact_type)
-
-        # Get Video Indexer video JSON artifact
-        response = requests.get(request_url,
-                                params=params)
-        response.raise_for_status()
+        # Attempt to put data to Azure Blob Storage
+        logging.info('Putting {0} to Azure Blob Storage'.format(blob_path))
 
-        logging.info(
-            'Success: Video Indexer {0} artifact returned'.format(artifact_type))
-
-        # Return Video Indexer JSON artifact
-        return requests.get(response.json()).json()
+        # Create a blob client for the blob path
+        blob_service_client = clients.getBlobServiceClient()
+        blob_client = blob_service_client.get_blob_client(
+            container=sa_container, blob=blob_path)
+
+        # Upload the data, bytes or an iterable of byte chunks
+        if isinstance(data, bytes):
+            data = [data]
+        kwargs = dict()
+        if deadline is not None:
+            kwargs['timeout'] = max(1, int(getDeadlineTimeout(None, deadline)))
+        blob_client.upload_blob(metrics.countBytes(data),
+                                overwrite=True,
+                                content_settings=content_settings,
+                                metadata=metadata,
+                                **kwargs)
+
+        logging.info('Success: Put {0} to Azure Blob Storage'.format(blob_path))
+
+        return True
     except Exception as e:
-        logging.info('Failed: Get Video Indexer artifact - id: {0} artifact_type: {1} {2}'.format(
-            video_id, artifact_type, e))
-        return dict()
+        logging.info('Failed: Put {0} to Azure Blob Storage {1}'.format(
+            blob_path, e))
 
+        return False
 
-def putBlob(file_path, sa_container):
+
+def putArtifact(fetch_artifact, artifact_path, sa_container, gzip_content,
+                reparse_json, tap=None, deadline=None, metadata=None):
     '''
+    Fetch an artifact and stream it to Azure Blob Storage, the fetch with
+    its retries and the upload all finished by deadline (epoch seconds).
     '''
-    try:
-        # Attempt to put URL to Azure Blob Storage
-        logging.info('Putting file to Azure Blob Storage')
+    from azure.storage.blob import ContentSettings
+
+    # Get Video Indexer JSON artifact response
+    response = fetch_artifact(deadline=deadline)
+    if response is None:
+        if deadline is not None and time.time() >= deadline:
+            return 'Failed: Timed out'
+        return 'Failed: Get Video Indexer artifact'
+
+    with closing(response):
+        # Stream the response body straight to Azure Blob Storage, unless
+        # asked to validate and re-serialize the JSON first
+        if reparse_json:
+            data = [json.dumps(response.json()).encode('utf-8')]
+        else:
+            data = response.iter_content(chunk_size=4 * 1024 * 1024)
+        if deadline is not None:
+            data = deadlineChunks(data, deadline)
+
+        # Let the caller see the chunks on their way to Blob Storage
+        if tap is not None:
+            data = tap(data)
+
+        if gzip_content:
+            data = gzipChunks(data)
+            content_settings = ContentSettings(content_type='application/json',
+                                               content_encoding='gzip')
+        else:
+            content_settings = ContentSettings(content_type='application/json')
 
-        # Create a blob client using the local file name as the name for the
-        # blob
-        blob_service_client = BlobServiceClient.from_connection_string(
-            os.environ['SA_CONNX_STRING'])
-        blob_client = blob_service_client.get_blob_client(
-            container=sa_container, blob=file_path)
-
-        # Upload the created file
-        with open(file_path, "rb") as data:
-            blob_client.upload_blob(data)
+        # Upload Video Indexer JSON artifact to Azure Blob Storage
+        if not putBlob(data, artifact_path, sa_container, content_settings,
+                       deadline, metadata):
+            if deadline is not None and time.time() >= deadline:
+                return 'Failed: Timed out'
+            return 'Failed: Put file to Azure Blob Storage'
 
-        logging.info('Success: Put file to Azure Blob Storage')
-    except Exception as e:
-        logging.info('Failed: Put file to Azure Blob Storage {0}'.format(e))
+    return 'Success'
 
 
-def getInsights(access_token, video_id):
+def putArtifacts(artifact_jobs, sa_container, max_inflight, timeout,
+                 stage_timeout, reparse_json=False):
+    '''
+    '''
+    # Fetch and upload every artifact concurrently, at most max_inflight at
+    # a time, and collect a per-artifact status report
+    logging.info('Putting {0} Video Indexer artifacts to Azure Blob Storage, max in-flight: {1}'.format(
+        len(artifact_jobs), max_inflight))
+
+    # Each artifact has timeout seconds from when a worker picks it up, for
+    # its retries and upload, and all of them must finish by the stage
+    # deadline so every worker is done writing before the response
+    stage_deadline = time.time() + stage_timeout
+
+    def putArtifactBefore(fetch_artifact, artifact_path, gzip_content, tap,
+                          metadata):
+        deadline = min(time.time() + timeout, stage_deadline)
+        if time.time() >= deadline:
+            return 'Failed: Timed out'
+        return putArtifact(fetch_artifact, artifact_path, sa_container,
+                           gzip_content, reparse_json, tap, deadline,
+                           metadata)
+
+    report = dict()
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        futures = {artifact_type: executor.submit(
+                       metrics.bindCorrelation(putArtifactBefore),
+                       fetch_artifact,
+                       artifact_path,
+                       gzip_content,
+                       tap,
+                       metadata)
+                   for artifact_type, (fetch_artifact, artifact_path, gzip_content, tap, metadata)
+                   in artifact_jobs.items()}
+
+        for artifact_type, future in futures.items():
+            try:
+                report[artifact_type] = future.result()
+            except Exception as e:
+                report[artifact_type] = 'Failed: {0}'.format(e)
+
+    logging.info('Video Indexer artifacts report: {0}'.format(report))
+
+    return report
+
+
+@metrics.instrument('getInsights')
+def getInsights(access_token, video_id, timeout=None, deadline=None):
     '''
     '''
     try:
@@ -118,135 +185,281 @@ def getInsights(access_token, video_id):
         # Format HTTPS Request
         headers = {'Ocp-Apim-Subscription-Key': os.environ['VI_KEY']}
         params = {'accessToken': access_token}
-        request_url = 'https://api.videoindexer.ai/{0}/Accounts/{1}/Videos/{2}/Index'.format(
-            os.environ['VI_LOCATION'], os.environ['VI_ACCOUNT_ID'], video_id)
+        request_url = '{0}/{1}/Accounts/{2}/Videos/{3}/Index'.format(
+            getViApiUrl(), os.environ['VI_LOCATION'], os.environ['VI_ACCOUNT_ID'],
+            video_id)
 
         # Get Video Indexer video JSON insights
-        response = requests.get(request_url,
-                                headers=headers,
-                                params=params)
+        response = viRequest('GET',
+                             request_url,
+                             deadline=deadline,
+                             headers=headers,
+                             params=params,
+                             timeout=timeout)
         response.raise_for_status()
 
         logging.info('Success: Video Indexer insights returned')
 
-        # Return Video Indexer JSON insights
-        return response.json()
+        # Return Video Indexer JSON insights response
+        return response
     except Exception as e:
         logging.info('Failed: Get Azure Video Indexer insights {0}'.format(e))
 
 
-def putTableEntity(video_id, video_name, video_path, insights_path, video_url):
+def putTableEntity(partition_key, video_id, video_name, video_path, insights_path, video_url,
+                   index_version=None):
     '''
     '''
     try:
         logging.info('Putting new entity to Azure Storage Table')
 
         # Get Azure Storage Table connection
-        table_service = TableService(
-            connection_string=os.environ['SA_CONNX_STRING'])
-
-        try:
-            logging.info('Checking for existing Azure Storage Table')
-
-            # Check for table, if none then create new table
-            table_service.create_table(os.environ['SA_TABLE_TRACKER'],
-                                       fail_on_exist=True)
-
-            logging.info('Success: New table created')
-        except Exception as e:
-            logging.info('Failed: Table already exists {0}'.format(e))
+        table_service = clients.getTableService()
 
         task = {
-            'PartitionKey': 'examplekey',
+            'PartitionKey': partition_key,
             'RowKey': video_id,
             'VideoIndexerId': video_id,
             'VideoName': video_name,
             'VideoPath': video_path,
             'VideoUrl': video_url,
             'InsightsPath': insights_path,
+            'IndexVersion': index_version,
             'State': 'Processed'
         }
 
-        # Write entry to Azure Storage Table
-        table_service.insert_or_merge_entity(
-            os.environ['SA_TABLE_TRACKER'], task)
+        # Write entry to Azure Storage Table, creating the table on first use
+        tables.putWithTable(table_service,
+                            os.environ['SA_TABLE_TRACKER'],
+                            lambda: table_service.insert_or_merge_entity(
+                                os.environ['SA_TABLE_TRACKER'], task))
 
         logging.info('Success: Put entity to Azure Storage Table')
     except Exception as e:
         logging.info('Failed: Put entity to Azure Storage Table {0}'.format(e))
 
 
+def processInsights(process_mode, sa_container, insights_path,
+                    video_insights, job=None):
+    '''
+    '''
+    # Imported when used, numpy and the Insights table code are not needed
+    # by duplicate callbacks
+    from shared_code.insights import (VIDEO_QUEUE, processVideoInsights,
+                                      markProcessed)
+
+    try:
+        # Write the Insights of this video to the Insights table now
+        if process_mode == 'inline':
+            if video_insights is None:
+                return 'Failed: No insights parsed'
+            report = processVideoInsights(insights_path.split('/')[-1],
+                                          video_insights)
+            if report is None or report['failed']:
+                return 'Failed: {0}'.format(report)
+            markProcessed(sa_container, insights_path)
+            if job is not None:
+                tracker.transitionJob(job, tracker.PROCESSED)
+
+            return 'Success: {0} rows'.format(report['rows'])
+
+        # Or leave it to the ProcessVideoInsights queue trigger
+        if process_mode == 'queue':
+            queue_client = clients.getQueueClient(VIDEO_QUEUE)
+            message = {'container': sa_container, 'blob': insights_path,
+                       'video': metrics.getCorrelationId()}
+            if job is not None:
+                message.update({'job': job['RowKey'],
+                                'pk': job['PartitionKey']})
+            queue_client.send_message(json.dumps(message))
+
+            return 'Queued'
+
+        return 'Skipped'
+    except Exception as e:
+        logging.info('Failed: Process Video Indexer insights {0}'.format(e))
+
+        return 'Failed: {0}'.format(e)
+
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Starting...')
 
     # Get HTTPS request params
     vi_video_id = req.params.get('id')
+    vi_state = req.params.get('state')
+    tracker_pk = req.params.get('pk')
+    job_key = req.params.get('job')
+
+    # Get the tracked video, callbacks of videos submitted before jobs
+    # existed carry no job, pk is only passed by callbacks of jobs
+    # submitted before job partitions were derived from the job key
+    job = None
+    tracker_table = None
+    if job_key is not None:
+        job = tracker.getJob(tracker_pk or getJobPartitionKey(job_key),
+                             job_key)
+        if job is None:
+            return func.HttpResponse(
+                'Failed: Job {0} not found'.format(job_key),
+                status_code=404)
+    else:
+        tracker_table = tracker.getTableEntity(vi_video_id, tracker_pk)
+        if tracker_table is None:
+            return func.HttpResponse(
+                'Failed: Video {0} not found'.format(vi_video_id),
+                status_code=404)
+
+    # Metrics of every stage of a video are tagged with its blob path
+    metrics.setCorrelation((job or tracker_table)['VideoPath'], job=job_key,
+                           video_id=vi_video_id)
+
+    # Claim the tracker job so duplicate callbacks are no-ops
+    if job is not None:
+        if vi_state == 'Failed':
+            tracker.failJob(job, 'Video Indexer indexing failed')
+            return func.HttpResponse(
+                json.dumps({'id': vi_video_id, 'job': job_key,
+                            'state': tracker.FAILED}),
+                mimetype='application/json',
+                status_code=200)
+
+        claimed_job = tracker.claimIndexed(job, vi_video_id)
+        if claimed_job is None:
+            logging.info('Completed. Duplicate callback of job {0} in state {1}'.format(
+                job_key, job['State']))
+            return func.HttpResponse(
+                json.dumps({'id': vi_video_id, 'job': job_key,
+                            'state': job['State'], 'duplicate': True}),
+                mimetype='application/json',
+                status_code=200)
+        job = claimed_job
 
     # Get Azure Storage Table tracker params
-    tracker_table = getTableEntity(vi_video_id)
+    tracker_table = job or tracker_table
     sa_video_url = tracker_table['VideoUrl']
     sa_video_path = tracker_table['VideoPath']
     video_name = tracker_table['VideoName']
 
-    # Get Video Indexer JSON artifacts, store in Azure Blob
-    vi_artifacts = ['Ocr',
-                    'Faces',
-                    'VisualContentModeration',
-                    'TextualContentModeration',
-                    'LanguageDetection',
-                    'MultiLanguageDetection',
-                    'Metadata',
-                    'Emotions',
-                    'TextualContentModeration']
+    # Get the eager Video Indexer JSON artifacts, store in Azure Blob, the
+    # others are fetched by GetArtifact when first requested
+    vi_artifacts = artifacts.getEagerArtifacts()
+
+    # Concurrency and per-artifact timeout (seconds) of the artifact stage,
+    # and the stage deadline, kept under the 230 second HTTP response limit
+    max_inflight = int(os.environ.get('DI_MAX_INFLIGHT', 8))
+    timeout = float(os.environ.get('DI_ARTIFACT_TIMEOUT', 60))
+    stage_timeout = min(float(os.environ.get('DI_STAGE_TIMEOUT', 150)), 200)
+
+    # Artifacts stored with gzip content-encoding, comma separated or 'all',
+    # and whether to validate and re-serialize JSON before upload
+    gzip_artifacts = [a.strip() for a in
+                      os.environ.get('DI_GZIP_ARTIFACTS', '').split(',')]
+    reparse_json = os.environ.get('DI_REPARSE_JSON', 'false').lower() == 'true'
+
+    # Process Insights into the Insights table 'inline', through the
+    # ProcessVideoInsights 'queue' or 'off' to leave it to ProcessInsights
+    process_mode = os.environ.get('DI_PROCESS_MODE', 'inline').lower()
 
     vi_token = getViToken()
     sa_container = sa_video_path.split('/')[0]
     sa_video = '/'.join(sa_video_path.split('/')[1:])
 
-    # For each artifact type, write JSON to Azure Blob Storage
+    # For each artifact type, fetch JSON and write to Azure Blob Storage
+    artifact_jobs = dict()
     for vi_artifact in vi_artifacts:
-        vi_artifact_path = '{0}_{1}.json'.format(os.path.splitext(sa_video)[0],
-                                                 vi_artifact)
-
-        # Get Video Indexer JSON artifact
-        vi_artifact_json = getArtifact(vi_token, vi_video_id, vi_artifact)
-
-        # Save Video Indexer JSON artifact, local
-        with open(vi_artifact_path, 'w') as f:
-            json.dump(vi_artifact_json, f)
-
-        # Upload Video Indexer JSON artifact to Azure Blob Storage
-        putBlob(vi_artifact_path, sa_container)
-
-        # Delete local artifact file
-        os.remove(vi_artifact_path)
-
-    # Get Video Indexer Insights JSON to save to Azure Blob Storage
-    vi_insights_json = getInsights(vi_token, vi_video_id)
-
-    # Save Video Indexer JSON artifact, local
+        vi_artifact_path = artifacts.getArtifactPath(sa_video, vi_artifact)
+        artifact_jobs[vi_artifact] = (
+            partial(artifacts.getArtifact, vi_token, vi_video_id, vi_artifact,
+                    timeout),
+            vi_artifact_path,
+            'all' in gzip_artifacts or vi_artifact in gzip_artifacts,
+            None,
+            None)
+
+    # Get Video Indexer Insights JSON to save to Azure Blob Storage, never
+    # compressed since ProcessInsights parses it, hashed on the way into
+    # the index version keying cached artifacts, parsed when processed
+    # inline and tagged with its job so ProcessInsights can record it
+    # Processed
     vi_insights_path = '{0}_Insights.json'.format(video_name)
-
-    # Save Video Indexer JSON insights, local
-    with open(vi_insights_path, 'w') as f:
-        json.dump(vi_insights_json, f)
-
-    # Upload Video Indexer Insights JSON to Azure Blob Storage
-    putBlob(vi_insights_path, sa_container)
-
-    # Delete local artifact file
-    os.remove(vi_insights_path)
-
-    # Update Azure Storage tracking table
-    putTableEntity(
-        vi_video_id,
-        video_name,
-        sa_video_path,
+    parsed_insights = []
+    insights_digest = hashlib.sha1()
+
+    def tapInsightsChunks(chunks):
+        chunks = hashChunks(chunks, insights_digest)
+        if process_mode == 'inline':
+            from shared_code.insights import getInsightsPrefix, tapInsights
+            chunks = tapInsights(chunks, getInsightsPrefix(), parsed_insights)
+        return chunks
+
+    artifact_jobs['Insights'] = (
+        partial(getInsights, vi_token, vi_video_id, timeout),
         vi_insights_path,
-        sa_video_url)
-
-    logging.info('Completed.')
-
+        False,
+        tapInsightsChunks,
+        dict(tracker.getJobMetadata(job) if job is not None else dict(),
+             **metrics.getCorrelationMetadata()))
+
+    # Fetch and upload all artifacts and Insights in parallel
+    artifacts_report = putArtifacts(artifact_jobs,
+                                    sa_container,
+                                    max_inflight,
+                                    timeout,
+                                    stage_timeout,
+                                    reparse_json)
+
+    insights_stored = artifacts_report.get('Insights') == 'Success'
+    failed_artifacts = [k for k, v in artifacts_report.items()
+                        if v != 'Success' and k != 'Insights']
+    index_version = artifacts.getIndexVersion(insights_digest) \
+        if insights_stored else None
+
+    # Record the job Downloaded, or Failed so the video can be submitted
+    # again when its Insights are missing. Failed artifacts are recorded
+    # on the job, GetArtifact fetches them when first requested
+    if job is not None:
+        if not insights_stored:
+            tracker.failJob(job, 'Failed Insights: {0}'.format(
+                artifacts_report.get('Insights')))
+            job = None
+        else:
+            job = tracker.transitionJob(job, tracker.DOWNLOADED,
+                                        {'InsightsPath': vi_insights_path,
+                                         'IndexVersion': index_version,
+                                         'FailedArtifacts': ', '.join(
+                                             failed_artifacts)})
+
+    # Process the uploaded Insights of this video
+    if insights_stored:
+        insights_report = processInsights(process_mode,
+                                          sa_container,
+                                          vi_insights_path,
+                                          parsed_insights[0]
+                                          if parsed_insights else None,
+                                          job)
+    else:
+        insights_report = 'Failed: Insights not stored'
+    logging.info('Video Indexer insights processing: {0}'.format(
+        insights_report))
+
+    # Update Azure Storage tracking table of videos without a job
+    if job_key is None:
+        putTableEntity(
+            tracker_table['PartitionKey'],
+            vi_video_id,
+            video_name,
+            sa_video_path,
+            vi_insights_path,
+            sa_video_url,
+            index_version)
+
+    logging.info('Completed. Video Indexer calls: {0}'.format(getViMetrics()))
+
+    # Return per-artifact success/failure report
     return func.HttpResponse(
-        'Success: Video Indexer JSON uploaded to Azure Blob Storage',
-        status_code=200)
+        json.dumps({'id': vi_video_id,
+                    'artifacts': artifacts_report,
+                    'insights': insights_report}),
+        mimetype='application/json',
+        status_code=200 if insights_stored else 500)
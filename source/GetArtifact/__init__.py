@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+from contextlib import closing
+import azure.functions as func
+from shared_code import clients, tracker, artifacts, metrics
+from shared_code.vi_client import getViToken
+from shared_code.partitioning import getJobPartitionKey
+
+
+def getStoredArtifact(entity, artifact_type):
+    '''
+    '''
+    from azure.core.exceptions import ResourceNotFoundError
+
+    # Eager artifact stored by DownloadInsights next to the video, with its
+    # content-encoding
+    sa_video_path = entity['VideoPath']
+    sa_container = sa_video_path.split('/')[0]
+    sa_video = '/'.join(sa_video_path.split('/')[1:])
+    blob_client = clients.getBlobServiceClient().get_blob_client(
+        container=sa_container,
+        blob=artifacts.getArtifactPath(sa_video, artifact_type))
+    try:
+        download_stream = blob_client.download_blob()
+        content_settings = download_stream.properties.content_settings
+
+        return download_stream.readall(), content_settings.content_encoding
+    except ResourceNotFoundError:
+        return None, None
+
+
+def fetchArtifact(entity, artifact_type):
+    '''
+    Artifact bytes, their content-encoding and where they came from,
+    'blob', 'cache' or 'vi'.
+    '''
+    video_id = entity['VideoIndexerId']
+    index_version = entity.get('IndexVersion')
+
+    # Eager artifacts of downloaded videos are already in Blob Storage
+    if artifact_type in artifacts.getEagerArtifacts() and \
+            entity.get('State') in (tracker.DOWNLOADED, tracker.PROCESSED):
+        data, content_encoding = getStoredArtifact(entity, artifact_type)
+        if data is not None:
+            return data, content_encoding, 'blob'
+
+    # Then the artifact cache, keyed by the index version of the video
+    cache_key = artifacts.getCacheKey(video_id, artifact_type, index_version)
+    data = artifacts.getCachedArtifact(cache_key)
+    if data is not None:
+        return data, None, 'cache'
+
+    # First request of this artifact of this index, fetch and cache it,
+    # retries included within the per-artifact timeout
+    timeout = float(os.environ.get('DI_ARTIFACT_TIMEOUT', 60))
+    response = artifacts.getArtifact(getViToken(), video_id, artifact_type,
+                                     timeout, deadline=time.time() + timeout)
+    if response is None:
+        return None, None, 'vi'
+    with closing(response):
+        data = response.content
+    artifacts.putCachedArtifact(cache_key, data, video_id, artifact_type,
+                                index_version)
+
+    return data, None, 'vi'
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Starting...')
+
+    # Get HTTPS request params, the video by Video Indexer id or by its
+    # tracker job and the artifact type
+    vi_video_id = req.params.get('id')
+    job_key = req.params.get('job')
+    tracker_pk = req.params.get('pk')
+    artifact_type = req.params.get('type')
+
+    if artifact_type not in artifacts.getEagerArtifacts() + \
+            artifacts.getLazyArtifacts():
+        return func.HttpResponse(
+            'Failed: Artifact type {0} is not available'.format(artifact_type),
+            status_code=400)
+    if job_key is None and vi_video_id is None:
+        return func.HttpResponse('Failed: id or job is required',
+                                 status_code=400)
+
+    # Get the tracked video, only indexed videos have artifacts
+    if job_key is not None:
+        entity = tracker.getJob(tracker_pk or getJobPartitionKey(job_key),
+                                job_key)
+    else:
+        entity = tracker.getTableEntity(vi_video_id, tracker_pk)
+    if entity is None or not entity.get('VideoIndexerId'):
+        return func.HttpResponse(
+            'Failed: Video {0} not found'.format(job_key or vi_video_id),
+            status_code=404)
+
+    # Metrics of every stage of a video are tagged with its blob path
+    metrics.setCorrelation(entity.get('VideoPath'), job=job_key,
+                           video_id=entity['VideoIndexerId'])
+
+    try:
+        data, content_encoding, source = fetchArtifact(entity, artifact_type)
+    except Exception as e:
+        logging.info('Failed: Get artifact {0} of video {1} {2}'.format(
+            artifact_type, entity['VideoIndexerId'], e))
+        return func.HttpResponse(
+            'Failed: Get artifact {0} {1}'.format(artifact_type, e),
+            status_code=500)
+    if data is None:
+        return func.HttpResponse(
+            'Failed: Get Video Indexer artifact {0}'.format(artifact_type),
+            status_code=502)
+
+    logging.info('Completed. {0} artifact of video {1} from {2}'.format(
+        artifact_type, entity['VideoIndexerId'], source))
+
+    headers = {'X-Artifact-Source': source}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+
+    return func.HttpResponse(data,
+                             headers=headers,
+                             mimetype='application/json',
+                             status_code=200)
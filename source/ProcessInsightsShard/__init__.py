@@ -0,0 +1,37 @@
+import json
+import logging
+import azure.functions as func
+from shared_code import sharding, processing, metrics
+
+
+def processShard(shard):
+    '''
+    Process the Insights blobs of one shard and record its status.
+    '''
+    logging.info('Processing shard {0} of run {1}'.format(shard['shard'],
+                                                          shard['run']))
+    sharding.putShardStatus(shard, 'Running')
+
+    try:
+        report = processing.processBlobs(shard['container'], shard['full'], shard)
+        sharding.putShardStatus(shard, 'Completed', report)
+        sharding.deleteShardBlobs(shard)
+
+        logging.info('Success: Processed shard {0} {1}'.format(
+            shard['shard'], report))
+
+        return report
+    except Exception as e:
+        logging.info('Failed: Process shard {0} {1}'.format(shard['shard'], e))
+        sharding.putShardStatus(shard, 'Failed')
+
+
+def main(msg: func.QueueMessage) -> None:
+    logging.info('Starting...')
+
+    # Get shard from the queue message sent by ProcessInsights mode=fanout
+    shard = json.loads(msg.get_body().decode('utf-8'))
+    metrics.setCorrelation(None, run=shard['run'], shard=shard['shard'])
+    processShard(shard)
+
+    logging.info('Completed.')
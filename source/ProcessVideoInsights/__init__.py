@@ -0,0 +1,26 @@
+import json
+import logging
+import azure.functions as func
+from shared_code import tracker, metrics
+from shared_code.insights import processInsightsBlob
+
+
+def main(msg: func.QueueMessage) -> None:
+    logging.info('Starting...')
+
+    # Get Insights blob from the queue message sent by DownloadInsights
+    message = json.loads(msg.get_body().decode('utf-8'))
+    metrics.setCorrelation(message.get('video') or message['blob'],
+                           job=message.get('job'))
+    report = processInsightsBlob(message['container'], message['blob'])
+
+    # Failed rows are retried by the queue, the blob is not checkpointed
+    if report is None or report['failed']:
+        raise RuntimeError('Failed: Process Insights blob {0} {1}'.format(
+            message['blob'], report))
+
+    # Record the tracker job of the video Processed, blobs downloaded
+    # before they named their job are recorded from the message
+    tracker.completeJob(message.get('pk'), message.get('job'))
+
+    logging.info('Completed. {0}'.format(report))
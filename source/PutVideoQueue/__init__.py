@@ -0,0 +1,113 @@
+import os
+import json
+import logging
+from itertools import islice
+import azure.functions as func
+from shared_code import clients, metrics
+from shared_code.vi_client import getViToken, getViMetrics
+from shared_code.videos import JOB_QUEUE, POISON_QUEUE, submitVideos
+
+
+def parseVideo(body):
+    '''
+    '''
+    # Job message sent by UploadVideo, None when malformed
+    try:
+        video = json.loads(body)
+        if all(video.get(key) for key in ('path', 'name', 'uri')):
+            return video
+    except (ValueError, AttributeError):
+        pass
+
+    logging.info('Failed: Malformed PutVideo job message {0}'.format(body))
+
+
+def receiveVideos(queue_client, max_messages, visibility_timeout):
+    '''
+    '''
+    # Drain more job messages so one token and HTTP session serve a batch,
+    # a page holds at most 32 messages
+    messages = []
+    try:
+        while len(messages) < max_messages:
+            page_size = min(max_messages - len(messages), 32)
+            page = list(islice(queue_client.receive_messages(
+                messages_per_page=page_size,
+                visibility_timeout=visibility_timeout), page_size))
+            messages.extend(page)
+            if len(page) < page_size:
+                break
+    except Exception as e:
+        logging.info('Failed: Receive PutVideo job messages {0}'.format(e))
+
+    return messages
+
+
+def settleMessage(queue_client, message, video, submitted, max_dequeue):
+    '''
+    '''
+    try:
+        # Submitted messages are done, failed ones become visible again
+        # after the visibility timeout until they reach the poison queue.
+        # Messages of videos another invocation is still submitting are
+        # left alone, they are settled once its upload succeeds or fails
+        if submitted:
+            queue_client.delete_message(message)
+        elif submitted is None:
+            logging.info('Skipped: PutVideo job {0} is being submitted'.format(
+                message.content))
+        elif video is None or message.dequeue_count >= max_dequeue:
+            clients.getQueueClient(POISON_QUEUE).send_message(message.content)
+            queue_client.delete_message(message)
+            logging.info('Failed: Moved PutVideo job to {0} {1}'.format(
+                POISON_QUEUE, message.content))
+    except Exception as e:
+        logging.info('Failed: Settle PutVideo job message {0}'.format(e))
+
+
+def main(msg: func.QueueMessage) -> None:
+    logging.info('Starting...')
+    metrics.setCorrelation(None)
+
+    # Messages per invocation, concurrent submissions, and the retries and
+    # seconds between retries of drained messages
+    batch_size = int(os.environ.get('PV_BATCH_SIZE', 32))
+    concurrency = int(os.environ.get('PV_BATCH_CONCURRENCY', 8))
+    max_dequeue = int(os.environ.get('PV_MAX_DEQUEUE', 5))
+    retry_seconds = int(os.environ.get('PV_RETRY_SECONDS', 60))
+
+    # Triggering message plus up to batch_size - 1 drained ones
+    queue_client = clients.getQueueClient(JOB_QUEUE)
+    messages = receiveVideos(queue_client, batch_size - 1, retry_seconds)
+    trigger_video = parseVideo(msg.get_body().decode('utf-8'))
+    videos = [parseVideo(message.content) for message in messages]
+
+    # Submit every well formed video with one cached access token
+    vi_token = getViToken()
+    pending = [video for video in [trigger_video] + videos
+               if video is not None]
+    results = dict(zip([id(video) for video in pending],
+                       submitVideos(vi_token, pending, concurrency)))
+
+    for message, video in zip(messages, videos):
+        settleMessage(queue_client, message, video,
+                      results[id(video)] if video is not None else False,
+                      max_dequeue)
+
+    logging.info('Completed. Videos: {0} Submitted: {1} Video Indexer calls: {2}'.format(
+        len(pending), sum(1 for submitted in results.values() if submitted),
+        getViMetrics()))
+
+    # Malformed triggering messages are never retried
+    if trigger_video is None:
+        clients.getQueueClient(POISON_QUEUE).send_message(
+            msg.get_body().decode('utf-8'))
+        return
+
+    # Fail the trigger so the Functions host retries it and moves it to
+    # the poison queue after maxDequeueCount attempts, also when another
+    # invocation is still submitting the video so it is retried if that
+    # upload fails
+    if not results[id(trigger_video)]:
+        raise RuntimeError('Failed: PutVideo job {0}'.format(
+            trigger_video['path']))
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+from shared_code import clients, metrics
+from shared_code.partitioning import (getIndexPartitionKey,
+                                      getIndexPartitionKeys, getIndexRowKey,
+                                      getIndexFeatureKey, normalizeFeature,
+                                      sanitizeKey, INDEX_FEATURE_KEY_LENGTH)
+
+
+# Properties of index entities returned by queries
+SELECT = ['FileName', 'SourceLanguage', 'FeatureType', 'Feature',
+          'MaxConfidence', 'MeanConfidence', 'Occurrences']
+
+# Responses of recent queries of this worker, {query: (expires, body)}
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def getCachedResponse(query):
+    '''
+    '''
+    with _cache_lock:
+        cached = _cache.get(query)
+        if cached is None:
+            return None
+        if cached[0] < time.time():
+            del _cache[query]
+            return None
+        _cache.move_to_end(query)
+
+        return cached[1]
+
+
+def putCachedResponse(query, body):
+    '''
+    '''
+    # Least recently used responses are evicted first
+    cache_size = int(os.environ.get('QI_CACHE_SIZE', 1024))
+    cache_seconds = float(os.environ.get('QI_CACHE_SECONDS', 60))
+    if cache_size <= 0 or cache_seconds <= 0:
+        return
+
+    with _cache_lock:
+        _cache[query] = (time.time() + cache_seconds, body)
+        _cache.move_to_end(query)
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+
+
+def quote(value):
+    '''
+    '''
+    # OData string literal
+    return "'{0}'".format(str(value).replace("'", "''"))
+
+
+def getPrefixEnd(prefix):
+    '''
+    '''
+    # Smallest key greater than every key starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+@metrics.instrument('queryIndex')
+def queryIndex(feature_type, feature, min_confidence, language=None,
+               video=None, prefix=False):
+    '''
+    Index entities of videos with a feature, read as a RowKey range of the
+    partition of its feature type, of every partition of the feature type
+    for a feature prefix, or a single row for a video.
+    '''
+    table_service = clients.getTableService()
+    index_table = os.environ['SA_TABLE_INDEX']
+    normalized_feature = normalizeFeature(feature)
+
+    try:
+        # Point read of one video
+        if video is not None:
+            entity = table_service.get_entity(
+                index_table, getIndexPartitionKey(feature_type, feature),
+                getIndexRowKey(feature, video), select=','.join(SELECT))
+            entities = [entity]
+        else:
+            # Rows of the feature, or of features starting with the prefix
+            # as far as it is kept in RowKeys
+            if prefix:
+                partition_keys = getIndexPartitionKeys(feature_type)
+                row_prefix = sanitizeKey(normalized_feature)[
+                    :INDEX_FEATURE_KEY_LENGTH - 17]
+            else:
+                partition_keys = [getIndexPartitionKey(feature_type, feature)]
+                row_prefix = getIndexFeatureKey(feature) + '|'
+            entities = []
+            for partition_key in partition_keys:
+                query_filter = 'PartitionKey eq {0} and RowKey ge {1} and RowKey lt {2}'.format(
+                    quote(partition_key), quote(row_prefix),
+                    quote(getPrefixEnd(row_prefix)))
+                if min_confidence > 0:
+                    query_filter += ' and MaxConfidence ge {0}'.format(
+                        float(min_confidence))
+                if language is not None:
+                    query_filter += ' and SourceLanguage eq {0}'.format(
+                        quote(language))
+                entities.extend(table_service.query_entities(
+                    index_table, filter=query_filter,
+                    select=','.join(SELECT)))
+
+        # Keys are sanitized and shortened, match the features themselves
+        results = [{name: entity.get(name) for name in SELECT}
+                   for entity in entities
+                   if entity.get('MaxConfidence', 0) >= min_confidence and
+                   (language is None or
+                    entity.get('SourceLanguage') == language) and
+                   (normalizeFeature(entity.get('Feature', '')).startswith(
+                       normalized_feature) if prefix else
+                    normalizeFeature(entity.get('Feature', '')) ==
+                    normalized_feature)]
+    except AzureMissingResourceHttpError:
+        results = []
+    except Exception as e:
+        logging.info('Failed: Query Insights index {0}'.format(e))
+        return None
+
+    metrics.count('rows', len(results))
+
+    return results
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Starting...')
+
+    # Get HTTPS request params
+    feature_type = req.params.get('type')
+    feature = req.params.get('feature')
+    language = req.params.get('language')
+    video = req.params.get('video')
+    prefix = req.params.get('prefix', 'false').lower() == 'true'
+    metrics.setCorrelation(None, feature_type=feature_type, feature=feature)
+
+    if not os.environ.get('SA_TABLE_INDEX'):
+        return func.HttpResponse('Failed: SA_TABLE_INDEX is not set',
+                                 status_code=501)
+    if not feature_type or not feature or not normalizeFeature(feature):
+        return func.HttpResponse('Failed: type and feature are required',
+                                 status_code=400)
+    try:
+        min_confidence = float(req.params.get('min_confidence', 0))
+        top = int(req.params.get('top', 100))
+    except ValueError:
+        return func.HttpResponse(
+            'Failed: min_confidence must be a number and top an integer',
+            status_code=400)
+    if top < 1:
+        return func.HttpResponse('Failed: top must be at least 1',
+                                 status_code=400)
+    top = min(top, 1000)
+
+    # Same normalized query, same response
+    query = (feature_type, normalizeFeature(feature), min_confidence,
+             language, video, prefix, top)
+    body = getCachedResponse(query)
+    cache = 'hit'
+    if body is None:
+        cache = 'miss'
+        results = queryIndex(feature_type, feature, min_confidence,
+                             language=language, video=video, prefix=prefix)
+        if results is None:
+            return func.HttpResponse('Failed: Query Insights index',
+                                     status_code=500)
+
+        # Most confident videos first
+        results.sort(key=lambda result: (-result['MaxConfidence'],
+                                         result['FileName']))
+        body = json.dumps({'count': len(results[:top]),
+                           'results': results[:top]})
+        putCachedResponse(query, body)
+
+    logging.info('Completed. Query {0} {1} cache {2}'.format(
+        feature_type, feature, cache))
+
+    return func.HttpResponse(body,
+                             headers={'X-Cache': cache},
+                             mimetype='application/json',
+                             status_code=200)
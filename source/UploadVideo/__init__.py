@@ -1,8 +1,10 @@
 import os
+import json
 import logging
-import requests
 from pathlib import Path
 import azure.functions as func
+from shared_code import clients, metrics
+from shared_code.vi_client import SUPPORTED_FORMATS
 
 
 def putVideo(blob_path, blob_name, blob_uri):
@@ -19,8 +21,9 @@ def putVideo(blob_path, blob_name, blob_uri):
         request_url = os.environ['AF_PUTVIDEO_URL']
 
         # Get Video Indexer access token
-        response = requests.get(request_url,
-                                params=params)
+        session = clients.getHttpSession()
+        response = session.get(request_url,
+                               params=params)
         response.raise_for_status()
 
         logging.info('Success: Sent blob information to PutVideo function')
@@ -32,25 +35,33 @@ def putVideo(blob_path, blob_name, blob_uri):
             'Failed: Send blob information to PutVideo Function: {0}'.format(e))
 
 
-def main(myblob: func.InputStream):
+def main(myblob: func.InputStream, msg: func.Out[str]):
     logging.info('Starting...')
 
     # Get blob params
     sa_blob_path = str(myblob.name)
     sa_blob_name = str(Path(sa_blob_path).stem)
     sa_blob_uri = str(myblob.uri)
+    metrics.setCorrelation(sa_blob_path)
 
-    supported_formats = ['.mxf', '.gxf', '.ts', '.ps', '.3gp',
-                         '.3gpp', '.mpg', '.wmv', '.asf', '.avi',
-                         '.mp4', '.m4a', '.m4v', '.isma', '.ismv',
-                         '.dvr-ms', '.mkv', '.wav', '.mov']
+    # Send blob to PutVideo through the putvideo-jobs queue, or 'http' to
+    # call it directly
+    dispatch_mode = os.environ.get('UV_DISPATCH_MODE', 'queue').lower()
 
     # Check for supported video format in VI
-    if Path(sa_blob_path).suffix in supported_formats:
-        # Get Video Indexer access token and upload video
-        putVideo(sa_blob_path, sa_blob_name, sa_blob_uri)
-    else:
+    if Path(sa_blob_path).suffix not in SUPPORTED_FORMATS:
         logging.info(
             '{0} unsupported file format in Video Indexer'.format(sa_blob_path))
+    elif dispatch_mode == 'http':
+        # Get Video Indexer access token and upload video
+        with metrics.timer('putVideo'):
+            putVideo(sa_blob_path, sa_blob_name, sa_blob_uri)
+    else:
+        # Enqueue a job message, failures fail the trigger so the Functions
+        # host retries the blob instead of losing the video
+        msg.set(json.dumps({'path': sa_blob_path,
+                            'name': sa_blob_name,
+                            'uri': sa_blob_uri}))
+        logging.info('Success: Queued {0} for PutVideo'.format(sa_blob_path))
 
     logging.info('Completed.')
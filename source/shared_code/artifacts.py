@@ -0,0 +1,165 @@
+import os
+import hashlib
+import logging
+from . import clients, metrics
+from .vi_client import getViApiUrl, getDeadlineTimeout, viRequest
+
+
+# Video Indexer JSON artifact types the pipeline knows about
+ARTIFACT_TYPES = ['Ocr',
+                  'Faces',
+                  'VisualContentModeration',
+                  'TextualContentModeration',
+                  'LanguageDetection',
+                  'MultiLanguageDetection',
+                  'Metadata',
+                  'Emotions']
+
+# Index version of videos downloaded before versions were recorded
+UNVERSIONED = 'unversioned'
+
+
+def getArtifactTypes(setting, default='all'):
+    '''
+    Artifact types of a comma separated setting, 'all' or 'none'.
+    '''
+    value = os.environ.get(setting, default).strip()
+    if value.lower() == 'all':
+        return list(ARTIFACT_TYPES)
+    if value.lower() in ('', 'none'):
+        return []
+
+    types = [a.strip() for a in value.split(',') if a.strip()]
+
+    # Keep the order of the setting but fetch each type once
+    return [a for i, a in enumerate(types) if a not in types[:i]]
+
+
+def getEagerArtifacts():
+    '''
+    Artifacts DownloadInsights stores next to every video.
+    '''
+    return getArtifactTypes('DI_EAGER_ARTIFACTS')
+
+
+def getLazyArtifacts():
+    '''
+    Artifacts GetArtifact fetches from Video Indexer on first request.
+    '''
+    return getArtifactTypes('DI_LAZY_ARTIFACTS')
+
+
+def getArtifactPath(video_blob, artifact_type):
+    '''
+    Blob name of an artifact stored next to its video blob.
+    '''
+    return '{0}_{1}.json'.format(os.path.splitext(video_blob)[0],
+                                 artifact_type)
+
+
+@metrics.instrument('getArtifact')
+def getArtifact(access_token, video_id, artifact_type, timeout=None,
+                deadline=None):
+    '''
+    '''
+    try:
+        # Attempt connection to VI for video JSON artifact
+        logging.info(
+            'Getting Video Indexer {0} artifact'.format(artifact_type))
+
+        # Format HTTPS Request
+        params = {'accessToken': access_token}
+        request_url = '{0}/{1}/Accounts/{2}/Videos/{3}/ArtifactUrl?type={4}'.format(
+            getViApiUrl(), os.environ['VI_LOCATION'], os.environ['VI_ACCOUNT_ID'],
+            video_id, artifact_type)
+
+        # Get Video Indexer video JSON artifact
+        response = viRequest('GET',
+                             request_url,
+                             deadline=deadline,
+                             params=params,
+                             timeout=timeout)
+        response.raise_for_status()
+
+        # Stream Video Indexer JSON artifact from the returned SAS URL
+        session = clients.getHttpSession()
+        artifact_response = session.get(response.json(),
+                                        timeout=getDeadlineTimeout(timeout,
+                                                                   deadline),
+                                        stream=True)
+        artifact_response.raise_for_status()
+
+        logging.info(
+            'Success: Video Indexer {0} artifact returned'.format(artifact_type))
+
+        # Return Video Indexer JSON artifact response, body not yet read
+        return artifact_response
+    except Exception as e:
+        logging.info('Failed: Get Video Indexer artifact - id: {0} artifact_type: {1} {2}'.format(
+            video_id, artifact_type, e))
+
+
+def getIndexVersion(digest):
+    '''
+    '''
+    # Hash of the Insights JSON as downloaded, it changes when a video is
+    # indexed again
+    return 'sha1-{0}'.format(digest.hexdigest())
+
+
+def getCacheContainer():
+    '''
+    '''
+    return os.environ.get('DI_ARTIFACT_CACHE_CONTAINER', 'artifact-cache')
+
+
+def getCacheKey(video_id, artifact_type, index_version):
+    '''
+    Blob name of a cached artifact, addressed by video, type and index
+    version so artifacts of a new index never hit stale entries.
+    '''
+    key = hashlib.sha256('{0}/{1}/{2}'.format(
+        video_id, artifact_type, index_version or UNVERSIONED).encode(
+            'utf-8')).hexdigest()
+
+    return '{0}/{1}.json'.format(key[:2], key)
+
+
+def getCachedArtifact(cache_key):
+    '''
+    Cached artifact bytes, or None on a miss.
+    '''
+    from azure.core.exceptions import ResourceNotFoundError
+
+    blob_client = clients.getContainerClient(
+        getCacheContainer()).get_blob_client(cache_key)
+    try:
+        return blob_client.download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+
+
+def putCachedArtifact(cache_key, data, video_id, artifact_type,
+                      index_version):
+    '''
+    '''
+    from azure.storage.blob import ContentSettings
+
+    try:
+        # Same key, same content, so concurrent first requests may both
+        # write it
+        blob_client = clients.getContainerClient(
+            getCacheContainer()).get_blob_client(cache_key)
+        blob_client.upload_blob(
+            data,
+            overwrite=True,
+            content_settings=ContentSettings(content_type='application/json'),
+            metadata={'video_id': video_id,
+                      'artifact_type': artifact_type,
+                      'index_version': index_version or UNVERSIONED})
+
+        logging.info('Success: Cached {0} artifact of video {1}'.format(
+            artifact_type, video_id))
+    except Exception as e:
+        logging.info('Failed: Cache {0} artifact of video {1} {2}'.format(
+            artifact_type, video_id, e))
@@ -0,0 +1,120 @@
+import os
+import json
+import logging
+from urllib.parse import quote, unquote
+from . import clients, tables
+
+
+def getCheckpointStore():
+    '''
+    Return the checkpoint backend, 'table' or 'file:<path to JSON file>'.
+    '''
+    return os.environ.get('PI_CHECKPOINT_STORE', 'table')
+
+
+def loadCheckpoint(blob_container):
+    '''
+    Return {blob name: ETag} of the blobs processed so far in a container.
+    '''
+    try:
+        logging.info('Getting processed blobs checkpoint')
+
+        store = getCheckpointStore()
+        if store.startswith('file:'):
+            # Local JSON checkpoint, keyed by container
+            checkpoint_path = store[len('file:'):]
+            if not os.path.exists(checkpoint_path):
+                return dict()
+            with open(checkpoint_path, 'r') as f:
+                return json.load(f).get(blob_container, dict())
+
+        # Azure Storage Table checkpoint, one entity per blob
+        table_service = clients.getTableService()
+        if not table_service.exists(os.environ['SA_TABLE_CHECKPOINT']):
+            return dict()
+        entities = table_service.query_entities(
+            os.environ['SA_TABLE_CHECKPOINT'],
+            filter="PartitionKey eq '{0}'".format(blob_container),
+            select='RowKey, BlobETag')
+
+        checkpoint = {unquote(entity['RowKey']): entity['BlobETag']
+                      for entity in entities}
+
+        logging.info(
+            'Success: Got checkpoint of {0} blobs'.format(len(checkpoint)))
+
+        return checkpoint
+    except Exception as e:
+        logging.info('Failed: Get processed blobs checkpoint {0}'.format(e))
+        return dict()
+
+
+def saveCheckpoint(blob_container, processed_blobs):
+    '''
+    Record {blob name: ETag} of newly processed blobs in a container.
+    '''
+    try:
+        if not processed_blobs:
+            return
+
+        logging.info('Putting checkpoint of {0} processed blobs'.format(
+            len(processed_blobs)))
+
+        store = getCheckpointStore()
+        if store.startswith('file:'):
+            # Local JSON checkpoint, rewritten atomically
+            checkpoint_path = store[len('file:'):]
+            checkpoint = dict()
+            if os.path.exists(checkpoint_path):
+                with open(checkpoint_path, 'r') as f:
+                    checkpoint = json.load(f)
+            checkpoint.setdefault(blob_container, dict()).update(
+                processed_blobs)
+            with open(checkpoint_path + '.tmp', 'w') as f:
+                json.dump(checkpoint, f)
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        else:
+            # Azure Storage Table checkpoint, blob names are quoted since
+            # '/' is not allowed in a RowKey
+            table_service = clients.getTableService()
+            for blob_name, blob_etag in processed_blobs.items():
+                entity = {'PartitionKey': blob_container,
+                          'RowKey': quote(blob_name, safe=''),
+                          'BlobETag': blob_etag}
+                tables.putWithTable(
+                    table_service,
+                    os.environ['SA_TABLE_CHECKPOINT'],
+                    lambda: table_service.insert_or_replace_entity(
+                        os.environ['SA_TABLE_CHECKPOINT'], entity))
+
+        logging.info('Success: Put processed blobs checkpoint')
+    except Exception as e:
+        logging.info('Failed: Put processed blobs checkpoint {0}'.format(e))
+
+
+def clearCheckpoint(blob_container):
+    '''
+    Forget every processed blob of a container, forcing a full rebuild.
+    '''
+    try:
+        logging.info('Clearing processed blobs checkpoint')
+
+        store = getCheckpointStore()
+        if store.startswith('file:'):
+            checkpoint_path = store[len('file:'):]
+            if os.path.exists(checkpoint_path):
+                with open(checkpoint_path, 'r') as f:
+                    checkpoint = json.load(f)
+                checkpoint.pop(blob_container, None)
+                with open(checkpoint_path, 'w') as f:
+                    json.dump(checkpoint, f)
+        else:
+            table_service = clients.getTableService()
+            for blob_name in loadCheckpoint(blob_container):
+                table_service.delete_entity(os.environ['SA_TABLE_CHECKPOINT'],
+                                            blob_container,
+                                            quote(blob_name, safe=''))
+
+        logging.info('Success: Cleared processed blobs checkpoint')
+    except Exception as e:
+        logging.info('Failed: Clear processed blobs checkpoint {0}'.format(e))
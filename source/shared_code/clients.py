@@ -0,0 +1,165 @@
+import os
+import threading
+
+
+# Clients created on first use and reused across warm invocations, the
+# SDKs are imported by their factories so cold starts of functions that
+# never use a client do not pay for importing it
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def getClient(name, factory):
+    '''
+    Registered client, created once per worker by factory on first use.
+    '''
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+
+    return client
+
+
+def setClient(name, client):
+    '''
+    Register a client instead of creating one, e.g. a local stand-in.
+    '''
+    with _clients_lock:
+        _clients[name] = client
+
+
+def createHttpSession():
+    '''
+    '''
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # Keep-alive connection pool sized for the concurrent requests of one
+    # worker
+    pool_size = int(os.environ.get('HTTP_POOL_SIZE', 32))
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def getHttpSession():
+    '''
+    Shared requests session for Video Indexer and Azure Function calls.
+    '''
+    return getClient('http', createHttpSession)
+
+
+def createBlobServiceClient():
+    '''
+    '''
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.storage.blob import BlobServiceClient
+
+    return BlobServiceClient.from_connection_string(
+        os.environ['SA_CONNX_STRING'],
+        transport=RequestsTransport(session=createHttpSession(),
+                                    session_owner=False))
+
+
+def getBlobServiceClient():
+    '''
+    Shared Azure Blob Storage client.
+    '''
+    return getClient('blob', createBlobServiceClient)
+
+
+def createContainerClient(container_name):
+    '''
+    '''
+    from azure.core.exceptions import ResourceExistsError
+
+    # Container created once per worker, for containers the pipeline owns
+    container_client = getBlobServiceClient().get_container_client(
+        container_name)
+    try:
+        container_client.create_container()
+    except ResourceExistsError:
+        pass
+
+    return container_client
+
+
+def getContainerClient(container_name):
+    '''
+    Shared client of one blob container, created if missing.
+    '''
+    return getClient('container:{0}'.format(container_name),
+                     lambda: createContainerClient(container_name))
+
+
+def createTableService():
+    '''
+    '''
+    from azure.cosmosdb.table.tableservice import TableService
+
+    return TableService(connection_string=os.environ['SA_CONNX_STRING'],
+                        request_session=createHttpSession())
+
+
+def getTableService():
+    '''
+    Shared Azure Storage Table client.
+    '''
+    return getClient('table', createTableService)
+
+
+def createQueueServiceClient():
+    '''
+    '''
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.storage.queue import QueueServiceClient
+
+    return QueueServiceClient.from_connection_string(
+        os.environ['SA_CONNX_STRING'],
+        transport=RequestsTransport(session=createHttpSession(),
+                                    session_owner=False))
+
+
+def getQueueServiceClient():
+    '''
+    Shared Azure Storage Queue client.
+    '''
+    return getClient('queue', createQueueServiceClient)
+
+
+def createQueueClient(queue_name):
+    '''
+    '''
+    from azure.core.exceptions import ResourceExistsError
+    from azure.storage.queue import (TextBase64EncodePolicy,
+                                     TextBase64DecodePolicy)
+
+    # Messages are base64 encoded as expected by Azure Functions queue
+    # triggers, the queue is created once per worker
+    queue_client = getQueueServiceClient().get_queue_client(
+        queue_name,
+        message_encode_policy=TextBase64EncodePolicy(),
+        message_decode_policy=TextBase64DecodePolicy())
+    try:
+        queue_client.create_queue()
+    except ResourceExistsError:
+        pass
+
+    return queue_client
+
+
+def getQueueClient(queue_name):
+    '''
+    Shared client of one queue.
+    '''
+    return getClient('queue:{0}'.format(queue_name),
+                     lambda: createQueueClient(queue_name))
@@ -0,0 +1,256 @@
+import os
+import uuid
+import logging
+import datetime
+from . import clients, metrics
+
+
+# Columns of exported Insights files and their Arrow types, the feature
+# type and ingestion date are partition directories,
+# feature_type={type}/ingest_date={YYYY-MM-DD}. pyarrow is imported on
+# first use, it is the slowest import of the app
+EXPORT_COLUMNS = [('vi_file_name', 'string'),
+                  ('vi_source_language', 'string'),
+                  ('vi_feature', 'string'),
+                  ('vi_confidence_score', 'float64'),
+                  ('vi_mean_confidence_score', 'float64'),
+                  ('vi_occurrences', 'int64'),
+                  ('vi_duration', 'float64')]
+
+# Repeated strings stored once per file and read back as dictionary arrays
+DICTIONARY_COLUMNS = ['vi_file_name', 'vi_source_language', 'vi_feature']
+
+
+def getExportFormat():
+    '''
+    Columnar export of processed Insights, 'parquet' or 'off'.
+    '''
+    return os.environ.get('PI_EXPORT_FORMAT', 'parquet').lower()
+
+
+def getExportContainer():
+    '''
+    '''
+    return os.environ.get('PI_EXPORT_CONTAINER', 'insights-export')
+
+
+def getPartitionPath(feature_type, ingest_date):
+    '''
+    '''
+    return 'feature_type={0}/ingest_date={1}/'.format(feature_type,
+                                                      ingest_date)
+
+
+def getPartName(timestamp, suffix=''):
+    '''
+    Part file name, ordered by the time its rows were ingested.
+    '''
+    return 'part-{0}-{1}{2}.parquet'.format(timestamp, uuid.uuid4().hex[:8],
+                                            suffix)
+
+
+def getPartTimestamp(blob_name):
+    '''
+    '''
+    return blob_name.split('/')[-1].split('-')[1]
+
+
+def toTable(columns, rows=None):
+    '''
+    Arrow table of aggregated Insights columns, only the given rows if
+    any, with the string columns dictionary encoded.
+    '''
+    import pyarrow as pa
+
+    arrays = []
+    for name, data_type in EXPORT_COLUMNS:
+        values = columns[name] if rows is None else columns[name][rows]
+        array = pa.array(values.tolist(), type=getattr(pa, data_type)())
+        if name in DICTIONARY_COLUMNS:
+            array = array.dictionary_encode()
+        arrays.append(array)
+
+    return pa.Table.from_arrays(arrays,
+                                names=[name for name, _ in EXPORT_COLUMNS])
+
+
+def writeParquet(table):
+    '''
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink,
+                   compression=os.environ.get('PI_EXPORT_COMPRESSION',
+                                              'snappy'),
+                   use_dictionary=DICTIONARY_COLUMNS)
+
+    return sink.getvalue().to_pybytes()
+
+
+def readParquet(data):
+    '''
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    return pq.read_table(pa.BufferReader(data))
+
+
+@metrics.instrument('exportInsights')
+def exportInsights(columns_list, ingest_date=None):
+    '''
+    Append aggregated Insights columns of one or more videos to the
+    export container, one part file per feature type.
+    '''
+    if getExportFormat() == 'off':
+        return {'files': 0, 'rows': 0, 'bytes': 0}
+    import numpy as np
+
+    try:
+        # Combine the videos so a batch writes one file per feature type
+        columns_list = [columns for columns in columns_list
+                        if len(columns['vi_feature'])]
+        if not columns_list:
+            return {'files': 0, 'rows': 0, 'bytes': 0}
+        columns = {name: np.concatenate([item[name] for item in columns_list])
+                   for name in ['vi_feature_type'] + [
+                       name for name, _ in EXPORT_COLUMNS]}
+
+        now = datetime.datetime.utcnow()
+        ingest_date = ingest_date or now.strftime('%Y-%m-%d')
+        timestamp = now.strftime('%Y%m%dT%H%M%S%f')
+        container_client = clients.getContainerClient(getExportContainer())
+
+        report = {'files': 0, 'rows': 0, 'bytes': 0}
+        feature_types, inverse = np.unique(columns['vi_feature_type'],
+                                           return_inverse=True)
+        for index, feature_type in enumerate(feature_types):
+            rows = np.flatnonzero(inverse == index)
+            data = writeParquet(toTable(columns, rows))
+            container_client.upload_blob(
+                getPartitionPath(feature_type, ingest_date) +
+                getPartName(timestamp),
+                data)
+            report['files'] += 1
+            report['rows'] += len(rows)
+            report['bytes'] += len(data)
+
+        metrics.count('rows', report['rows'])
+        metrics.count('bytes', report['bytes'])
+        logging.info('Success: Exported Insights {0}'.format(report))
+
+        return report
+    except Exception as e:
+        logging.info('Failed: Export Insights {0}'.format(e))
+
+
+def listPartitions(container_client):
+    '''
+    Part file names of each partition directory, oldest first.
+    '''
+    partitions = dict()
+    for blob in container_client.list_blobs(name_starts_with='feature_type='):
+        if blob.name.endswith('.parquet'):
+            path = blob.name[:blob.name.rindex('/') + 1]
+            partitions.setdefault(path, []).append(blob.name)
+
+    return {path: sorted(names, key=getPartTimestamp)
+            for path, names in partitions.items()}
+
+
+def compactPartition(container_client, path, blob_names):
+    '''
+    Rewrite the part files of one partition as a single file, keeping
+    the latest row of each video and feature.
+    '''
+    import pyarrow as pa
+
+    tables = [readParquet(container_client.get_blob_client(name)
+                          .download_blob().readall())
+              for name in blob_names]
+    table = pa.concat_tables(tables)
+
+    # Videos processed again are appended again, keep the newest rows
+    keys = zip(table.column('vi_file_name').to_pylist(),
+               table.column('vi_feature').to_pylist())
+    seen = set()
+    rows = []
+    for row, key in reversed(list(enumerate(keys))):
+        if key not in seen:
+            seen.add(key)
+            rows.append(row)
+    table = table.take(pa.array(rows[::-1], type=pa.int64()))
+
+    # Named after the newest input so parts appended meanwhile stay newer,
+    # inputs are deleted only once the compacted file is written
+    container_client.upload_blob(
+        path + getPartName(getPartTimestamp(blob_names[-1]), '-compacted'),
+        writeParquet(table))
+    for name in blob_names:
+        container_client.get_blob_client(name).delete_blob()
+
+    return table.num_rows
+
+
+def compactExport(min_files=None):
+    '''
+    Compact partitions holding at least min_files part files.
+    '''
+    min_files = min_files or int(os.environ.get('PI_EXPORT_COMPACT_MIN_FILES',
+                                                8))
+    container_client = clients.getContainerClient(getExportContainer())
+
+    report = {'partitions': 0, 'files': 0, 'rows': 0, 'failed': 0}
+    for path, blob_names in sorted(listPartitions(container_client).items()):
+        if len(blob_names) < max(min_files, 2):
+            continue
+        try:
+            report['rows'] += compactPartition(container_client, path,
+                                               blob_names)
+            report['partitions'] += 1
+            report['files'] += len(blob_names)
+        except Exception as e:
+            report['failed'] += 1
+            logging.info('Failed: Compact export partition {0} {1}'.format(
+                path, e))
+
+    logging.info('Success: Compacted Insights export {0}'.format(report))
+
+    return report
+
+
+def loadExport(feature_types=None, since=None):
+    '''
+    Read the export, optionally only some feature types and ingestion
+    dates from since (YYYY-MM-DD), as one table with the partition
+    columns vi_feature_type and vi_ingest_date added.
+    '''
+    import pyarrow as pa
+
+    container_client = clients.getContainerClient(getExportContainer())
+
+    tables = []
+    for path, blob_names in sorted(listPartitions(container_client).items()):
+        feature_type, ingest_date = [part.split('=', 1)[1]
+                                     for part in path.strip('/').split('/')]
+        if feature_types and feature_type not in feature_types:
+            continue
+        if since and ingest_date < since:
+            continue
+        for name in blob_names:
+            table = readParquet(container_client.get_blob_client(name)
+                                .download_blob().readall())
+            table = table.append_column(
+                'vi_feature_type',
+                pa.array([feature_type] * table.num_rows).dictionary_encode())
+            table = table.append_column(
+                'vi_ingest_date',
+                pa.array([ingest_date] * table.num_rows).dictionary_encode())
+            tables.append(table)
+
+    if not tables:
+        return None
+
+    return pa.concat_tables(tables)
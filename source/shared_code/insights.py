@@ -0,0 +1,546 @@
+import os
+import json
+import time
+import logging
+import ijson
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from . import clients, tables, tracker, checkpoint, export, metrics
+from .partitioning import (getInsightsPartitionKey, getIndexPartitionKey,
+                           getIndexRowKey, sanitizeKey, shortenKey)
+
+
+# Queue of single Insights blobs emitted by DownloadInsights
+VIDEO_QUEUE = 'processinsights-videos'
+
+
+def getInsightsPrefix():
+    '''
+    JSON path of the insights subtree within Insights blobs.
+    '''
+    return os.environ.get('PI_INSIGHTS_PREFIX', 'videos.item.insights')
+
+
+def iterInsights(chunks, prefix):
+    '''
+    '''
+    # Incrementally parse the JSON byte chunks, yielding only the objects
+    # found under prefix so the rest of the document is never materialized
+    items = ijson.sendable_list()
+    coro = ijson.items_coro(items, prefix, use_float=True)
+    for chunk in chunks:
+        coro.send(chunk)
+        for item in items:
+            yield item
+        del items[:]
+    coro.close()
+    for item in items:
+        yield item
+
+
+def tapInsights(chunks, prefix, found):
+    '''
+    Pass byte chunks through unchanged while parsing the first object
+    under prefix into found, so Insights being uploaded are also parsed.
+    '''
+    items = ijson.sendable_list()
+    coro = ijson.items_coro(items, prefix, use_float=True)
+    parsing = True
+    for chunk in chunks:
+        if parsing:
+            try:
+                coro.send(chunk)
+                found.extend(items[:1])
+                parsing = not found
+            except Exception as e:
+                logging.info('Failed: Parse Insights {0}'.format(e))
+                parsing = False
+        yield chunk
+    if parsing:
+        try:
+            coro.close()
+            found.extend(items[:1])
+        except Exception as e:
+            logging.info('Failed: Parse Insights {0}'.format(e))
+
+
+# Video Indexer feature types and the item field holding the feature
+FEATURE_FIELDS = [('brands', 'name'),
+                  ('topics', 'name'),
+                  ('keywords', 'text'),
+                  ('labels', 'name'),
+                  ('ocr', 'text'),
+                  ('namedLocations', 'name')]
+
+# Columns of flattened Insights
+COLUMNS = ['vi_file_name', 'vi_source_language', 'vi_feature_type',
+           'vi_feature', 'vi_confidence_score']
+
+# Columns of aggregated Insights, vi_confidence_score holds the max
+AGGREGATE_COLUMNS = COLUMNS + ['vi_mean_confidence_score', 'vi_occurrences',
+                               'vi_duration']
+
+
+def parseTime(value):
+    '''
+    '''
+    # Video Indexer instance times, e.g. '0:01:02.5'
+    try:
+        hours, minutes, seconds = value.split(':')
+
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (ValueError, AttributeError):
+        return 0.0
+
+
+def parseTimes(values):
+    '''
+    '''
+    # Parse all times in one pass, falling back to one at a time when a
+    # time is not in the 'H:MM:SS.fff' form
+    try:
+        parts = np.fromstring(' '.join(values).replace(':', ' '), sep=' ')
+    except ValueError:
+        parts = np.empty(0)
+    if len(parts) != 3 * len(values):
+        return np.array([parseTime(value) for value in values],
+                        dtype=np.float64)
+
+    return parts.reshape(-1, 3).dot([3600.0, 60.0, 1.0])
+
+
+def getInstanceColumns(instances_column):
+    '''
+    '''
+    # Number of appearances per row and their total duration in seconds
+    rows = len(instances_column)
+    counts = np.fromiter((len(instances) for instances in instances_column),
+                         dtype=np.int64, count=rows)
+    starts = [instance.get('start', '') for instances in instances_column
+              for instance in instances]
+    ends = [instance.get('end', '') for instances in instances_column
+            for instance in instances]
+    durations = np.clip(parseTimes(ends) - parseTimes(starts), 0.0, None)
+    durations = np.bincount(np.repeat(np.arange(rows), counts),
+                            weights=durations, minlength=rows)
+
+    return np.maximum(counts, 1), durations
+
+
+def getFeatureColumns(data, feature, feature_type='text'):
+    '''
+    '''
+    try:
+        items = data[feature]
+        features = [item[feature_type] for item in items]
+        if feature == 'labels':
+            # Labels only carry a confidence per instance
+            confidences = np.fromiter(
+                (max(instance['confidence'] for instance in item['instances'])
+                 for item in items), dtype=np.float64, count=len(items))
+        else:
+            confidences = np.fromiter(
+                (item['confidence'] for item in items),
+                dtype=np.float64, count=len(items))
+        instances = [item.get('instances') or [] for item in items]
+
+        return features, confidences, instances
+    except BaseException:
+        return [], np.empty(0, dtype=np.float64), []
+
+
+@metrics.instrument('flattenInsights')
+def flattenInsights(file_name, video_insights):
+    '''
+    Flatten video Insights into column arrays, one entry per feature.
+    '''
+    features = []
+    confidences = []
+    instances = []
+    counts = []
+    for feature, feature_type in FEATURE_FIELDS:
+        feature_values, confidence_values, instance_values = \
+            getFeatureColumns(video_insights, feature, feature_type)
+        features.extend(feature_values)
+        confidences.append(confidence_values)
+        instances.extend(instance_values)
+        counts.append(len(feature_values))
+
+    rows = len(features)
+    feature_column = np.empty(rows, dtype=object)
+    feature_column[:] = features
+
+    # Instances are kept by reference and only summarized for the rows
+    # left after filtering
+    instances_column = np.empty(rows, dtype=object)
+    for i, instance_values in enumerate(instances):
+        instances_column[i] = instance_values
+
+    return {'vi_file_name': np.full(rows, file_name, dtype=object),
+            'vi_source_language': np.full(rows,
+                                          video_insights['sourceLanguage'],
+                                          dtype=object),
+            'vi_feature_type': np.repeat(
+                np.array([feature for feature, _ in FEATURE_FIELDS],
+                         dtype=object), counts),
+            'vi_feature': feature_column,
+            'vi_confidence_score': np.concatenate(confidences),
+            'vi_instances': instances_column}
+
+
+def getConfidenceThresholds():
+    '''
+    '''
+    # Global confidence cutoff and per feature type overrides,
+    # 0.0 <= x <= 1.0, e.g. PI_CONFIDENCE_THRESHOLDS={"ocr": 0.8}
+    confidence_cutoff = float(os.environ.get('PI_CONFIDENCE_CUTOFF', 0.0))
+    try:
+        thresholds = json.loads(
+            os.environ.get('PI_CONFIDENCE_THRESHOLDS') or '{}')
+    except ValueError as e:
+        logging.info('Failed: Parse PI_CONFIDENCE_THRESHOLDS {0}'.format(e))
+        thresholds = dict()
+
+    return confidence_cutoff, thresholds
+
+
+def filterInsights(columns, confidence_cutoff=0.0, thresholds=None):
+    '''
+    '''
+    # Build per row cutoffs and keep rows above them in one masked pass
+    feature_types = columns['vi_feature_type']
+    cutoffs = np.full(len(feature_types), confidence_cutoff, dtype=np.float64)
+    for feature_type, threshold in (thresholds or dict()).items():
+        cutoffs[feature_types == feature_type] = float(threshold)
+    mask = columns['vi_confidence_score'] > cutoffs
+
+    return {column: values[mask] for column, values in columns.items()}
+
+
+def getTopK():
+    '''
+    '''
+    # Max rows kept per feature type and video, 0 keeps all
+    return int(os.environ.get('PI_TOP_K', 0))
+
+
+@metrics.instrument('aggregateInsights')
+def aggregateInsights(columns, top_k=0):
+    '''
+    Collapse repeated features of a video into one row per feature type and
+    feature, keeping the top_k most confident per feature type.
+    '''
+    if not len(columns['vi_feature']):
+        return {column: np.empty(0) for column in AGGREGATE_COLUMNS}
+
+    # Group rows by feature type and feature, the file is one video
+    keys = columns['vi_feature_type'] + '\x00' + columns['vi_feature']
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    groups = len(first)
+
+    confidences = columns['vi_confidence_score']
+    max_confidences = np.full(groups, -np.inf)
+    np.maximum.at(max_confidences, inverse, confidences)
+    mean_confidences = np.bincount(inverse, weights=confidences,
+                                   minlength=groups) / np.bincount(
+                                       inverse, minlength=groups)
+    row_occurrences, row_durations = getInstanceColumns(
+        columns['vi_instances'])
+    occurrences = np.bincount(inverse, weights=row_occurrences,
+                              minlength=groups).astype(np.int64)
+    durations = np.bincount(inverse, weights=row_durations,
+                            minlength=groups)
+
+    # Rank groups within their feature type by max confidence, then
+    # occurrences, and keep the top_k of each type
+    feature_types = columns['vi_feature_type'][first]
+    _, type_codes = np.unique(feature_types, return_inverse=True)
+    order = np.lexsort((-occurrences, -max_confidences, type_codes))
+    if top_k > 0:
+        sorted_codes = type_codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ranks = np.arange(groups) - np.repeat(starts, np.diff(np.r_[starts, groups]))
+        order = order[ranks < top_k]
+    keep = first[order]
+
+    return {'vi_file_name': columns['vi_file_name'][keep],
+            'vi_source_language': columns['vi_source_language'][keep],
+            'vi_feature_type': feature_types[order],
+            'vi_feature': columns['vi_feature'][keep],
+            'vi_confidence_score': max_confidences[order],
+            'vi_mean_confidence_score': mean_confidences[order],
+            'vi_occurrences': occurrences[order],
+            'vi_duration': durations[order]}
+
+
+def putTableBatch(table_service, table_name, tasks):
+    '''
+    '''
+    from azure.cosmosdb.table.tablebatch import TableBatch
+
+    # Commit entities sharing one PartitionKey as an entity-group
+    # transaction, retry the failed batch once, then fall back to single
+    # row writes so one bad row does not drop the whole batch
+    for attempt in range(2):
+        try:
+            batch = TableBatch()
+            for task in tasks:
+                batch.insert_or_merge_entity(task)
+            tables.putWithTable(table_service,
+                                table_name,
+                                lambda: table_service.commit_batch(table_name,
+                                                                   batch))
+
+            return 0
+        except Exception as e:
+            logging.info(
+                'Failed: Commit Azure Storage Table batch, attempt {0} {1}'.format(
+                    attempt + 1, e))
+
+    failed = 0
+    for task in tasks:
+        try:
+            tables.putWithTable(table_service,
+                                table_name,
+                                lambda: table_service.insert_or_merge_entity(
+                                    table_name, task))
+        except Exception as e:
+            failed += 1
+            logging.info(
+                'Failed: Put entity to Azure Storage Table {0}'.format(e))
+
+    return failed
+
+
+def putEntities(table_service, table_name, entities):
+    '''
+    Write entities in entity-group batches per PartitionKey, returning the
+    number of rows and of failed rows.
+    '''
+    # Batch size (max 100 per transaction) and concurrent batches
+    batch_size = min(int(os.environ.get('PI_BATCH_SIZE', 100)), 100)
+    batch_concurrency = int(os.environ.get('PI_BATCH_CONCURRENCY', 4))
+
+    rows = 0
+    failed = 0
+    partitions = dict()
+    futures = set()
+    executor = ThreadPoolExecutor(max_workers=batch_concurrency)
+    try:
+        for entity in entities:
+            # Group rows by PartitionKey, a batch may hold each RowKey only
+            # once so rows colliding after key sanitizing keep the last value
+            tasks = partitions.setdefault(entity['PartitionKey'], dict())
+            if entity['RowKey'] not in tasks:
+                rows += 1
+            tasks[entity['RowKey']] = entity
+            if len(tasks) < batch_size:
+                continue
+
+            # Send full batch, bounding the number of pending batches
+            futures.add(executor.submit(putTableBatch,
+                                        table_service,
+                                        table_name,
+                                        list(tasks.values())))
+            del partitions[entity['PartitionKey']]
+            if len(futures) >= 2 * batch_concurrency:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                failed += sum(future.result() for future in done)
+
+        # Send remaining partial batches
+        for tasks in partitions.values():
+            futures.add(executor.submit(putTableBatch,
+                                        table_service,
+                                        table_name,
+                                        list(tasks.values())))
+        failed += sum(future.result() for future in futures)
+    finally:
+        executor.shutdown(wait=True)
+
+    return rows, failed
+
+
+def iterRows(columns):
+    '''
+    '''
+    return zip(*(columns[column].tolist() for column in AGGREGATE_COLUMNS))
+
+
+@metrics.instrument('putTableEntity',
+                    failed=lambda report: report is None or report['failed'])
+def putTableEntity(columns):
+    '''
+    '''
+    try:
+        # Get Azure Storage Table connection
+        logging.info('Creating Azure Storage Table')
+
+        table_service = clients.getTableService()
+
+        def entities():
+            for file_name, language, feature_type, feature, confidence, \
+                    mean_confidence, occurrences, duration in iterRows(columns):
+                # Create unique row key, long OCR lines and transcripts
+                # shortened
+                row_key = shortenKey(sanitizeKey('{0}_{1}_{2}'.format(
+                    file_name, feature_type, feature)))
+
+                yield {'PartitionKey': getInsightsPartitionKey(
+                           file_name, feature_type),
+                       'RowKey': row_key,
+                       'FileName': file_name,
+                       'SourceLanguage': language,
+                       'FeatureType': feature_type,
+                       'Feature': feature,
+                       'ConfidenceScore': confidence,
+                       'MeanConfidenceScore': mean_confidence,
+                       'Occurrences': occurrences,
+                       'DurationSeconds': round(duration, 3)}
+
+        start_time = time.time()
+        rows, failed = putEntities(table_service,
+                                   os.environ['SA_TABLE_INSIGHTS'],
+                                   entities())
+
+        elapsed = time.time() - start_time
+        metrics.count('rows', rows)
+        metrics.count('failed_rows', failed)
+        report = {'rows': rows,
+                  'failed': failed,
+                  'seconds': round(elapsed, 3),
+                  'rows_per_sec': round(rows / elapsed, 1) if elapsed else 0.0}
+
+        logging.info(
+            'Success: Put entity to Azure Storage Table {0}'.format(report))
+
+        return report
+    except Exception as e:
+        logging.info(
+            'Failed: Put entities to Azure Storage Table {0}'.format(e))
+
+
+@metrics.instrument('putIndexEntity',
+                    failed=lambda report: report is not None and report['failed'])
+def putIndexEntity(columns):
+    '''
+    Add the videos of aggregated Insights to the inverted index table
+    SA_TABLE_INDEX, one partition per feature type holding a row per
+    normalized feature and video, so the rows of a video are written in
+    batches and QueryInsights never scans the Insights table. Returns None
+    when no index table is configured.
+    '''
+    index_table = os.environ.get('SA_TABLE_INDEX')
+    if not index_table:
+        return None
+
+    try:
+        table_service = clients.getTableService()
+
+        # Features differing only in case or whitespace share an index
+        # row, keep the most confident of them
+        entities = dict()
+        for file_name, language, feature_type, feature, confidence, \
+                mean_confidence, occurrences, _ in iterRows(columns):
+            key = (getIndexPartitionKey(feature_type, feature),
+                   getIndexRowKey(feature, file_name))
+            if key in entities and \
+                    entities[key]['MaxConfidence'] >= confidence:
+                continue
+            entities[key] = {'PartitionKey': key[0],
+                             'RowKey': key[1],
+                             'FileName': file_name,
+                             'SourceLanguage': language,
+                             'FeatureType': feature_type,
+                             'Feature': feature,
+                             'MaxConfidence': confidence,
+                             'MeanConfidence': mean_confidence,
+                             'Occurrences': occurrences}
+
+        rows, failed = putEntities(table_service, index_table,
+                                   entities.values())
+        metrics.count('rows', rows)
+        metrics.count('failed_rows', failed)
+        report = {'rows': rows, 'failed': failed}
+
+        logging.info('Success: Put index entities {0}'.format(report))
+
+        return report
+    except Exception as e:
+        logging.info('Failed: Put index entities {0}'.format(e))
+
+        return {'rows': 0, 'failed': len(columns['vi_feature'])}
+
+
+def processVideoInsights(file_name, video_insights, exports=None):
+    '''
+    Flatten, filter and aggregate the Insights of one video and write them
+    to the Insights table and the columnar export, returning the
+    putTableEntity report. Callers batching the export pass a list the
+    aggregated columns are appended to instead.
+    '''
+    # Transform JSON data into columns and apply confidence cutoffs
+    confidence_cutoff, thresholds = getConfidenceThresholds()
+    columns = flattenInsights(file_name, video_insights)
+    columns = filterInsights(columns, confidence_cutoff, thresholds)
+
+    # Collapse repeated features into one row each
+    features_count = len(columns['vi_feature'])
+    columns = aggregateInsights(columns, getTopK())
+    logging.info('Aggregated {0} features of {1} into {2} rows'.format(
+        features_count, file_name, len(columns['vi_feature'])))
+
+    # Write features to Azure Storage Insights Table and the inverted
+    # index, failed index rows fail the video so it is processed again
+    report = putTableEntity(columns)
+    index_report = putIndexEntity(columns)
+    if report is not None and index_report is not None:
+        report['failed'] += index_report['failed']
+
+    # Append features to the partitioned Parquet export
+    if exports is not None:
+        exports.append(columns)
+    else:
+        export.exportInsights([columns])
+
+    return report
+
+
+def markProcessed(blob_container, blob_name, blob_etag=None):
+    '''
+    Record an Insights blob in the checkpoint so ProcessInsights skips it.
+    '''
+    try:
+        if blob_etag is None:
+            blob_client = clients.getBlobServiceClient().get_blob_client(
+                container=blob_container, blob=blob_name)
+            blob_etag = blob_client.get_blob_properties().etag
+        checkpoint.saveCheckpoint(blob_container, {blob_name: blob_etag})
+    except Exception as e:
+        logging.info('Failed: Checkpoint Insights blob {0} {1}'.format(
+            blob_name, e))
+
+
+def processInsightsBlob(blob_container, blob_name):
+    '''
+    Process a single Insights blob, checkpoint it and record its job
+    Processed, returning the putTableEntity report.
+    '''
+    blob_client = clients.getBlobServiceClient().get_blob_client(
+        container=blob_container, blob=blob_name)
+    blob_etag = blob_client.get_blob_properties().etag
+    download_stream = blob_client.download_blob()
+    video_insights = next(iterInsights(download_stream.chunks(),
+                                       getInsightsPrefix()), None)
+    if video_insights is None:
+        logging.info('Failed: No insights found in blob {0}'.format(blob_name))
+        return None
+
+    report = processVideoInsights(blob_name.split('/')[-1], video_insights)
+    if report is not None and not report['failed']:
+        markProcessed(blob_container, blob_name, blob_etag)
+        blob_metadata = download_stream.properties.metadata or dict()
+        tracker.completeJob(blob_metadata.get(tracker.PARTITION_METADATA),
+                            blob_metadata.get(tracker.JOB_METADATA))
+
+    return report
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import logging
+import datetime
+import functools
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+
+# Correlation id, extra fields and open timers of the current thread
+_context = threading.local()
+
+# Aggregates written by the prometheus exporter, {(stage, status): {...}}
+_totals = dict()
+_export_lock = threading.Lock()
+
+# Upper bounds (seconds) of the prometheus duration histogram buckets
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Counters a timed stage may add to
+COUNTERS = ['bytes', 'retries', 'rows', 'failed_rows']
+
+# Blob metadata key carrying the correlation id of a video to later stages
+CORRELATION_METADATA = 'correlation_id'
+
+
+def getExporter():
+    '''
+    Metrics exporter, 'log' lines picked up by Application Insights,
+    'jsonl:<path>', 'prometheus:<path>' or 'off'.
+    '''
+    return os.environ.get('METRICS_EXPORT', 'log')
+
+
+def getCorrelationId():
+    '''
+    '''
+    return getattr(_context, 'correlation_id', None)
+
+
+def getTimers():
+    '''
+    '''
+    if not hasattr(_context, 'timers'):
+        _context.timers = []
+
+    return _context.timers
+
+
+def setCorrelation(correlation_id, **fields):
+    '''
+    Tag the following metrics of this thread, set at the start of each
+    invocation so nothing leaks from the previous one.
+    '''
+    _context.correlation_id = correlation_id
+    _context.fields = fields
+
+
+@contextmanager
+def correlation(correlation_id, **fields):
+    '''
+    Tag the metrics of the enclosed block, on this thread, with the
+    correlation id of a video and extra fields such as its blob path.
+    '''
+    previous = (getCorrelationId(), getattr(_context, 'fields', dict()))
+    _context.correlation_id = correlation_id
+    _context.fields = dict(previous[1], **fields)
+    try:
+        yield
+    finally:
+        _context.correlation_id, _context.fields = previous
+
+
+def getCorrelationMetadata():
+    '''
+    Blob metadata with the correlation id of this thread, quoted as
+    metadata values are ASCII.
+    '''
+    correlation_id = getCorrelationId()
+    if correlation_id is None:
+        return dict()
+
+    return {CORRELATION_METADATA: quote(correlation_id, safe='/')}
+
+
+def getMetadataCorrelation(metadata, default=None):
+    '''
+    '''
+    correlation_id = (metadata or dict()).get(CORRELATION_METADATA)
+
+    return unquote(correlation_id) if correlation_id else default
+
+
+def bindCorrelation(function):
+    '''
+    Wrap function to run with the correlation of the calling thread, for
+    work submitted to thread pools.
+    '''
+    correlation_id = getCorrelationId()
+    fields = dict(getattr(_context, 'fields', dict()))
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with correlation(correlation_id, **fields):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def count(name, value=1):
+    '''
+    Add to a counter of the innermost timed stage of this thread.
+    '''
+    timers = getTimers()
+    if timers:
+        timers[-1][name] = timers[-1].get(name, 0) + value
+
+
+def countBytes(chunks):
+    '''
+    Pass byte chunks through while counting them on the current stage.
+    '''
+    timers = getTimers()
+    metric = timers[-1] if timers else dict()
+    for chunk in chunks:
+        metric['bytes'] = metric.get('bytes', 0) + len(chunk)
+        yield chunk
+
+
+@contextmanager
+def timer(stage):
+    '''
+    Time the enclosed block as stage, yielding the metric so the block can
+    add counters or set its status.
+    '''
+    metric = {'stage': stage, 'status': 'ok'}
+    timers = getTimers()
+    timers.append(metric)
+    start_time = time.perf_counter()
+    try:
+        yield metric
+    except Exception:
+        metric['status'] = 'error'
+        raise
+    finally:
+        metric['duration_ms'] = round(
+            (time.perf_counter() - start_time) * 1000, 3)
+        timers.pop()
+        emit(metric)
+
+
+def instrument(stage, failed=lambda result: result is None):
+    '''
+    Decorator timing each call of a function as stage, calls returning a
+    failed result, None for the helpers that log and swallow errors, are
+    recorded with status 'failed'.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage) as metric:
+                result = function(*args, **kwargs)
+                if failed(result):
+                    metric['status'] = 'failed'
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def emit(metric):
+    '''
+    '''
+    exporter = getExporter()
+    if exporter == 'off':
+        return
+
+    record = dict(getattr(_context, 'fields', dict()),
+                  ts=datetime.datetime.utcnow().isoformat() + 'Z',
+                  correlation_id=getCorrelationId(),
+                  **metric)
+    try:
+        if exporter.startswith('jsonl:'):
+            line = json.dumps(record, default=str) + '\n'
+            with _export_lock:
+                with open(exporter[len('jsonl:'):], 'a') as f:
+                    f.write(line)
+        elif exporter.startswith('prometheus:'):
+            putPrometheus(exporter[len('prometheus:'):], record)
+        else:
+            logging.info('Metric: {0}'.format(json.dumps(record, default=str)))
+    except Exception as e:
+        logging.info('Failed: Export metric {0}'.format(e))
+
+
+def putPrometheus(path, record):
+    '''
+    '''
+    # Aggregate per stage and status and rewrite the text exposition file,
+    # for a local node exporter textfile collector or scraping by hand
+    seconds = record['duration_ms'] / 1000.0
+    with _export_lock:
+        totals = _totals.setdefault((record['stage'], record['status']), {
+            'count': 0, 'sum': 0.0, 'buckets': [0] * len(DURATION_BUCKETS),
+            'counters': dict()})
+        totals['count'] += 1
+        totals['sum'] += seconds
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                totals['buckets'][i] += 1
+        for name in COUNTERS:
+            if name in record:
+                totals['counters'][name] = totals['counters'].get(
+                    name, 0) + record[name]
+
+        lines = ['# TYPE video_pipeline_stage_seconds histogram']
+        for (stage, status), totals in sorted(_totals.items()):
+            labels = 'stage="{0}",status="{1}"'.format(stage, status)
+            for bound, value in zip(DURATION_BUCKETS, totals['buckets']):
+                lines.append('video_pipeline_stage_seconds_bucket{{{0},le="{1}"}} {2}'.format(
+                    labels, bound, value))
+            lines.append('video_pipeline_stage_seconds_bucket{{{0},le="+Inf"}} {1}'.format(
+                labels, totals['count']))
+            lines.append('video_pipeline_stage_seconds_sum{{{0}}} {1}'.format(
+                labels, totals['sum']))
+            lines.append('video_pipeline_stage_seconds_count{{{0}}} {1}'.format(
+                labels, totals['count']))
+        for name in COUNTERS:
+            lines.append('# TYPE video_pipeline_stage_{0}_total counter'.format(name))
+            for (stage, status), totals in sorted(_totals.items()):
+                if name in totals['counters']:
+                    lines.append('video_pipeline_stage_{0}_total{{stage="{1}",status="{2}"}} {3}'.format(
+                        name, stage, status, totals['counters'][name]))
+
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+def percentile(values, p):
+    '''
+    '''
+    # Nearest-rank percentile
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(1, int(round(p / 100.0 * len(values) + 0.5)))
+
+    return values[min(rank, len(values)) - 1]
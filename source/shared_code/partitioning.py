@@ -0,0 +1,158 @@
+import os
+import re
+import zlib
+import hashlib
+import datetime
+
+
+# Characters not allowed in PartitionKey and RowKey values
+DISALLOWED_KEY_CHARS = re.compile(r'[/\\#?\x00-\x1f\x7f-\x9f]')
+
+# PartitionKey of rows written before a partitioning strategy existed
+LEGACY_PARTITION_KEY = 'examplekey'
+
+# Characters of the normalized feature in inverted index RowKeys, longer
+# features are shortened
+INDEX_FEATURE_KEY_LENGTH = 128
+
+
+def sanitizeKey(value):
+    '''
+    Replace characters not allowed in Azure Storage Table keys.
+    '''
+    return DISALLOWED_KEY_CHARS.sub('_', str(value))
+
+
+def shortenKey(key, max_length=255):
+    '''
+    Key longer than max_length characters cut short and suffixed with a
+    hash of the whole key, so keys stay unique and within the 1 KiB key
+    limit.
+    '''
+    if len(key) <= max_length:
+        return key
+
+    return '{0}~{1}'.format(key[:max_length - 17], hashlib.sha1(
+        key.encode('utf-8')).hexdigest()[:16])
+
+
+def hashBucket(value, buckets):
+    '''
+    Stable hash bucket of a value, zero padded so buckets sort in order.
+    '''
+    return '{0:03d}'.format(zlib.crc32(str(value).encode('utf-8')) % buckets)
+
+
+def getTrackerPartitionKey(video_id, video_path, created=None):
+    '''
+    PartitionKey of a tracker table entity of a video submitted before
+    jobs existed, by SA_TRACKER_PARTITION: 'hash' (default) bucket of the
+    video id, 'container' of the video blob, upload 'date' or 'static'
+    single legacy partition.
+    '''
+    strategy = os.environ.get('SA_TRACKER_PARTITION', 'hash')
+
+    if strategy == 'hash':
+        buckets = int(os.environ.get('SA_TRACKER_PARTITION_BUCKETS', 16))
+        return hashBucket(video_id, buckets)
+    if strategy == 'container':
+        return sanitizeKey(video_path.split('/')[0])
+    if strategy == 'date':
+        created = created or datetime.datetime.utcnow()
+        return created.strftime('%Y%m%d')
+
+    return LEGACY_PARTITION_KEY
+
+
+def getTrackerLookupKey(video_id):
+    '''
+    PartitionKey of a tracker table entity when it can be derived from the
+    video id alone, otherwise None.
+    '''
+    strategy = os.environ.get('SA_TRACKER_PARTITION', 'hash')
+
+    if strategy in ('container', 'date'):
+        return None
+
+    return getTrackerPartitionKey(video_id, None)
+
+
+def getJobPartitionKey(job_key):
+    '''
+    PartitionKey of a tracker job, a hash bucket of the job key whatever
+    SA_TRACKER_PARTITION, so every trigger of the same content finds the
+    same job.
+    '''
+    buckets = int(os.environ.get('SA_TRACKER_PARTITION_BUCKETS', 16))
+
+    return hashBucket(job_key, buckets)
+
+
+def getInsightsPartitionKey(file_name, feature_type):
+    '''
+    PartitionKey of an insights table entity, by SA_INSIGHTS_PARTITION:
+    'video' (default), 'feature' type, 'video_feature' or 'static'.
+    '''
+    strategy = os.environ.get('SA_INSIGHTS_PARTITION', 'video')
+
+    if strategy == 'video':
+        return shortenKey(sanitizeKey(file_name))
+    if strategy == 'feature':
+        return sanitizeKey(feature_type)
+    if strategy == 'video_feature':
+        return shortenKey(sanitizeKey('{0}_{1}'.format(file_name,
+                                                       feature_type)))
+
+    return LEGACY_PARTITION_KEY
+
+
+def normalizeFeature(feature):
+    '''
+    Case and whitespace insensitive form of a feature for index lookups.
+    '''
+    return ' '.join(str(feature).casefold().split())
+
+
+def getIndexFeatureKey(feature):
+    '''
+    Normalized feature as stored in inverted index RowKeys.
+    '''
+    return shortenKey(sanitizeKey(normalizeFeature(feature)),
+                      INDEX_FEATURE_KEY_LENGTH)
+
+
+def getIndexPartitionKeys(feature_type):
+    '''
+    PartitionKeys of the inverted index entities of a feature type, split
+    in SA_INDEX_PARTITION_BUCKETS (default: 1) hash buckets.
+    '''
+    buckets = int(os.environ.get('SA_INDEX_PARTITION_BUCKETS', 1))
+    if buckets <= 1:
+        return [sanitizeKey(feature_type)]
+
+    return ['{0}_{1:03d}'.format(sanitizeKey(feature_type), bucket)
+            for bucket in range(buckets)]
+
+
+def getIndexPartitionKey(feature_type, feature):
+    '''
+    PartitionKey of an inverted index entity, the feature type, or its
+    hash bucket of the normalized feature, so the rows of a video batch
+    per feature type.
+    '''
+    buckets = int(os.environ.get('SA_INDEX_PARTITION_BUCKETS', 1))
+    if buckets <= 1:
+        return sanitizeKey(feature_type)
+
+    return '{0}_{1}'.format(sanitizeKey(feature_type),
+                            hashBucket(getIndexFeatureKey(feature), buckets))
+
+
+def getIndexRowKey(feature, file_name):
+    '''
+    RowKey of an inverted index entity, the normalized feature and the
+    video, so the videos of a feature are a RowKey range of its partition.
+    '''
+    return '{0}|{1}'.format(getIndexFeatureKey(feature),
+                            shortenKey(sanitizeKey(file_name),
+                                       254 - INDEX_FEATURE_KEY_LENGTH))
@@ -0,0 +1,166 @@
+import time
+import logging
+from . import clients, tables, tracker, checkpoint, sharding, export, metrics
+
+
+def getInsightsBlobs(blob_container='content', checkpoint=None, shard=None):
+    '''
+    Stream the new or changed Insights blobs of a container, or the blobs
+    of a shard listed by the fan-out coordinator.
+    '''
+    from .insights import iterInsights, getInsightsPrefix
+
+    # Stream all new or changed Insights blobs, one video at a time
+    logging.info('Streaming Azure Storage Insights blobs')
+    checkpoint = checkpoint or dict()
+    skipped = 0
+
+    # JSON path of the insights subtree within each Insights blob
+    insights_prefix = getInsightsPrefix()
+
+    try:
+        # Connect to Blob Client to get list of blobs with 'Insights' in name
+        blob_service_client = clients.getBlobServiceClient()
+        container_client = blob_service_client.get_container_client(
+            blob_container)
+
+        # Get list of Insights blobs, a shard's blobs were listed and
+        # checked against the checkpoint once by the coordinator
+        if shard is not None:
+            insight_blobs = sorted(sharding.loadShardBlobs(shard).items())
+        else:
+            insight_blobs = ((blob.name, blob.etag)
+                             for blob in container_client.list_blobs()
+                             if 'Insights' in blob.name)
+    except Exception as e:
+        logging.info('Failed: List Azure Storage blobs {0}'.format(e))
+        return
+
+    for blob_name, blob_etag in insight_blobs:
+        # Skip blobs unchanged since they were last processed
+        if checkpoint.get(blob_name) == blob_etag:
+            skipped += 1
+            continue
+
+        try:
+            # Stream download blob and parse only the first video insights,
+            # checkpointed with the ETag of the content downloaded
+            blob_client = container_client.get_blob_client(blob_name)
+            download_stream = blob_client.download_blob()
+            video_insights = next(iterInsights(download_stream.chunks(),
+                                               insights_prefix), None)
+            if video_insights is None:
+                logging.info(
+                    'Failed: No insights found in blob {0}'.format(blob_name))
+                continue
+
+            yield (blob_name, download_stream.properties.etag, video_insights,
+                   download_stream.properties.metadata or dict())
+        except Exception as e:
+            logging.info('Failed: Stream Azure Storage blob {0} {1}'.format(
+                blob_name, e))
+
+    logging.info('Success: Azure Storage Insights blobs streamed, {0} unchanged skipped'.format(
+        skipped))
+
+
+def processBlobs(blob_container='content', full=False, shard=None):
+    '''
+    Process new or changed Insights blobs, of one shard if given, into the
+    Insights table and return counts.
+    '''
+    # Imported when used, the fanout and status modes never parse Insights
+    from .insights import processVideoInsights
+
+    # Get processed blobs checkpoint to only process new or changed blobs,
+    # shards only hold such blobs
+    if full and shard is None:
+        checkpoint.clearCheckpoint(blob_container)
+    if full or shard is not None:
+        processed_checkpoint = dict()
+    else:
+        processed_checkpoint = checkpoint.loadCheckpoint(blob_container)
+
+    # Stream Azure Storage Insights blobs, one video at a time
+    processed_blobs = dict()
+    exports = []
+    processed_count = 0
+    rows_count = 0
+    failed_count = 0
+    failed_blobs = 0
+    start_time = time.time()
+    try:
+        for blob_name, blob_etag, video_insights, blob_metadata in getInsightsBlobs(
+                blob_container, processed_checkpoint, shard):
+            # Write the features of the video to Azure Storage Insights
+            # Table, tagged with the correlation id of the video, or the
+            # blob name for blobs stored before it was recorded. A malformed
+            # blob is left out of the checkpoint and the run goes on
+            try:
+                with metrics.correlation(
+                        metrics.getMetadataCorrelation(blob_metadata,
+                                                       blob_name)):
+                    report = processVideoInsights(blob_name.split('/')[-1],
+                                                  video_insights, exports)
+            except Exception as e:
+                logging.info('Failed: Process Insights blob {0} {1}'.format(
+                    blob_name, e))
+                failed_blobs += 1
+                continue
+            if report is None:
+                continue
+            rows_count += report['rows']
+            failed_count += report['failed']
+            if not report['failed']:
+                processed_blobs[blob_name] = blob_etag
+                processed_count += 1
+
+                # Record the job of the video Processed
+                tracker.completeJob(
+                    blob_metadata.get(tracker.PARTITION_METADATA),
+                    blob_metadata.get(tracker.JOB_METADATA))
+
+            # Periodically export the batch and record processed blobs in
+            # checkpoint
+            if len(exports) >= 50:
+                export.exportInsights(exports)
+                exports = []
+            if len(processed_blobs) >= 50:
+                checkpoint.saveCheckpoint(blob_container, processed_blobs)
+                processed_blobs = dict()
+    finally:
+        export.exportInsights(exports)
+        checkpoint.saveCheckpoint(blob_container, processed_blobs)
+
+    elapsed = time.time() - start_time
+    logging.info('Completed. Rows: {0} Failed rows: {1} Rows/sec: {2:.1f} Table round trips saved: {3}'.format(
+        rows_count, failed_count, rows_count / elapsed if elapsed else 0.0,
+        tables.getSavedRoundTrips()))
+
+    return {'Processed': processed_count,
+            'Rows': rows_count,
+            'FailedRows': failed_count,
+            'FailedBlobs': failed_blobs,
+            'Seconds': round(elapsed, 3)}
+
+
+def listChangedBlobs(blob_container='content', full=False):
+    '''
+    {blob name: ETag} of the Insights blobs new or changed since they were
+    last processed, every Insights blob when full.
+    '''
+    # Listed once and checked against the checkpoint once, shard workers
+    # neither list the container nor load the checkpoint
+    if full:
+        checkpoint.clearCheckpoint(blob_container)
+        processed_checkpoint = dict()
+    else:
+        processed_checkpoint = checkpoint.loadCheckpoint(blob_container)
+
+    blob_service_client = clients.getBlobServiceClient()
+    container_client = blob_service_client.get_container_client(
+        blob_container)
+
+    return {blob.name: blob.etag for blob in container_client.list_blobs()
+            if 'Insights' in blob.name and
+            processed_checkpoint.get(blob.name) != blob.etag}
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import uuid
+import logging
+from . import clients, tables
+from .partitioning import hashBucket
+
+
+# Queue the ProcessInsightsShard workers are triggered by
+SHARD_QUEUE = 'processinsights-shards'
+
+
+def getShardContainer():
+    '''
+    Blob container of the blob lists of shards, queue messages are too
+    small to hold them.
+    '''
+    return os.environ.get('PI_SHARD_CONTAINER', 'insights-shards')
+
+
+def getShardStrategy():
+    '''
+    Shard Insights blobs by 'hash' (default) of the blob name or by name
+    'prefix' of PI_SHARD_PREFIX_LENGTH characters.
+    '''
+    return os.environ.get('PI_SHARD_BY', 'hash')
+
+
+def getShardKey(blob_name, strategy, shard_count=None, prefix_length=None):
+    '''
+    '''
+    if strategy == 'prefix':
+        return blob_name[:prefix_length]
+
+    return hashBucket(blob_name, shard_count)
+
+
+def planShards(blobs, run_id=None, blob_container='content', full=False):
+    '''
+    Group Insights blobs to process, {blob name: ETag}, into shards, empty
+    shards are skipped. Each shard holds its blobs until saveShards writes
+    them to its blob list.
+    '''
+    run_id = run_id or '{0}-{1}'.format(time.strftime('%Y%m%d%H%M%S'),
+                                         uuid.uuid4().hex[:8])
+    strategy = getShardStrategy()
+    shard_count = int(os.environ.get('PI_SHARD_COUNT', 16))
+    prefix_length = int(os.environ.get('PI_SHARD_PREFIX_LENGTH', 1))
+
+    shard_blobs = dict()
+    for blob_name, blob_etag in blobs.items():
+        shard_key = getShardKey(blob_name, strategy, shard_count,
+                                prefix_length)
+        shard_blobs.setdefault(shard_key, dict())[blob_name] = blob_etag
+
+    return [{'run': run_id,
+             'shard': index,
+             'by': strategy,
+             'key': shard_key,
+             'count': shard_count,
+             'container': blob_container,
+             'full': full,
+             'blobs': len(shard_blobs[shard_key]),
+             'list': '{0}/{1:05d}.json'.format(run_id, index),
+             'blob_etags': shard_blobs[shard_key]}
+            for index, shard_key in enumerate(sorted(shard_blobs))]
+
+
+def getShardMessage(shard):
+    '''
+    '''
+    return {name: value for name, value in shard.items()
+            if name != 'blob_etags'}
+
+
+def saveShards(shards):
+    '''
+    Write the blob list of each shard and record it as Queued.
+    '''
+    container_client = clients.getContainerClient(getShardContainer())
+    for shard in shards:
+        container_client.upload_blob(shard['list'],
+                                     json.dumps(shard['blob_etags']),
+                                     overwrite=True)
+        putShardStatus(shard, 'Queued')
+
+
+def loadShardBlobs(shard):
+    '''
+    {blob name: ETag} of the Insights blobs of a shard message.
+    '''
+    container_client = clients.getContainerClient(getShardContainer())
+
+    return json.loads(container_client.get_blob_client(shard['list'])
+                      .download_blob().readall())
+
+
+def deleteShardBlobs(shard):
+    '''
+    '''
+    try:
+        container_client = clients.getContainerClient(getShardContainer())
+        container_client.get_blob_client(shard['list']).delete_blob()
+    except Exception as e:
+        logging.info('Failed: Delete blob list of shard {0} {1}'.format(
+            shard['shard'], e))
+
+
+def dispatchShards(shards):
+    '''
+    Save shards and send one queue message per shard.
+    '''
+    saveShards(shards)
+    queue_client = clients.getQueueClient(SHARD_QUEUE)
+    for shard in shards:
+        queue_client.send_message(json.dumps(getShardMessage(shard)))
+
+    logging.info('Success: Dispatched {0} shards of run {1}'.format(
+        len(shards), shards[0]['run'] if shards else None))
+
+
+def putShardStatus(shard, state, report=None):
+    '''
+    '''
+    # One entity per shard, partitioned by run so a run's status is a
+    # single partition query
+    entity = {'PartitionKey': shard['run'],
+              'RowKey': '{0:05d}'.format(shard['shard']),
+              'ShardKey': shard['key'],
+              'Blobs': shard['blobs'],
+              'State': state}
+    for name, value in (report or dict()).items():
+        entity[name] = value
+
+    try:
+        table_service = clients.getTableService()
+        tables.putWithTable(table_service,
+                            os.environ['SA_TABLE_SHARDS'],
+                            lambda: table_service.insert_or_merge_entity(
+                                os.environ['SA_TABLE_SHARDS'], entity))
+    except Exception as e:
+        logging.info('Failed: Put shard status {0} {1}'.format(
+            entity['RowKey'], e))
+
+
+def getRunStatus(run_id):
+    '''
+    Aggregate status of the shards of a run.
+    '''
+    table_service = clients.getTableService()
+    entities = table_service.query_entities(
+        os.environ['SA_TABLE_SHARDS'],
+        filter="PartitionKey eq '{0}'".format(run_id))
+
+    status = {'run': run_id,
+              'shards': 0,
+              'states': dict(),
+              'blobs': 0,
+              'processed': 0,
+              'rows': 0,
+              'failed_rows': 0,
+              'failed_blobs': 0}
+    for entity in entities:
+        status['shards'] += 1
+        state = entity.get('State')
+        status['states'][state] = status['states'].get(state, 0) + 1
+        status['blobs'] += entity.get('Blobs') or 0
+        status['processed'] += entity.get('Processed') or 0
+        status['rows'] += entity.get('Rows') or 0
+        status['failed_rows'] += entity.get('FailedRows') or 0
+        status['failed_blobs'] += entity.get('FailedBlobs') or 0
+
+    status['done'] = status['shards'] > 0 and \
+        status['states'].get('Completed', 0) + \
+        status['states'].get('Failed', 0) == status['shards']
+
+    return status
@@ -0,0 +1,69 @@
+import logging
+import threading
+
+
+# Tables known to exist, checked or created once per worker
+_known_tables = set()
+_known_tables_lock = threading.Lock()
+_saved_round_trips = 0
+
+
+def getSavedRoundTrips():
+    '''
+    Number of create table round trips skipped for known tables.
+    '''
+    return _saved_round_trips
+
+
+def ensureTable(table_service, table_name):
+    '''
+    Create a table unless this worker already knows it exists.
+    '''
+    global _saved_round_trips
+
+    with _known_tables_lock:
+        if table_name in _known_tables:
+            _saved_round_trips += 1
+            return
+
+        logging.info('Checking for existing Azure Storage Table')
+
+        # Check for table, if none then create new table
+        if table_service.create_table(table_name, fail_on_exist=False):
+            logging.info('Success: New table created')
+
+        _known_tables.add(table_name)
+
+
+def invalidateTable(table_name):
+    '''
+    '''
+    with _known_tables_lock:
+        _known_tables.discard(table_name)
+
+
+def isTableNotFound(error):
+    '''
+    '''
+    return getattr(error, 'status_code', None) == 404 and \
+        'TableNotFound' in str(error)
+
+
+def putWithTable(table_service, table_name, write):
+    '''
+    Run a table write, creating the table again and retrying once if it
+    was deleted since it was last checked.
+    '''
+    ensureTable(table_service, table_name)
+    try:
+        return write()
+    except Exception as e:
+        if not isTableNotFound(e):
+            raise
+
+        logging.info('Failed: Table {0} not found, creating it'.format(
+            table_name))
+        invalidateTable(table_name)
+        ensureTable(table_service, table_name)
+
+        return write()
@@ -0,0 +1,294 @@
+import os
+import hashlib
+import logging
+import datetime
+from azure.common import AzureConflictHttpError, AzureHttpError
+from azure.common import AzureMissingResourceHttpError
+from . import clients, tables
+from .partitioning import sanitizeKey, getTrackerLookupKey
+
+
+# Video job states, in order, and the states each may move to, a fast
+# indexing callback may overtake the Submitted update
+QUEUED = 'Queued'
+SUBMITTED = 'Submitted'
+INDEXED = 'Indexed'
+DOWNLOADED = 'Downloaded'
+PROCESSED = 'Processed'
+FAILED = 'Failed'
+
+TRANSITIONS = {QUEUED: (SUBMITTED, INDEXED, FAILED),
+               SUBMITTED: (INDEXED, FAILED),
+               INDEXED: (DOWNLOADED, FAILED),
+               DOWNLOADED: (PROCESSED, FAILED),
+               PROCESSED: (),
+               FAILED: (QUEUED,)}
+
+# Metadata of an Insights blob naming the job it was downloaded for, so
+# whichever function processes the blob can record the job Processed
+JOB_METADATA = 'tracker_job'
+PARTITION_METADATA = 'tracker_pk'
+
+
+def getJobKey(blob_path, blob_properties):
+    '''
+    Job RowKey of a video blob, its content MD5 when the blob has one so
+    identical files are only indexed once, otherwise its path and ETag.
+    '''
+    content_settings = blob_properties.get('content_settings') or dict()
+    content_md5 = content_settings.get('content_md5')
+    if content_md5:
+        return 'md5-{0}'.format(bytes(content_md5).hex())
+
+    return 'etag-{0}'.format(hashlib.sha1('{0}|{1}'.format(
+        blob_path, blob_properties['etag']).encode('utf-8')).hexdigest())
+
+
+def getStaleSeconds():
+    '''
+    '''
+    # Seconds after which a Queued or Indexed job is assumed abandoned
+    return int(os.environ.get('SA_TRACKER_STALE_SECONDS', 3600))
+
+
+def isStale(job):
+    '''
+    '''
+    changed = job.get('StateChanged')
+    if changed is None:
+        return True
+    if changed.tzinfo is not None:
+        changed = changed.replace(tzinfo=None) - changed.utcoffset()
+
+    age = datetime.datetime.utcnow() - changed
+
+    return age.total_seconds() > getStaleSeconds()
+
+
+def getJob(partition_key, job_key):
+    '''
+    Tracker entity of a job, with its ETag, or None.
+    '''
+    try:
+        table_service = clients.getTableService()
+
+        return table_service.get_entity(os.environ['SA_TABLE_TRACKER'],
+                                        partition_key,
+                                        job_key)
+    except AzureMissingResourceHttpError:
+        return None
+
+
+def claimJob(partition_key, job_key, properties):
+    '''
+    Create a Queued job, or take over a Failed or stale one. Returns the
+    job and whether this invocation owns it, duplicates get False.
+    '''
+    table_service = clients.getTableService()
+    job = dict(properties,
+               PartitionKey=partition_key,
+               RowKey=job_key,
+               State=QUEUED,
+               StateChanged=datetime.datetime.utcnow())
+
+    try:
+        etag = tables.putWithTable(table_service,
+                                   os.environ['SA_TABLE_TRACKER'],
+                                   lambda: table_service.insert_entity(
+                                       os.environ['SA_TABLE_TRACKER'], job))
+
+        return dict(job, etag=etag), True
+    except AzureConflictHttpError:
+        pass
+
+    # Job exists, only a Failed or abandoned job is submitted again
+    existing = getJob(partition_key, job_key)
+    if existing is None:
+        return claimJob(partition_key, job_key, properties)
+    if existing['State'] != FAILED and not (
+            existing['State'] == QUEUED and isStale(existing)):
+        return existing, False
+
+    claimed = transitionJob(existing, QUEUED, properties, force=True)
+    if claimed is None:
+        return getJob(partition_key, job_key) or existing, False
+
+    return claimed, True
+
+
+def transitionJob(job, state, properties=None, force=False):
+    '''
+    Move a job to state if allowed, conditional on its ETag so concurrent
+    duplicates cannot both win. Returns the updated job, or None when the
+    transition is not allowed or the job changed since it was read.
+    '''
+    if not force and state not in TRANSITIONS.get(job.get('State'), ()):
+        logging.info('Skipped: Job {0} is {1}, not moving to {2}'.format(
+            job['RowKey'], job.get('State'), state))
+        return None
+
+    update = dict(properties or dict(),
+                  PartitionKey=job['PartitionKey'],
+                  RowKey=job['RowKey'],
+                  State=state,
+                  StateChanged=datetime.datetime.utcnow())
+
+    try:
+        table_service = clients.getTableService()
+        etag = table_service.merge_entity(os.environ['SA_TABLE_TRACKER'],
+                                          update,
+                                          if_match=job['etag'])
+    except AzureHttpError as e:
+        if getattr(e, 'status_code', None) not in (404, 412):
+            raise
+        logging.info('Skipped: Job {0} changed before moving to {1}'.format(
+            job['RowKey'], state))
+        return None
+
+    logging.info('Success: Job {0} {1} -> {2}'.format(
+        job['RowKey'], job.get('State'), state))
+
+    return dict(job, etag=etag, **update)
+
+
+def claimIndexed(job, video_id):
+    '''
+    Take over a Submitted job, or a stale Indexed one, to download its
+    artifacts. Returns the updated job or None for duplicate callbacks.
+    '''
+    properties = {'VideoIndexerId': video_id}
+    if job.get('State') == INDEXED and isStale(job):
+        claimed = transitionJob(job, INDEXED, properties, force=True)
+    else:
+        claimed = transitionJob(job, INDEXED, properties)
+
+    # The callback may overtake PutVideo recording the Video Indexer id
+    if claimed is not None:
+        putVideoId(claimed, video_id)
+
+    return claimed
+
+
+def failJob(job, error):
+    '''
+    '''
+    try:
+        return transitionJob(job, FAILED, {'Error': str(error)[:1024]})
+    except Exception as e:
+        logging.info('Failed: Mark job {0} failed {1}'.format(
+            job['RowKey'], e))
+
+
+def getJobMetadata(job):
+    '''
+    '''
+    return {JOB_METADATA: job['RowKey'],
+            PARTITION_METADATA: job['PartitionKey']}
+
+
+def completeJob(partition_key, job_key):
+    '''
+    Record a job Processed once the Insights of its video are in the
+    Insights table, jobs already Processed are left unchanged.
+    '''
+    if job_key is None:
+        return None
+
+    try:
+        job = getJob(partition_key, job_key)
+        if job is None or job['State'] == PROCESSED:
+            return job
+
+        return transitionJob(job, PROCESSED)
+    except Exception as e:
+        logging.info('Failed: Mark job {0} processed {1}'.format(job_key, e))
+
+
+def getVideoIdTable():
+    '''
+    Table of Video Indexer id to job pointers, jobs are keyed on their blob
+    content so lookups by video id would otherwise scan the tracker table.
+    '''
+    return os.environ.get('SA_TABLE_VIDEO_IDS',
+                          os.environ['SA_TABLE_TRACKER'] + 'videoids')
+
+
+def putVideoId(job, video_id):
+    '''
+    Point the Video Indexer id of a job at the job.
+    '''
+    entity = {'PartitionKey': sanitizeKey(video_id),
+              'RowKey': 'job',
+              'JobKey': job['RowKey'],
+              'JobPartitionKey': job['PartitionKey']}
+
+    try:
+        table_service = clients.getTableService()
+        tables.putWithTable(table_service,
+                            getVideoIdTable(),
+                            lambda: table_service.insert_or_replace_entity(
+                                getVideoIdTable(), entity))
+    except Exception as e:
+        logging.info('Failed: Put video id {0} of job {1} {2}'.format(
+            video_id, job['RowKey'], e))
+
+
+def getJobByVideoId(video_id):
+    '''
+    Job of a Video Indexer id with two point reads, or None for videos
+    submitted before jobs existed.
+    '''
+    try:
+        table_service = clients.getTableService()
+        pointer = table_service.get_entity(getVideoIdTable(),
+                                           sanitizeKey(video_id),
+                                           'job')
+    except AzureMissingResourceHttpError:
+        return None
+
+    return getJob(pointer['JobPartitionKey'], pointer['JobKey'])
+
+
+def getTableEntity(entity_id, partition_key=None):
+    '''
+    Job or tracker entity of a Video Indexer id, or None.
+    '''
+    try:
+        # Get subset of feature values for rows with State not 'Processed'
+        logging.info('Getting Azure Storage Table entity')
+
+        # Get Azure Storage Table connection
+        table_service = clients.getTableService()
+
+        select = 'RowKey, PartitionKey, VideoIndexerId, VideoName, VideoPath, VideoUrl, State, IndexVersion'
+
+        # Jobs are keyed on their blob, found through their video id pointer
+        job = getJobByVideoId(entity_id)
+        if job is not None:
+            return job
+
+        # Point read of videos submitted before jobs existed when the
+        # PartitionKey is known
+        partition_key = partition_key or getTrackerLookupKey(entity_id)
+        if partition_key is not None:
+            try:
+                return table_service.get_entity(os.environ['SA_TABLE_TRACKER'],
+                                                partition_key,
+                                                entity_id,
+                                                select=select)
+            except AzureMissingResourceHttpError:
+                logging.info('Failed: Point read of entity {0} in partition {1}'.format(
+                    entity_id, partition_key))
+
+        # Fall back to scan for entities not yet migrated to the partition
+        # strategy
+        tasks = table_service.query_entities(os.environ['SA_TABLE_TRACKER'],
+                                             filter="VideoIndexerId eq '{0}'".format(
+                                                 entity_id),
+                                             select=select)
+
+        entity = [task for task in tasks][0]
+
+        return entity
+    except Exception as e:
+        logging.info('Get Table Video List failed: {0}.'.format(e))
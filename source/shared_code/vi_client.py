@@ -0,0 +1,348 @@
+import os
+import json
+import time
+import base64
+import logging
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from . import clients, metrics
+
+
+# Video file formats supported by Video Indexer
+SUPPORTED_FORMATS = ['.mxf', '.gxf', '.ts', '.ps', '.3gp',
+                     '.3gpp', '.mpg', '.wmv', '.asf', '.avi',
+                     '.mp4', '.m4a', '.m4v', '.isma', '.ismv',
+                     '.dvr-ms', '.mkv', '.wav', '.mov']
+
+# Cached Video Indexer access tokens, {(location, account, allow_edit):
+# (token, expiry)}, shared by every invocation of a warm worker
+_tokens = dict()
+_token_locks = dict()
+_token_locks_lock = threading.Lock()
+
+# Token bucket shared by every Video Indexer call of a worker, paused for
+# the Retry-After of a throttled call so other callers back off too
+_bucket = {'tokens': None, 'updated': 0.0, 'paused_until': 0.0}
+_bucket_lock = threading.Lock()
+
+# Video Indexer call counters of a worker
+_metrics = {'calls': 0, 'succeeded': 0, 'throttled': 0, 'server_errors': 0,
+            'connection_errors': 0, 'retried': 0, 'failed': 0}
+_metrics_lock = threading.Lock()
+
+# Methods safe to send again when a response was lost
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+def getViApiUrl():
+    '''
+    Video Indexer API base URL, VI_API_URL points it at a local stand-in.
+    '''
+    return os.environ.get('VI_API_URL', 'https://api.videoindexer.ai').rstrip('/')
+
+
+def countMetric(name):
+    '''
+    '''
+    with _metrics_lock:
+        _metrics[name] += 1
+
+
+def getViMetrics():
+    '''
+    Video Indexer call counters, throttled vs. successful calls.
+    '''
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def acquireRateLimit():
+    '''
+    Block until the token bucket, tuned by VI_RATE_PER_SEC and
+    VI_RATE_BURST to the account quota, allows one more call.
+    '''
+    rate = float(os.environ.get('VI_RATE_PER_SEC', 10))
+    burst = float(os.environ.get('VI_RATE_BURST', 10))
+
+    while True:
+        with _bucket_lock:
+            now = time.time()
+            if _bucket['tokens'] is None:
+                _bucket['tokens'] = burst
+            else:
+                _bucket['tokens'] = min(
+                    burst, _bucket['tokens'] + (now - _bucket['updated']) * rate)
+            _bucket['updated'] = now
+
+            if now >= _bucket['paused_until'] and _bucket['tokens'] >= 1:
+                _bucket['tokens'] -= 1
+                return
+            delay = max(_bucket['paused_until'] - now,
+                        (1 - _bucket['tokens']) / rate)
+
+        time.sleep(delay)
+
+
+def pauseRateLimit(delay):
+    '''
+    '''
+    with _bucket_lock:
+        _bucket['paused_until'] = max(_bucket['paused_until'],
+                                      time.time() + delay)
+        _bucket['tokens'] = 0
+
+
+def getRetryDelay(response, attempt):
+    '''
+    '''
+    base = float(os.environ.get('VI_BACKOFF_BASE', 1))
+    cap = float(os.environ.get('VI_BACKOFF_MAX', 60))
+
+    # Honor Retry-After, in seconds or as an HTTP date, when present, up to
+    # the backoff cap so one header cannot stall the invocation
+    retry_after = getRetryAfter(response)
+    if retry_after is not None:
+        return min(cap, max(0.0, retry_after))
+
+    # Otherwise exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def getRetryAfter(response):
+    '''
+    '''
+    retry_after = response.headers.get('Retry-After') \
+        if response is not None else None
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except Exception:
+            return None
+
+
+def isRetryable(method, response, error=None):
+    '''
+    Whether a failed call may be sent again. Non-idempotent calls, e.g.
+    the POST uploading a video, are only retried when the request surely
+    was not acted on, throttled (429), unavailable with a Retry-After
+    (503) or never connected, so a video is not indexed twice.
+    '''
+    import requests
+
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    if error is not None:
+        return isinstance(error, requests.ConnectTimeout)
+
+    return response.status_code == 429 or (
+        response.status_code == 503 and getRetryAfter(response) is not None)
+
+
+def getDeadlineTimeout(timeout, deadline):
+    '''
+    Request timeout (seconds) bounded by the time left until deadline
+    (epoch seconds), raising TimeoutError once it has passed.
+    '''
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise TimeoutError('Deadline exceeded')
+
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def viRequest(method, request_url, deadline=None, **kwargs):
+    '''
+    Call the Video Indexer API through the shared rate limiter, retrying
+    throttled (429), server error (5xx) and connection failures of calls
+    that are safe to retry, with every attempt and wait before deadline
+    (epoch seconds) if given.
+    '''
+    import requests
+
+    max_retries = int(os.environ.get('VI_MAX_RETRIES', 5))
+    session = clients.getHttpSession()
+    timeout = kwargs.pop('timeout', None)
+
+    for attempt in range(max_retries + 1):
+        acquireRateLimit()
+        countMetric('calls')
+
+        error = None
+        try:
+            response = session.request(
+                method, request_url,
+                timeout=getDeadlineTimeout(timeout, deadline), **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            countMetric('connection_errors')
+            if attempt == max_retries or not isRetryable(method, None, e):
+                countMetric('failed')
+                raise
+            response = None
+            error = e
+        else:
+            if response.status_code == 429:
+                countMetric('throttled')
+            elif response.status_code >= 500:
+                countMetric('server_errors')
+            else:
+                if response.ok:
+                    countMetric('succeeded')
+                else:
+                    countMetric('failed')
+                return response
+
+            if attempt == max_retries or not isRetryable(method, response):
+                countMetric('failed')
+                return response
+
+        # Wait before retrying, pausing every caller when throttled, unless
+        # the retry could not be sent before the deadline
+        delay = getRetryDelay(response, attempt)
+        if deadline is not None and time.time() + delay >= deadline:
+            countMetric('failed')
+            if response is None:
+                raise error
+            return response
+        if response is not None and response.status_code == 429:
+            pauseRateLimit(delay)
+        countMetric('retried')
+        metrics.count('retries')
+        logging.info('Retrying Video Indexer call in {0:.1f}s, attempt {1}'.format(
+            delay, attempt + 1))
+        time.sleep(delay)
+
+
+def getTokenExpiry(access_token):
+    '''
+    Expiry (epoch seconds) read from the 'exp' claim of the access token
+    JWT, one hour from now if it cannot be read.
+    '''
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return time.time() + 3600
+
+
+def isTokenValid(cached_token):
+    '''
+    '''
+    # Treat tokens as expired a safety margin before their expiry
+    margin = float(os.environ.get('VI_TOKEN_MARGIN', 300))
+
+    return cached_token is not None and cached_token[1] - margin > time.time()
+
+
+def getTokenBlobClient(token_key):
+    '''
+    '''
+    blob_service_client = clients.getBlobServiceClient()
+
+    return blob_service_client.get_blob_client(
+        container=os.environ['VI_TOKEN_CACHE_CONTAINER'],
+        blob='vi-token-{0}-{1}-{2}.json'.format(*token_key))
+
+
+def getPersistedToken(token_key):
+    '''
+    '''
+    try:
+        # Share tokens across warm instances through Azure Blob Storage
+        if not os.environ.get('VI_TOKEN_CACHE_CONTAINER'):
+            return None
+
+        blob_client = getTokenBlobClient(token_key)
+        cached_token = json.loads(blob_client.download_blob().readall())
+
+        return cached_token['token'], cached_token['expiry']
+    except Exception as e:
+        logging.info(
+            'Failed: Get persisted Video Indexer access token {0}'.format(e))
+
+
+def putPersistedToken(token_key, cached_token):
+    '''
+    '''
+    try:
+        if not os.environ.get('VI_TOKEN_CACHE_CONTAINER'):
+            return
+
+        blob_client = getTokenBlobClient(token_key)
+        blob_client.upload_blob(json.dumps({'token': cached_token[0],
+                                            'expiry': cached_token[1]}),
+                                overwrite=True)
+    except Exception as e:
+        logging.info(
+            'Failed: Put persisted Video Indexer access token {0}'.format(e))
+
+
+def requestViToken(location, account_id, allow_edit):
+    '''
+    '''
+    try:
+        # Attempt connection to VI for Access Token
+        logging.info('Creating Video Indexer access token')
+
+        # Format HTTPS Request
+        headers = {'Ocp-Apim-Subscription-Key': os.environ['VI_KEY']}
+        request_url = '{0}/Auth/{1}/Accounts/{2}/AccessToken?allowEdit={3}'.format(
+            getViApiUrl(), location, account_id, allow_edit)
+
+        # Get Video Indexer access token
+        response = viRequest('GET',
+                             request_url,
+                             headers=headers)
+        response.raise_for_status()
+
+        logging.info('Success: Created Azure Video Indexer access token')
+
+        # Return Video Indexer access token
+        return response.json()
+    except Exception as e:
+        logging.info(
+            'Failed: Create Azure Video Indexer access token: {0}'.format(e))
+
+
+@metrics.instrument('getViToken')
+def getViToken(allow_edit=True):
+    '''
+    Cached Video Indexer access token, refreshed a safety margin before it
+    expires by a single caller while concurrent callers wait for it.
+    '''
+    token_key = (os.environ['VI_LOCATION'],
+                 os.environ['VI_ACCOUNT_ID'],
+                 allow_edit)
+
+    cached_token = _tokens.get(token_key)
+    if isTokenValid(cached_token):
+        return cached_token[0]
+
+    with _token_locks_lock:
+        token_lock = _token_locks.setdefault(token_key, threading.Lock())
+
+    with token_lock:
+        # Another caller may have refreshed the token while waiting
+        cached_token = _tokens.get(token_key)
+        if isTokenValid(cached_token):
+            return cached_token[0]
+
+        # Reuse a token persisted by another instance
+        cached_token = getPersistedToken(token_key)
+        if not isTokenValid(cached_token):
+            access_token = requestViToken(*token_key)
+            if access_token is None:
+                return None
+            cached_token = (access_token, getTokenExpiry(access_token))
+            putPersistedToken(token_key, cached_token)
+
+        _tokens[token_key] = cached_token
+
+        return cached_token[0]
@@ -0,0 +1,159 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from . import clients, tracker, metrics
+from .vi_client import getViApiUrl, viRequest
+from .partitioning import getJobPartitionKey
+
+
+# Queue of video blobs sent by UploadVideo, and of the messages that kept
+# failing
+JOB_QUEUE = 'putvideo-jobs'
+POISON_QUEUE = 'putvideo-jobs-poison'
+
+
+def getCallbackUrl(job_key=None):
+    '''
+    '''
+    # Pass the tracker job to DownloadInsights through the callback URL,
+    # Video Indexer appends the video id and state to it
+    callback_url = urlparse(os.environ['VI_CALLBACK_URL'])
+    query = parse_qsl(callback_url.query)
+    if job_key is not None:
+        query.append(('job', job_key))
+
+    return urlunparse(callback_url._replace(query=urlencode(query)))
+
+
+@metrics.instrument('uploadVideo')
+def uploadVideo(access_token, video_url, video_name, callback_url):
+    '''
+    '''
+    try:
+        # Attempt connection to VI for video upload
+        logging.info(
+            'Uploading video to Video Indexer - video: {0}'.format(video_name))
+
+        # Format HTTPS Request
+        headers = {'Content-Type': 'multipart/form-data'}
+        params = {'privacy': 'Private',
+                  'accessToken': access_token,
+                  'videoUrl': video_url,
+                  'callback_url': callback_url,
+                  'priority': 'High'}
+
+        request_url = '{0}/{1}/Accounts/{2}/Videos?name={3}'.format(
+            getViApiUrl(), os.environ['VI_LOCATION'], os.environ['VI_ACCOUNT_ID'],
+            video_name)
+
+        # Video Indexer fetches the video from videoUrl after answering, so
+        # the upload call itself is short
+        response = viRequest('POST',
+                             request_url,
+                             headers=headers,
+                             params=params,
+                             timeout=float(os.environ.get('PV_UPLOAD_TIMEOUT',
+                                                          60)))
+        response.raise_for_status()
+
+        logging.info('Success: Uploaded video to Video Indexer')
+
+        return response.json()
+    except Exception as e:
+        logging.info('Failed: Upload video to Azure Video Indexer: {0} {1} {2}'.format(
+            video_url, video_name, e))
+
+
+def getBlobProperties(blob_path):
+    '''
+    '''
+    try:
+        # Blob path is '{container}/{blob name}'
+        blob_service_client = clients.getBlobServiceClient()
+        blob_client = blob_service_client.get_blob_client(
+            container=blob_path.split('/')[0],
+            blob='/'.join(blob_path.split('/')[1:]))
+
+        return blob_client.get_blob_properties()
+    except Exception as e:
+        logging.info('Failed: Get blob properties {0} {1}'.format(
+            blob_path, e))
+
+
+def submitVideo(access_token, blob_path, blob_name, blob_uri):
+    '''
+    Submit a video blob to Video Indexer once per blob content, returning
+    its tracker job, or None on failure.
+    '''
+    # Job is keyed on the blob content so overwrites with identical files
+    # and repeated triggers do not index the video again
+    blob_properties = getBlobProperties(blob_path)
+    if blob_properties is None:
+        return None
+    job_key = tracker.getJobKey(blob_path, blob_properties)
+
+    # Job PartitionKey is derived from the job key alone, so a duplicate
+    # trigger on another day or from another container claims the same job
+    partition_key = getJobPartitionKey(job_key)
+
+    try:
+        job, claimed = tracker.claimJob(partition_key, job_key,
+                                        {'VideoName': blob_name,
+                                         'VideoPath': blob_path,
+                                         'VideoUrl': blob_uri,
+                                         'BlobETag': blob_properties['etag']})
+    except Exception as e:
+        logging.info('Failed: Claim job {0} {1}'.format(job_key, e))
+        return None
+    if not claimed:
+        logging.info('Skipped: {0} is already job {1} in state {2}'.format(
+            blob_path, job_key, job['State']))
+        return job
+
+    vi_upload_response = uploadVideo(access_token,
+                                     blob_uri,
+                                     blob_name,
+                                     getCallbackUrl(job_key))
+
+    if vi_upload_response is None:
+        tracker.failJob(job, 'Upload to Video Indexer failed')
+        return None
+
+    # Record the Video Indexer id of the job, a fast indexing callback may
+    # already have moved it past Submitted
+    vi_video_id = vi_upload_response['id']
+    submitted = tracker.transitionJob(job, tracker.SUBMITTED,
+                                      {'VideoIndexerId': vi_video_id})
+    tracker.putVideoId(job, vi_video_id)
+
+    return submitted or dict(job, VideoIndexerId=vi_video_id,
+                             State=tracker.SUBMITTED)
+
+
+def submitVideos(access_token, videos, concurrency):
+    '''
+    Submit video blobs {path, name, uri} concurrently with one access
+    token, returning whether each was submitted, or None for videos
+    another invocation is still submitting.
+    '''
+    def submit(video):
+        try:
+            with metrics.correlation(video.get('path')):
+                job = submitVideo(access_token, video['path'], video['name'],
+                                  video['uri'])
+        except Exception as e:
+            logging.info('Failed: Submit {0} {1}'.format(video.get('path'), e))
+            return False
+        if job is None:
+            return False
+
+        # A job left Queued is owned by an invocation still uploading it,
+        # its upload may yet fail so the video is not submitted
+        if job['State'] == tracker.QUEUED:
+            return None
+
+        return True
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(submit, videos))
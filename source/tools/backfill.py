@@ -0,0 +1,155 @@
+'''
+Submit the existing videos of a storage container to Video Indexer, as if
+each had just been uploaded and fired the UploadVideo trigger.
+
+Run from the function app root with the same application settings:
+
+    python -m tools.backfill --container content --rate 2 --concurrency 4
+
+Progress is printed after every page of blobs together with the
+continuation token to pass to --continuation-token to resume.
+'''
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from shared_code import clients
+from shared_code.vi_client import SUPPORTED_FORMATS, getViToken
+from shared_code.videos import submitVideo
+
+
+def getTrackedPaths():
+    '''
+    '''
+    # Video paths already submitted, read once instead of per blob
+    table_service = clients.getTableService()
+    if not table_service.exists(os.environ['SA_TABLE_TRACKER']):
+        return set()
+    entities = table_service.query_entities(os.environ['SA_TABLE_TRACKER'],
+                                            select='VideoPath')
+
+    return {entity.get('VideoPath') for entity in entities}
+
+
+def submitBlob(blob_path, blob_uri):
+    '''
+    '''
+    try:
+        # Token is cached, so this only calls VI when it is about to expire
+        vi_token = getViToken()
+
+        return submitVideo(vi_token, blob_path, Path(blob_path).stem,
+                           blob_uri) is not None
+    except Exception as e:
+        print('Failed: Submit {0} {1}'.format(blob_path, e), file=sys.stderr)
+
+        return False
+
+
+def backfill(blob_container, rate, concurrency, page_size=500,
+             continuation_token=None, state_file=None, dry_run=False):
+    '''
+    '''
+    blob_service_client = clients.getBlobServiceClient()
+    container_client = blob_service_client.get_container_client(
+        blob_container)
+    tracked_paths = getTrackedPaths()
+
+    stats = {'scanned': 0, 'unsupported': 0, 'tracked': 0,
+             'submitted': 0, 'failed': 0}
+    start_time = time.time()
+    next_submit = start_time
+
+    def countDone(done):
+        for future in done:
+            stats['submitted' if future.result() else 'failed'] += 1
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = set()
+    pages = container_client.list_blobs(
+        results_per_page=page_size).by_page(
+            continuation_token=continuation_token)
+    try:
+        for page in pages:
+            for blob in page:
+                stats['scanned'] += 1
+                blob_path = '{0}/{1}'.format(blob_container, blob.name)
+
+                # Same filters as the UploadVideo trigger, plus videos
+                # already in the tracker table
+                if Path(blob.name).suffix not in SUPPORTED_FORMATS:
+                    stats['unsupported'] += 1
+                    continue
+                if blob_path in tracked_paths:
+                    stats['tracked'] += 1
+                    continue
+                if dry_run:
+                    continue
+
+                # Pace submissions to the requested rate, bounding the
+                # number of pending submissions
+                delay = next_submit - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                next_submit = max(next_submit, time.time()) + 1.0 / rate
+                if len(futures) >= 2 * concurrency:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    countDone(done)
+
+                blob_uri = container_client.get_blob_client(blob.name).url
+                futures.add(executor.submit(submitBlob, blob_path, blob_uri))
+
+            # A page is complete once all of its submissions finished, so
+            # its continuation token is safe to resume from
+            countDone(wait(futures).done)
+            futures = set()
+            continuation_token = pages.continuation_token
+            if state_file and continuation_token:
+                with open(state_file, 'w') as f:
+                    f.write(continuation_token)
+
+            elapsed = time.time() - start_time
+            print('scanned: {scanned} unsupported: {unsupported} tracked: {tracked} '
+                  'submitted: {submitted} failed: {failed}'.format(**stats),
+                  '| {0:.2f} videos/sec | continuation token: {1}'.format(
+                      stats['submitted'] / elapsed if elapsed else 0.0,
+                      continuation_token))
+    finally:
+        executor.shutdown(wait=True)
+
+    return stats
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Submit existing videos of a container to Video Indexer')
+    parser.add_argument('--container', default='content')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='Max video submissions per second')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Max concurrent video submissions')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--continuation-token',
+                        help='Resume listing from this continuation token')
+    parser.add_argument('--state-file',
+                        help='File the last continuation token is read from and saved to')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only count the videos that would be submitted')
+    args = parser.parse_args()
+
+    continuation_token = args.continuation_token
+    if not continuation_token and args.state_file and \
+            os.path.exists(args.state_file):
+        with open(args.state_file, 'r') as f:
+            continuation_token = f.read().strip() or None
+
+    backfill(args.container, args.rate, args.concurrency, args.page_size,
+             continuation_token, args.state_file, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Micro-benchmark of the previous row based mergeInsights flattening, kept
+here, against the columnar flattenInsights/filterInsights path of
+ProcessInsights.
+
+Run from the function app root:
+
+    python -m tools.bench_flatten --sizes 100 1000 10000 --cutoff 0.5
+'''
+import json
+import time
+import argparse
+from shared_code.insights import (flattenInsights, filterInsights,
+                                  aggregateInsights, COLUMNS)
+from tools.fake_vi import buildInsights
+
+
+def getFeature(data, feature, feature_type='text'):
+    '''
+    '''
+    try:
+        return [{item[feature_type]: item['confidence']}
+                for item in data[feature]]
+    except BaseException:
+        return {}
+
+
+def getLabels(data, feature):
+    '''
+    '''
+    results = []
+    for item in data[feature]:
+        item_confidence = [instance['confidence']
+                           for instance in item['instances']]
+        results.append({item['name']: max(item_confidence)})
+
+    return results
+
+
+def mergeInsights(insights_list):
+    '''
+    '''
+    for file_name, video_insights in insights_list:
+        # Get video features from Insights JSON
+        video_features = {'brands': getFeature(video_insights,
+                                               'brands',
+                                               'name'),
+                          'topics': getFeature(video_insights,
+                                               'topics',
+                                               'name'),
+                          'keywords': getFeature(video_insights,
+                                                 'keywords'),
+                          'labels': getLabels(video_insights,
+                                              'labels'),
+                          'ocr': getFeature(video_insights,
+                                            'ocr'),
+                          'namedLocations': getFeature(video_insights,
+                                                       'namedLocations',
+                                                       'name')}
+
+        # Loop through vi_features
+        for k in video_features.keys():
+            for feature_list in video_features[k]:
+                for f in feature_list:
+                    yield {
+                        'vi_file_name': file_name,
+                        'vi_source_language': video_insights['sourceLanguage'],
+                        'vi_feature_type': k,
+                        'vi_feature': f,
+                        'vi_confidence_score': feature_list[f]
+                    }
+
+
+def rowFlatten(file_name, video_insights, confidence_cutoff, thresholds):
+    '''
+    '''
+    # Previous implementation, per row dicts filtered after the fact
+    rows = [item for item in mergeInsights([(file_name, video_insights)])
+            if item['vi_confidence_score'] > thresholds.get(
+                item['vi_feature_type'], confidence_cutoff)]
+
+    return [tuple(row[column] for column in COLUMNS) for row in rows]
+
+
+def columnFlatten(file_name, video_insights, confidence_cutoff, thresholds):
+    '''
+    '''
+    columns = filterInsights(flattenInsights(file_name, video_insights),
+                             confidence_cutoff, thresholds)
+
+    return list(zip(*(columns[column].tolist() for column in COLUMNS)))
+
+
+def timeBest(function, args, repeat):
+    '''
+    '''
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark Insights flattening implementations')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='Approximate items per insights feature type')
+    parser.add_argument('--cutoff', type=float, default=0.5)
+    parser.add_argument('--thresholds', default='{"ocr": 0.8}',
+                        help='Per feature type cutoffs as JSON')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    thresholds = json.loads(args.thresholds)
+
+    print('{0:>8}{1:>10}{2:>12}{3:>12}{4:>9}{5:>12}{6:>9}'.format(
+        'size', 'rows', 'rows ms', 'columns ms', 'speedup', 'aggregated',
+        'agg ms'))
+    for size in args.sizes:
+        video_insights = buildInsights('bench', 'bench', size)['videos'][0]['insights']
+        bench_args = ('bench_Insights.json', video_insights, args.cutoff,
+                      thresholds)
+        row_seconds, row_result = timeBest(rowFlatten, bench_args,
+                                           args.repeat)
+        column_seconds, column_result = timeBest(columnFlatten, bench_args,
+                                                 args.repeat)
+
+        # Both paths must keep the same rows in the same order
+        if row_result != column_result:
+            raise SystemExit('Failed: Flattened rows differ for size {0}'.format(
+                size))
+
+        # Rows left to write once repeated features are collapsed
+        columns = filterInsights(flattenInsights(*bench_args[:2]),
+                                 *bench_args[2:])
+        aggregate_seconds, aggregated = timeBest(aggregateInsights,
+                                                 (columns,), args.repeat)
+
+        print('{0:>8}{1:>10}{2:>12.2f}{3:>12.2f}{4:>8.1f}x{5:>12}{6:>9.2f}'.format(
+            size, len(column_result), row_seconds * 1000,
+            column_seconds * 1000, row_seconds / column_seconds,
+            len(aggregated['vi_feature']), aggregate_seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
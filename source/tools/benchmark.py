@@ -0,0 +1,570 @@
+'''
+End-to-end throughput benchmark of UploadVideo -> PutVideo ->
+DownloadInsights -> ProcessInsights against the local Video Indexer
+stand-in and in-memory (or Azurite) storage.
+
+Run from the function app root:
+
+    python -m tools.benchmark --videos 100 --concurrency 8
+    python -m tools.benchmark --videos 20 --latency 0.05 --throttle-rate 0.1
+
+HTTP-triggered functions are served by a minimal local function host so
+the Video Indexer callback reaches DownloadInsights like it does in Azure.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+import tracemalloc
+from functools import partial
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import azure.functions as func
+from shared_code.metrics import percentile
+from tools import fake_vi, fake_storage
+
+
+# Per-stage latencies (seconds) and failures of the current run
+_stages = dict()
+_stages_lock = threading.Lock()
+
+
+def recordStage(stage, seconds, ok=True):
+    '''
+    '''
+    with _stages_lock:
+        stats = _stages.setdefault(stage, {'latencies': [], 'failed': 0})
+        stats['latencies'].append(seconds)
+        if not ok:
+            stats['failed'] += 1
+
+
+def timeStage(stage, function, *args):
+    '''
+    '''
+    start_time = time.time()
+    try:
+        result = function(*args)
+    except Exception as e:
+        recordStage(stage, time.time() - start_time, ok=False)
+        print('Failed: {0} {1}'.format(stage, e), file=sys.stderr)
+        raise
+
+    ok = not isinstance(result, func.HttpResponse) or result.status_code < 400
+    recordStage(stage, time.time() - start_time, ok)
+
+    return result
+
+
+class FunctionHostHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.invoke('GET')
+
+    def do_POST(self):
+        self.invoke('POST')
+
+    def invoke(self, method):
+        parsed = urlparse(self.path)
+        function_name = parsed.path.rstrip('/').split('/')[-1]
+        module = self.server.functions.get(function_name)
+        if module is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        req = func.HttpRequest(method=method,
+                               url='http://localhost{0}'.format(self.path),
+                               headers=dict(self.headers),
+                               params=dict(parse_qsl(parsed.query)),
+                               body=self.rfile.read(length) if length else b'')
+        try:
+            response = timeStage(function_name, module.main, req)
+            status_code, body = response.status_code, response.get_body()
+        except Exception as e:
+            status_code, body = 500, str(e).encode('utf-8')
+
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def startFunctionHost(functions):
+    '''
+    Serve HTTP-triggered function modules on http://127.0.0.1:{port}/api/{name}.
+    '''
+    server = fake_vi.ThreadingHTTPServer(('127.0.0.1', 0), FunctionHostHandler)
+    server.functions = functions
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+class FakeInputStream(object):
+    '''
+    Blob trigger input, as passed to UploadVideo by the Functions host.
+    '''
+    def __init__(self, name, uri, data):
+        self.name = name
+        self.uri = uri
+        self.length = len(data)
+        self._data = data
+
+    def read(self, size=-1):
+        return self._data
+
+
+class QueueOut(object):
+    '''
+    Queue output binding, sends the value set by the function.
+    '''
+    def __init__(self, queue_name):
+        self.queue_name = queue_name
+        self.value = None
+
+    def set(self, value):
+        from shared_code import clients
+        self.value = value
+        clients.getQueueClient(self.queue_name).send_message(value)
+
+    def get(self):
+        return self.value
+
+
+def startQueueTrigger(queue_name, module, concurrency, stop_event,
+                      max_dequeue=5):
+    '''
+    Invoke a queue-triggered function module for the messages of a queue
+    until stop_event is set, like the Functions host does.
+    '''
+    from shared_code import clients
+    queue_client = clients.getQueueClient(queue_name)
+    poison_client = clients.getQueueClient('{0}-poison'.format(queue_name))
+    stage = module.__name__
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def invoke(message):
+        try:
+            timeStage(stage, module.main,
+                      func.QueueMessage(id=message.id,
+                                        body=message.content.encode('utf-8')))
+            queue_client.delete_message(message)
+        except Exception:
+            if message.dequeue_count >= max_dequeue:
+                poison_client.send_message(message.content)
+                queue_client.delete_message(message)
+
+    def poll():
+        while not stop_event.is_set():
+            messages = list(queue_client.receive_messages(
+                messages_per_page=16, visibility_timeout=5))
+            for message in messages:
+                executor.submit(invoke, message)
+            if not messages:
+                time.sleep(0.05)
+        executor.shutdown(wait=True)
+
+    thread = threading.Thread(target=poll)
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def configureEnvironment(vi_url, host_url):
+    '''
+    '''
+    # Settings of a local run, existing settings (e.g. Azurite) win
+    defaults = {'VI_API_URL': vi_url,
+                'VI_LOCATION': 'trial',
+                'VI_ACCOUNT_ID': 'benchmark',
+                'VI_KEY': 'benchmark',
+                'VI_CALLBACK_URL': '{0}/api/DownloadInsights?code=benchmark'.format(host_url),
+                'AF_PUTVIDEO_URL': '{0}/api/PutVideo?code=benchmark'.format(host_url),
+                'SA_CONNX_STRING': 'UseDevelopmentStorage=true',
+                'SA_TABLE_TRACKER': 'benchmarktracker',
+                'SA_TABLE_INSIGHTS': 'benchmarkinsights',
+                'SA_TABLE_INDEX': 'benchmarkindex',
+                'SA_TABLE_CHECKPOINT': 'benchmarkcheckpoint',
+                'SA_TABLE_SHARDS': 'benchmarkshards'}
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    os.environ['VI_API_URL'] = vi_url
+    os.environ['VI_CALLBACK_URL'] = defaults['VI_CALLBACK_URL']
+    os.environ['AF_PUTVIDEO_URL'] = defaults['AF_PUTVIDEO_URL']
+
+
+def drainShards(concurrency):
+    '''
+    '''
+    # Stand in for the ProcessInsightsShard queue trigger
+    import ProcessInsightsShard
+    from shared_code import clients, sharding
+    queue_client = clients.getQueueClient(sharding.SHARD_QUEUE)
+
+    def runShard(message):
+        timeStage('ProcessInsightsShard', ProcessInsightsShard.main,
+                  func.QueueMessage(body=message.content.encode('utf-8')))
+        queue_client.delete_message(message)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(runShard,
+                          queue_client.receive_messages(max_messages=32,
+                                                        visibility_timeout=600)))
+
+
+def drainVideos(concurrency):
+    '''
+    '''
+    # Stand in for the ProcessVideoInsights queue trigger
+    import ProcessVideoInsights
+    from shared_code import clients
+    from shared_code.insights import VIDEO_QUEUE
+    queue_client = clients.getQueueClient(VIDEO_QUEUE)
+
+    def runVideo(message):
+        timeStage('ProcessVideoInsights', ProcessVideoInsights.main,
+                  func.QueueMessage(body=message.content.encode('utf-8')))
+        queue_client.delete_message(message)
+
+    while True:
+        messages = list(queue_client.receive_messages(max_messages=32,
+                                                      visibility_timeout=600))
+        if not messages:
+            break
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(runVideo, messages))
+
+
+def runBenchmark(videos, concurrency, vi_config, use_azurite=False,
+                 timeout=600, video_size=1024, fanout=False,
+                 trigger_repeats=1, get_artifact=None,
+                 query_insights=0):
+    '''
+    '''
+    _stages.clear()
+
+    if not use_azurite:
+        fake_storage.useInMemoryStorage()
+    vi_server = fake_vi.startServer(**vi_config)
+
+    # Function modules read their settings at call time, so they are
+    # imported once the local clients are registered
+    import UploadVideo
+    import PutVideo
+    import PutVideoQueue
+    import DownloadInsights
+    import ProcessInsights
+    from shared_code.videos import JOB_QUEUE
+
+    host = startFunctionHost({'PutVideo': PutVideo,
+                              'DownloadInsights': DownloadInsights})
+    configureEnvironment('http://127.0.0.1:{0}'.format(vi_server.server_port),
+                         'http://127.0.0.1:{0}'.format(host.server_port))
+
+    # Seed synthetic videos, as if uploaded to the content container
+    from shared_code import clients
+    container_client = clients.getBlobServiceClient().get_container_client(
+        'content')
+    blob_triggers = []
+    for i in range(videos):
+        blob_name = 'benchmark/video{0:05d}.mp4'.format(i)
+        blob_client = container_client.get_blob_client(blob_name)
+        blob_client.upload_blob(os.urandom(video_size), overwrite=True)
+        blob_triggers.append(FakeInputStream('content/{0}'.format(blob_name),
+                                             blob_client.url,
+                                             b''))
+
+    # Fire the blob triggers, the rest of the pipeline is driven by the
+    # putvideo-jobs queue (or PutVideo call) and the Video Indexer callback,
+    # repeated triggers stand in for blob overwrites
+    stop_event = threading.Event()
+    queue_trigger = startQueueTrigger(JOB_QUEUE, PutVideoQueue,
+                                      concurrency, stop_event)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for blob_trigger in blob_triggers * trigger_repeats:
+            executor.submit(timeStage, 'UploadVideo', UploadVideo.main,
+                            blob_trigger, QueueOut(JOB_QUEUE))
+
+    # Wait for every video job to be done by DownloadInsights, duplicate
+    # callbacks also invoke it so its calls are not counted
+    process_mode = os.environ.get('DI_PROCESS_MODE', 'inline').lower()
+    done_states = ['Processed', 'Failed']
+    if process_mode != 'inline':
+        done_states.append('Downloaded')
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        states = countTrackerStates()
+        downloaded = sum(states.get(state, 0) for state in done_states)
+        if downloaded >= videos:
+            break
+        time.sleep(0.1)
+    stop_event.set()
+    queue_trigger.join()
+
+    # Queued Insights are processed once every video is downloaded
+    if process_mode == 'queue':
+        drainVideos(concurrency)
+    pipeline_seconds = time.time() - start_time
+
+    # Process the Insights of every video in one ProcessInsights run, or
+    # fan out shards to ProcessInsightsShard workers
+    process_start_time = time.time()
+    response = timeStage('ProcessInsights', ProcessInsights.main,
+                         func.HttpRequest(method='GET',
+                                          url='http://localhost/api/ProcessInsights',
+                                          params={'mode': 'fanout'}
+                                          if fanout else {},
+                                          body=b''))
+    if fanout:
+        drainShards(concurrency)
+    process_seconds = time.time() - process_start_time
+
+    # Request an artifact of every video twice through GetArtifact, the
+    # second request is served from storage
+    artifact_sources = getArtifacts(get_artifact, concurrency) \
+        if get_artifact else None
+
+    # Query indexed features twice through QueryInsights, the second query
+    # is served from the response cache
+    query_cache = queryInsights(query_insights, concurrency) \
+        if query_insights else None
+
+    host.shutdown()
+    vi_server.shutdown()
+
+    return {'videos': videos,
+            'downloaded': downloaded,
+            'pipeline_seconds': round(pipeline_seconds, 3),
+            'videos_per_sec': round(downloaded / pipeline_seconds, 2)
+            if pipeline_seconds else 0.0,
+            'process_seconds': round(process_seconds, 3),
+            'vi_calls': vi_server.state['calls'],
+            'vi_throttled': vi_server.state['throttled'],
+            'process_insights': response.get_body().decode('utf-8'),
+            'insights_rows': countInsightsRows(),
+            'export': countExport(),
+            'tracker_states': countTrackerStates(),
+            'artifact_sources': artifact_sources,
+            'query_cache': query_cache}
+
+
+def getArtifacts(artifact_type, concurrency):
+    '''
+    '''
+    import GetArtifact
+    from shared_code import clients
+    table_service = clients.getTableService()
+    jobs = [(entity['PartitionKey'], entity['RowKey'], entity['VideoIndexerId'])
+            for entity in table_service.query_entities(
+                os.environ['SA_TABLE_TRACKER'],
+                select='PartitionKey, RowKey, VideoIndexerId')]
+
+    # Requested once by job and once by Video Indexer id
+    def getArtifact(job, by_id=False):
+        params = {'id': job[2]} if by_id else {'pk': job[0], 'job': job[1]}
+        params['type'] = artifact_type
+        response = timeStage('GetArtifact', GetArtifact.main, func.HttpRequest(
+            method='GET',
+            url='http://localhost/api/GetArtifact',
+            params=params,
+            body=b''))
+        return response.headers.get('X-Artifact-Source', 'failed') \
+            if response.status_code == 200 else 'failed'
+
+    sources = dict()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for source in list(executor.map(getArtifact, jobs)) + \
+                list(executor.map(partial(getArtifact, by_id=True), jobs)):
+            sources[source] = sources.get(source, 0) + 1
+
+    return sources
+
+
+def queryInsights(queries, concurrency):
+    '''
+    '''
+    import QueryInsights
+    from shared_code import clients
+    table_service = clients.getTableService()
+    features = sorted(set((entity['FeatureType'], entity['Feature'])
+                          for entity in table_service.query_entities(
+                              os.environ['SA_TABLE_INDEX'],
+                              select='FeatureType, Feature')))[:queries]
+
+    def query(feature):
+        response = timeStage('QueryInsights', QueryInsights.main,
+                             func.HttpRequest(
+                                 method='GET',
+                                 url='http://localhost/api/QueryInsights',
+                                 params={'type': feature[0],
+                                         'feature': feature[1]},
+                                 body=b''))
+        return response.headers.get('X-Cache', 'failed') \
+            if response.status_code == 200 else 'failed'
+
+    results = dict()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for result in list(executor.map(query, features)) + \
+                list(executor.map(query, features)):
+            results[result] = results.get(result, 0) + 1
+
+    return results
+
+
+def countInsightsRows():
+    '''
+    '''
+    from shared_code import clients
+    table_service = clients.getTableService()
+    if not table_service.exists(os.environ['SA_TABLE_INSIGHTS']):
+        return 0
+
+    return sum(1 for _ in table_service.query_entities(
+        os.environ['SA_TABLE_INSIGHTS'], select='RowKey'))
+
+
+def countExport():
+    '''
+    '''
+    # Part files and rows of the Parquet export, rows of videos processed
+    # more than once are counted until compaction
+    from shared_code import clients, export
+    container_client = clients.getContainerClient(export.getExportContainer())
+    blobs = [blob for blob in container_client.list_blobs()
+             if blob.name.endswith('.parquet')]
+    table = export.loadExport() if blobs else None
+
+    return {'files': len(blobs),
+            'bytes': sum(blob.size for blob in blobs),
+            'rows': table.num_rows if table is not None else 0}
+
+
+def countTrackerStates():
+    '''
+    '''
+    from shared_code import clients
+    table_service = clients.getTableService()
+    if not table_service.exists(os.environ['SA_TABLE_TRACKER']):
+        return dict()
+
+    states = dict()
+    for entity in table_service.query_entities(os.environ['SA_TABLE_TRACKER'],
+                                               select='State'):
+        states[entity.get('State')] = states.get(entity.get('State'), 0) + 1
+
+    return states
+
+
+def printReport(summary):
+    '''
+    '''
+    print('{0:<22}{1:>7}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+        'stage', 'calls', 'failed', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for stage in ['UploadVideo', 'PutVideoQueue', 'PutVideo', 'DownloadInsights',
+                  'ProcessVideoInsights', 'ProcessInsights',
+                  'ProcessInsightsShard', 'GetArtifact', 'QueryInsights']:
+        stats = _stages.get(stage)
+        if stats is None:
+            continue
+        latencies = stats['latencies']
+        print('{0:<22}{1:>7}{2:>8}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>10.1f}'.format(
+            stage, len(latencies), stats['failed'],
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000))
+    print(json.dumps(summary, indent=2))
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='End-to-end pipeline benchmark against local stand-ins')
+    parser.add_argument('--videos', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Concurrent UploadVideo blob triggers')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every Video Indexer API call')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of Video Indexer API calls answered with 429')
+    parser.add_argument('--index-delay', type=float, default=0.05,
+                        help='Seconds between upload and indexing callback')
+    parser.add_argument('--insights-size', type=int, default=50,
+                        help='Approximate items per insights feature type')
+    parser.add_argument('--artifact-size', type=int, default=10000,
+                        help='Approximate bytes per artifact')
+    parser.add_argument('--azurite', action='store_true',
+                        help='Use the storage of SA_CONNX_STRING (e.g. Azurite) instead of in-memory storage')
+    parser.add_argument('--no-tracemalloc', action='store_true',
+                        help='Skip Python heap tracing, only report max RSS')
+    parser.add_argument('--dispatch-mode', choices=['queue', 'http'],
+                        help='UV_DISPATCH_MODE of UploadVideo (default: queue)')
+    parser.add_argument('--process-mode', choices=['inline', 'queue', 'off'],
+                        help='DI_PROCESS_MODE of DownloadInsights (default: inline)')
+    parser.add_argument('--trigger-repeats', type=int, default=1,
+                        help='UploadVideo triggers fired per video')
+    parser.add_argument('--callback-repeats', type=int, default=1,
+                        help='Video Indexer indexing callbacks sent per video')
+    parser.add_argument('--fanout', action='store_true',
+                        help='Process Insights with ProcessInsights mode=fanout shard workers')
+    parser.add_argument('--get-artifact', metavar='TYPE',
+                        help='Request this artifact of every video twice through GetArtifact')
+    parser.add_argument('--query-insights', type=int, default=0, metavar='N',
+                        help='Query N indexed features twice through QueryInsights')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    # Throttled calls are retried quickly against the local stand-in
+    os.environ.setdefault('VI_BACKOFF_BASE', '0.05')
+    os.environ.setdefault('VI_RATE_PER_SEC', '1000')
+    os.environ.setdefault('VI_RATE_BURST', '1000')
+    os.environ.setdefault('HTTP_POOL_SIZE', '128')
+    if args.dispatch_mode:
+        os.environ['UV_DISPATCH_MODE'] = args.dispatch_mode
+    if args.process_mode:
+        os.environ['DI_PROCESS_MODE'] = args.process_mode
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    summary = runBenchmark(args.videos, args.concurrency,
+                           {'latency': args.latency,
+                            'jitter': args.jitter,
+                            'throttle_rate': args.throttle_rate,
+                            'retry_after': 0,
+                            'index_delay': args.index_delay,
+                            'insights_size': args.insights_size,
+                            'artifact_size': args.artifact_size,
+                            'callback_repeats': args.callback_repeats},
+                           use_azurite=args.azurite,
+                           timeout=args.timeout,
+                           fanout=args.fanout,
+                           trigger_repeats=args.trigger_repeats,
+                           get_artifact=args.get_artifact,
+                           query_insights=args.query_insights)
+
+    if not args.no_tracemalloc:
+        summary['peak_traced_mb'] = round(
+            tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0, 1)
+    summary['max_rss_mb'] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+    printReport(summary)
+
+
+if __name__ == '__main__':
+    main()
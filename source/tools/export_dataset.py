@@ -0,0 +1,40 @@
+'''
+Download the Parquet export of the Insights dataset as a single local
+Parquet file, instead of paging through the Insights table.
+
+Run from the function app root with the same application settings:
+
+    python -m tools.export_dataset --out insights.parquet
+    python -m tools.export_dataset --out ocr.parquet --feature-type ocr --since 2020-06-01
+
+Rows of videos processed again on a later day are kept once per
+ingestion date, filter on the latest vi_ingest_date per vi_file_name if
+only current rows are needed.
+'''
+import argparse
+import pyarrow.parquet as pq
+from shared_code import export
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Download the Insights Parquet export as one file')
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--feature-type', action='append',
+                        help='Only this feature type, may be repeated')
+    parser.add_argument('--since',
+                        help='Only ingestion dates from YYYY-MM-DD')
+    args = parser.parse_args()
+
+    table = export.loadExport(args.feature_type, args.since)
+    if table is None:
+        raise SystemExit('Failed: No exported Insights found')
+
+    pq.write_table(table, args.out, use_dictionary=True)
+    print('Wrote {0} rows to {1}'.format(table.num_rows, args.out))
+
+
+if __name__ == '__main__':
+    main()
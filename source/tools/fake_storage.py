@@ -0,0 +1,547 @@
+'''
+In-memory stand-ins for the subset of the Azure Blob Storage, Azure
+Storage Table and Azure Storage Queue clients used by the functions, registered in place of the
+real clients with shared_code.clients.setClient:
+
+    useInMemoryStorage()
+
+To run against Azurite instead, keep the real clients and set
+SA_CONNX_STRING to the Azurite connection string.
+'''
+import re
+import json
+import uuid
+import hashlib
+import time
+import datetime
+import threading
+from azure.common import (AzureConflictHttpError, AzureHttpError,
+                          AzureMissingResourceHttpError)
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.cosmosdb.table.models import Entity
+from azure.storage.blob import BlobBlock, ContentSettings
+from shared_code import clients
+
+
+def readData(data):
+    '''
+    '''
+    # Upload data may be bytes, str, a file-like object or an iterable of
+    # byte chunks
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    if hasattr(data, 'read'):
+        return readData(data.read())
+
+    return b''.join(readData(chunk) for chunk in data)
+
+
+def newETag():
+    '''
+    '''
+    return '"0x{0}"'.format(uuid.uuid4().hex[:16].upper())
+
+
+class BlobProperties(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeDownloader(object):
+    def __init__(self, data, chunk_size=4 * 1024 * 1024, properties=None):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.size = len(data)
+        self.properties = properties
+
+    def readall(self):
+        return self.data
+
+    def content_as_bytes(self):
+        return self.data
+
+    def content_as_text(self, encoding='UTF-8'):
+        return self.data.decode(encoding)
+
+    def chunks(self):
+        for i in range(0, len(self.data), self.chunk_size):
+            yield self.data[i:i + self.chunk_size]
+
+    def readinto(self, stream):
+        stream.write(self.data)
+        return len(self.data)
+
+
+class FakePager(object):
+    def __init__(self, items, page_size, continuation_token=None):
+        self.items = items
+        self.page_size = page_size
+        self.start = int(continuation_token or 0)
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        while self.start < len(self.items):
+            page = self.items[self.start:self.start + self.page_size]
+            self.start += self.page_size
+            self.continuation_token = str(self.start) \
+                if self.start < len(self.items) else None
+            yield iter(page)
+
+
+class FakeItemPaged(object):
+    def __init__(self, items, page_size):
+        self.items = items
+        self.page_size = page_size
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_page(self, continuation_token=None):
+        return FakePager(self.items, self.page_size, continuation_token)
+
+
+class FakeBlobClient(object):
+    def __init__(self, service, container, blob):
+        self.service = service
+        self.container_name = container
+        self.blob_name = blob
+        self.url = 'https://fake.blob.core.windows.net/{0}/{1}'.format(
+            container, blob)
+
+    def _blobs(self):
+        return self.service.containers.setdefault(self.container_name, dict())
+
+    def upload_blob(self, data, overwrite=False, content_settings=None,
+                    metadata=None, **kwargs):
+        data = readData(data)
+        with self.service.lock:
+            blobs = self._blobs()
+            if self.blob_name in blobs and not overwrite:
+                raise ResourceExistsError('The specified blob already exists.')
+            content_settings = ContentSettings(
+                **vars(content_settings or ContentSettings()))
+            if not content_settings.content_md5:
+                content_settings.content_md5 = bytearray(
+                    hashlib.md5(data).digest())
+            blobs[self.blob_name] = BlobProperties(
+                name=self.blob_name,
+                container=self.container_name,
+                data=data,
+                size=len(data),
+                etag=newETag(),
+                last_modified=datetime.datetime.utcnow(),
+                content_settings=content_settings,
+                metadata=dict(metadata or dict()))
+
+            return {'etag': blobs[self.blob_name]['etag'],
+                    'last_modified': blobs[self.blob_name]['last_modified']}
+
+    def _get(self):
+        blob = self._blobs().get(self.blob_name)
+        if blob is None:
+            raise ResourceNotFoundError('The specified blob does not exist.')
+        return blob
+
+    def download_blob(self, **kwargs):
+        blob = self._get()
+        return FakeDownloader(blob['data'], properties=blob)
+
+    def get_blob_properties(self, **kwargs):
+        return self._get()
+
+    def set_blob_metadata(self, metadata=None, **kwargs):
+        with self.service.lock:
+            blob = self._get()
+            blob['metadata'] = dict(metadata or dict())
+            blob['etag'] = newETag()
+
+    def delete_blob(self, **kwargs):
+        with self.service.lock:
+            self._get()
+            del self._blobs()[self.blob_name]
+
+    def _staged(self):
+        return self.service.staged.setdefault(
+            (self.container_name, self.blob_name), dict())
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        data = readData(data)
+        with self.service.lock:
+            self._staged()[block_id] = data
+
+    def get_block_list(self, block_list_type='committed', **kwargs):
+        with self.service.lock:
+            staged = self._staged()
+            blob = self._blobs().get(self.blob_name)
+            if not staged and blob is None:
+                raise ResourceNotFoundError('The specified blob does not exist.')
+            uncommitted = []
+            for block_id, data in staged.items():
+                block = BlobBlock(block_id=block_id)
+                block.size = len(data)
+                uncommitted.append(block)
+            committed = []
+            for block_id, size in (blob or dict()).get('blocks', []):
+                block = BlobBlock(block_id=block_id)
+                block.size = size
+                committed.append(block)
+
+        return committed, uncommitted
+
+    def commit_block_list(self, block_list, content_settings=None,
+                          metadata=None, **kwargs):
+        with self.service.lock:
+            staged = self._staged()
+            data = b''.join(staged[block.id] for block in block_list)
+            blocks = [(block.id, len(staged[block.id])) for block in block_list]
+            del self.service.staged[(self.container_name, self.blob_name)]
+
+            result = self.upload_blob(data, overwrite=True,
+                                      content_settings=content_settings,
+                                      metadata=metadata)
+            self._blobs()[self.blob_name]['blocks'] = blocks
+
+            return result
+
+
+class FakeContainerClient(object):
+    def __init__(self, service, container):
+        self.service = service
+        self.container_name = container
+
+    def create_container(self, **kwargs):
+        with self.service.lock:
+            if self.container_name in self.service.containers:
+                raise ResourceExistsError('The specified container already exists.')
+            self.service.containers[self.container_name] = dict()
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self.service, self.container_name, blob)
+
+    def list_blobs(self, name_starts_with=None, results_per_page=5000,
+                   **kwargs):
+        with self.service.lock:
+            blobs = self.service.containers.get(self.container_name, dict())
+            items = [blobs[name] for name in sorted(blobs)
+                     if not name_starts_with or name.startswith(name_starts_with)]
+
+        return FakeItemPaged(items, results_per_page or 5000)
+
+    def upload_blob(self, name, data, **kwargs):
+        return self.get_blob_client(name).upload_blob(data, **kwargs)
+
+
+class FakeBlobServiceClient(object):
+    '''
+    In-memory BlobServiceClient, {container: {blob name: properties}}.
+    '''
+    def __init__(self):
+        self.containers = dict()
+        self.staged = dict()
+        self.lock = threading.RLock()
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+
+# Comparison of a single property in a table query filter
+FILTER_CLAUSE = re.compile(
+    r"^\s*(\w+)\s+(eq|ne|gt|ge|lt|le)\s+('(?:[^']|'')*'|[-\d.]+|true|false)\s*$")
+
+FILTER_OPERATORS = {'eq': lambda a, b: a == b,
+                    'ne': lambda a, b: a != b,
+                    'gt': lambda a, b: a > b,
+                    'ge': lambda a, b: a >= b,
+                    'lt': lambda a, b: a < b,
+                    'le': lambda a, b: a <= b}
+
+
+def parseFilter(query_filter):
+    '''
+    '''
+    # Only conjunctions of simple comparisons are supported
+    clauses = []
+    if not query_filter:
+        return clauses
+    for clause in re.split(r'\s+and\s+', query_filter):
+        match = FILTER_CLAUSE.match(clause.strip('() '))
+        if match is None:
+            raise ValueError('Unsupported filter: {0}'.format(clause))
+        name, operator, value = match.groups()
+        if value.startswith("'"):
+            value = value[1:-1].replace("''", "'")
+        elif value in ('true', 'false'):
+            value = value == 'true'
+        else:
+            value = float(value)
+        clauses.append((name, FILTER_OPERATORS[operator], value))
+
+    return clauses
+
+
+def decodeBatchBody(body):
+    '''
+    '''
+    # Entities in batch requests are serialized with odata type annotations
+    properties = json.loads(body.decode('utf-8')) if body else dict()
+    entity = dict()
+    for name, value in properties.items():
+        if name.endswith('@odata.type'):
+            continue
+        edm_type = properties.get(name + '@odata.type')
+        if edm_type == 'Edm.Int64':
+            value = int(value)
+        elif edm_type == 'Edm.Double':
+            value = float(value)
+        entity[name] = value
+
+    return entity
+
+
+class FakeTableService(object):
+    '''
+    In-memory TableService, {table: {(PartitionKey, RowKey): entity}}.
+    '''
+    def __init__(self):
+        self.tables = dict()
+        self.lock = threading.RLock()
+        self.calls = 0
+
+    def _table(self, table_name):
+        self.calls += 1
+        table = self.tables.get(table_name)
+        if table is None:
+            raise AzureMissingResourceHttpError(
+                'TableNotFound The table specified does not exist.', 404)
+        return table
+
+    def create_table(self, table_name, fail_on_exist=False, **kwargs):
+        with self.lock:
+            self.calls += 1
+            if table_name in self.tables:
+                if fail_on_exist:
+                    raise AzureConflictHttpError(
+                        'TableAlreadyExists The table specified already exists.', 409)
+                return False
+            self.tables[table_name] = dict()
+            return True
+
+    def exists(self, table_name, **kwargs):
+        self.calls += 1
+        return table_name in self.tables
+
+    def _store(self, table, entity, merge):
+        key = (entity['PartitionKey'], entity['RowKey'])
+        stored = Entity(table.get(key, dict())) if merge else Entity()
+        stored.update({k: v for k, v in entity.items()
+                       if k not in ('etag', 'Timestamp')})
+        stored['Timestamp'] = datetime.datetime.utcnow()
+        stored['etag'] = newETag()
+        table[key] = stored
+
+        return stored['etag']
+
+    def _checkETag(self, table, entity, if_match):
+        key = (entity['PartitionKey'], entity['RowKey'])
+        if key not in table:
+            raise AzureMissingResourceHttpError(
+                'ResourceNotFound The specified resource does not exist.', 404)
+        if if_match != '*' and table[key]['etag'] != if_match:
+            raise AzureHttpError(
+                'UpdateConditionNotSatisfied The update condition specified in the request was not satisfied.', 412)
+
+    def insert_entity(self, table_name, entity, **kwargs):
+        with self.lock:
+            table = self._table(table_name)
+            if (entity['PartitionKey'], entity['RowKey']) in table:
+                raise AzureConflictHttpError(
+                    'EntityAlreadyExists The specified entity already exists.', 409)
+            return self._store(table, entity, merge=False)
+
+    def insert_or_merge_entity(self, table_name, entity, **kwargs):
+        with self.lock:
+            return self._store(self._table(table_name), entity, merge=True)
+
+    def insert_or_replace_entity(self, table_name, entity, **kwargs):
+        with self.lock:
+            return self._store(self._table(table_name), entity, merge=False)
+
+    def merge_entity(self, table_name, entity, if_match='*', **kwargs):
+        with self.lock:
+            table = self._table(table_name)
+            self._checkETag(table, entity, if_match)
+            return self._store(table, entity, merge=True)
+
+    def update_entity(self, table_name, entity, if_match='*', **kwargs):
+        with self.lock:
+            table = self._table(table_name)
+            self._checkETag(table, entity, if_match)
+            return self._store(table, entity, merge=False)
+
+    def delete_entity(self, table_name, partition_key, row_key,
+                      if_match='*', **kwargs):
+        with self.lock:
+            table = self._table(table_name)
+            entity = {'PartitionKey': partition_key, 'RowKey': row_key}
+            self._checkETag(table, entity, if_match)
+            del table[(partition_key, row_key)]
+
+    def get_entity(self, table_name, partition_key, row_key, select=None,
+                   **kwargs):
+        with self.lock:
+            entity = self._table(table_name).get((partition_key, row_key))
+            if entity is None:
+                raise AzureMissingResourceHttpError(
+                    'ResourceNotFound The specified resource does not exist.', 404)
+            return Entity(entity)
+
+    def query_entities(self, table_name, filter=None, select=None,
+                       num_results=None, **kwargs):
+        clauses = parseFilter(filter)
+        with self.lock:
+            entities = [Entity(entity) for key, entity
+                        in sorted(self._table(table_name).items())
+                        if all(name in entity and operator(entity[name], value)
+                               for name, operator, value in clauses)]
+        if num_results is not None:
+            entities = entities[:num_results]
+        if select and select != '*':
+            names = [name.strip() for name in select.split(',')]
+            entities = [Entity({k: v for k, v in entity.items()
+                                if k in names or k == 'etag'})
+                        for entity in entities]
+
+        return entities
+
+    def commit_batch(self, table_name, batch, **kwargs):
+        # Apply every request of the batch, or none of them
+        with self.lock:
+            table = self._table(table_name)
+            snapshot = dict(table)
+            try:
+                for row_key, request in batch._requests:
+                    entity = decodeBatchBody(request.body)
+                    entity.setdefault('PartitionKey', batch._partition_key)
+                    entity.setdefault('RowKey', row_key)
+                    if_match = request.headers.get('If-Match')
+                    if request.method == 'POST':
+                        self.insert_entity(table_name, entity)
+                    elif request.method == 'DELETE':
+                        self.delete_entity(table_name, batch._partition_key,
+                                           row_key, if_match)
+                    elif if_match:
+                        self._checkETag(table, entity, if_match)
+                        self._store(table, entity,
+                                    merge=request.method == 'MERGE')
+                    else:
+                        self._store(table, entity,
+                                    merge=request.method == 'MERGE')
+            except Exception:
+                table.clear()
+                table.update(snapshot)
+                raise
+
+
+class FakeQueueMessage(object):
+    def __init__(self, content):
+        self.id = uuid.uuid4().hex
+        self.content = content
+        self.dequeue_count = 0
+        self.pop_receipt = None
+        self.next_visible_on = 0.0
+        self.inserted_on = datetime.datetime.utcnow()
+
+
+class FakeQueueClient(object):
+    def __init__(self, service, queue):
+        self.service = service
+        self.queue_name = queue
+
+    def _messages(self):
+        return self.service.queues.setdefault(self.queue_name, [])
+
+    def create_queue(self, **kwargs):
+        with self.service.lock:
+            if self.queue_name in self.service.queues:
+                raise ResourceExistsError('The specified queue already exists.')
+            self.service.queues[self.queue_name] = []
+
+    def send_message(self, content, visibility_timeout=None, **kwargs):
+        message = FakeQueueMessage(content)
+        message.next_visible_on = time.time() + (visibility_timeout or 0)
+        with self.service.lock:
+            self._messages().append(message)
+
+        return message
+
+    def receive_messages(self, messages_per_page=None, visibility_timeout=30,
+                         max_messages=None, **kwargs):
+        # Received messages stay invisible until deleted or timed out
+        limit = max_messages or messages_per_page or 1
+        now = time.time()
+        received = []
+        with self.service.lock:
+            for message in self._messages():
+                if len(received) >= limit:
+                    break
+                if message.next_visible_on > now:
+                    continue
+                message.dequeue_count += 1
+                message.pop_receipt = uuid.uuid4().hex
+                message.next_visible_on = now + visibility_timeout
+                received.append(message)
+
+        return iter(received)
+
+    def delete_message(self, message, pop_receipt=None, **kwargs):
+        message_id = getattr(message, 'id', message)
+        with self.service.lock:
+            messages = self._messages()
+            for i, queued in enumerate(messages):
+                if queued.id == message_id:
+                    del messages[i]
+                    return
+        raise ResourceNotFoundError('The specified message does not exist.')
+
+    def get_queue_properties(self, **kwargs):
+        with self.service.lock:
+            if self.queue_name not in self.service.queues:
+                raise ResourceNotFoundError('The specified queue does not exist.')
+
+            return BlobProperties(
+                name=self.queue_name,
+                approximate_message_count=len(self._messages()))
+
+
+class FakeQueueServiceClient(object):
+    '''
+    In-memory QueueServiceClient, {queue: [messages]}.
+    '''
+    def __init__(self):
+        self.queues = dict()
+        self.lock = threading.RLock()
+
+    def get_queue_client(self, queue, **kwargs):
+        return FakeQueueClient(self, queue)
+
+
+def useInMemoryStorage():
+    '''
+    Register in-memory Blob, Table and Queue clients and return them.
+    '''
+    blob_service_client = FakeBlobServiceClient()
+    table_service = FakeTableService()
+    queue_service_client = FakeQueueServiceClient()
+    clients.setClient('blob', blob_service_client)
+    clients.setClient('table', table_service)
+    clients.setClient('queue', queue_service_client)
+
+    return blob_service_client, table_service, queue_service_client
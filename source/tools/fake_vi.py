@@ -0,0 +1,317 @@
+'''
+Local stand-in for the Video Indexer API, covering the Auth, Videos
+upload, ArtifactUrl and Index endpoints and the indexing callback, with
+configurable size synthetic insights, injectable latency and throttling.
+
+Point the functions at it with VI_API_URL, e.g.:
+
+    python -m tools.fake_vi --port 8090 --latency 0.05 --throttle-rate 0.1
+    VI_API_URL=http://localhost:8090
+'''
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import requests
+
+
+DEFAULT_CONFIG = {'latency': 0.0,
+                  'jitter': 0.0,
+                  'throttle_rate': 0.0,
+                  'retry_after': 1,
+                  'index_delay': 0.0,
+                  'insights_size': 50,
+                  'artifact_size': 10000,
+                  'callbacks': True,
+                  'callback_repeats': 1}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def formatTime(seconds):
+    '''
+    '''
+    return '{0}:{1:02d}:{2:06.3f}'.format(int(seconds // 3600),
+                                          int(seconds % 3600 // 60),
+                                          seconds % 60)
+
+
+def buildInstances(rng, count=2):
+    '''
+    '''
+    instances = []
+    for _ in range(count):
+        start = rng.uniform(0, 600)
+        instances.append({'confidence': round(rng.uniform(0.3, 1.0), 4),
+                          'start': formatTime(start),
+                          'end': formatTime(start + rng.uniform(0.5, 10))})
+
+    return instances
+
+
+def buildInsights(video_id, video_name, size):
+    '''
+    Synthetic Video Indexer Index JSON with about size items per feature
+    type, OCR and keywords repeating texts like real content does.
+    '''
+    rng = random.Random(video_id)
+    words = ['word{0}'.format(i) for i in range(max(1, size // 2))]
+
+    def items(field, count, vocabulary):
+        return [{'id': i,
+                 field: rng.choice(vocabulary),
+                 'confidence': round(rng.uniform(0.3, 1.0), 4),
+                 'instances': buildInstances(rng)}
+                for i in range(count)]
+
+    insights = {'version': '1.0.0.0',
+                'duration': formatTime(600),
+                'sourceLanguage': 'en-US',
+                'language': 'en-US',
+                'brands': items('name', max(1, size // 10),
+                                ['Brand{0}'.format(i) for i in range(10)]),
+                'topics': items('name', max(1, size // 10),
+                                ['Topic{0}'.format(i) for i in range(20)]),
+                'keywords': items('text', size, words),
+                'labels': [{'id': i,
+                            'name': 'label{0}'.format(i),
+                            'instances': buildInstances(rng, 3)}
+                           for i in range(max(1, size // 5))],
+                'ocr': items('text', size * 4, words),
+                'namedLocations': items('name', max(1, size // 10),
+                                        ['City{0}'.format(i) for i in range(10)])}
+
+    return {'accountId': 'fake',
+            'id': video_id,
+            'name': video_name,
+            'state': 'Processed',
+            'videos': [{'id': video_id,
+                        'state': 'Processed',
+                        'insights': insights}]}
+
+
+def buildArtifact(video_id, artifact_type, size):
+    '''
+    '''
+    # Pad the artifact to roughly size bytes
+    item = {'videoId': video_id, 'type': artifact_type, 'text': 'x' * 80}
+    count = max(1, size // (len(json.dumps(item)) + 2))
+
+    return {'type': artifact_type, 'results': [item] * count}
+
+
+def buildAccessToken(lifetime=3600):
+    '''
+    '''
+    payload = base64.urlsafe_b64encode(json.dumps(
+        {'exp': int(time.time() + lifetime)}).encode('utf-8'))
+
+    return 'fake.{0}.token'.format(payload.decode('utf-8').rstrip('='))
+
+
+def appendQuery(url, params):
+    '''
+    '''
+    parsed = urlparse(url)
+    query = parse_qsl(parsed.query) + list(params.items())
+
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+
+class FakeVideoIndexerHandler(BaseHTTPRequestHandler):
+    routes = [('GET', re.compile(r'^/Auth/[^/]+/Accounts/[^/]+/AccessToken$'), 'getAccessToken'),
+              ('POST', re.compile(r'^/[^/]+/Accounts/[^/]+/Videos$'), 'postVideo'),
+              ('GET', re.compile(r'^/[^/]+/Accounts/[^/]+/Videos/([^/]+)/ArtifactUrl$'), 'getArtifactUrl'),
+              ('GET', re.compile(r'^/[^/]+/Accounts/[^/]+/Videos/([^/]+)/Index$'), 'getIndex'),
+              ('GET', re.compile(r'^/artifacts/([^/]+)/([^/]+)$'), 'getArtifact')]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        parsed = urlparse(self.path)
+        params = dict(parse_qsl(parsed.query))
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(parsed.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.sendJson(404, {'ErrorType': 'NOT_FOUND'})
+
+        state = self.server.state
+        config = state['config']
+        with state['lock']:
+            state['calls'] += 1
+
+        # Artifact downloads stand in for blob SAS URLs and are never
+        # throttled
+        if handler != 'getArtifact':
+            delay = config['latency'] + random.uniform(0, config['jitter'])
+            if delay:
+                time.sleep(delay)
+            if random.random() < config['throttle_rate']:
+                with state['lock']:
+                    state['throttled'] += 1
+                return self.sendJson(429, {'statusCode': 429,
+                                           'message': 'Rate limit is exceeded.'},
+                                     {'Retry-After': str(config['retry_after'])})
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        getattr(self, handler)(params, *match.groups())
+
+    def sendJson(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def getAccessToken(self, params):
+        self.sendJson(200, buildAccessToken())
+
+    def postVideo(self, params):
+        state = self.server.state
+        video_id = uuid.uuid4().hex[:10]
+        with state['lock']:
+            state['videos'][video_id] = {'name': params.get('name'),
+                                         'state': 'Processing'}
+
+        # Video Indexer appends the video id and state to the callback URL
+        # once indexing is done
+        callback_url = params.get('callback_url')
+        if callback_url and state['config']['callbacks']:
+            timer = threading.Timer(state['config']['index_delay'],
+                                    sendCallback,
+                                    (state, video_id, callback_url))
+            timer.daemon = True
+            timer.start()
+        else:
+            state['videos'][video_id]['state'] = 'Processed'
+
+        self.sendJson(200, {'accountId': 'fake',
+                            'id': video_id,
+                            'name': params.get('name'),
+                            'state': 'Uploaded'})
+
+    def getArtifactUrl(self, params, video_id):
+        if video_id not in self.server.state['videos']:
+            return self.sendJson(404, {'ErrorType': 'VIDEO_NOT_FOUND'})
+
+        self.sendJson(200, 'http://{0}:{1}/artifacts/{2}/{3}'.format(
+            self.server.server_address[0], self.server.server_address[1],
+            video_id, params.get('type')))
+
+    def getIndex(self, params, video_id):
+        video = self.server.state['videos'].get(video_id)
+        if video is None:
+            return self.sendJson(404, {'ErrorType': 'VIDEO_NOT_FOUND'})
+
+        self.sendJson(200, buildInsights(video_id, video['name'],
+                                         self.server.state['config']['insights_size']))
+
+    def getArtifact(self, params, video_id, artifact_type):
+        self.sendJson(200, buildArtifact(video_id, artifact_type,
+                                         self.server.state['config']['artifact_size']))
+
+
+def sendCallback(state, video_id, callback_url):
+    '''
+    '''
+    with state['lock']:
+        state['videos'][video_id]['state'] = 'Processed'
+
+    # Video Indexer may call back more than once for a video
+    for _ in range(state['config']['callback_repeats']):
+        try:
+            requests.get(appendQuery(callback_url, {'id': video_id,
+                                                    'state': 'Processed'}),
+                         timeout=600)
+        except Exception as e:
+            print('Failed: Fake Video Indexer callback {0} {1}'.format(
+                callback_url, e))
+
+
+def startServer(host='127.0.0.1', port=0, **config):
+    '''
+    Start the fake Video Indexer API on a background thread and return the
+    server, its base URL is 'http://{host}:{server.server_port}'.
+    '''
+    server = ThreadingHTTPServer((host, port), FakeVideoIndexerHandler)
+    server.state = {'config': dict(DEFAULT_CONFIG, **config),
+                    'videos': dict(),
+                    'calls': 0,
+                    'throttled': 0,
+                    'lock': threading.Lock()}
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Video Indexer API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every API call')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Max random seconds added on top of latency')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--index-delay', type=float, default=0.0,
+                        help='Seconds between upload and indexing callback')
+    parser.add_argument('--insights-size', type=int, default=50,
+                        help='Approximate items per insights feature type')
+    parser.add_argument('--artifact-size', type=int, default=10000,
+                        help='Approximate bytes per artifact')
+    parser.add_argument('--callback-repeats', type=int, default=1,
+                        help='Indexing callbacks sent per video')
+    args = parser.parse_args()
+
+    server = startServer(args.host, args.port,
+                         latency=args.latency,
+                         jitter=args.jitter,
+                         throttle_rate=args.throttle_rate,
+                         retry_after=args.retry_after,
+                         index_delay=args.index_delay,
+                         insights_size=args.insights_size,
+                         artifact_size=args.artifact_size,
+                         callback_repeats=args.callback_repeats)
+    print('Fake Video Indexer API on http://{0}:{1}'.format(
+        args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+'''
+Upload large local videos to the content container with parallel block
+uploads, resuming from the blocks staged by an interrupted run, then hand
+them to the pipeline.
+
+Block ids embed the MD5 of their block, every block is sent with a
+transactional MD5 checked by the service, and the committed block list
+is checked against the local file, so the blob holds exactly the local
+bytes. --verify also downloads the blob again and compares its MD5.
+
+Run from the function app root with the same application settings:
+
+    python -m tools.ingest /mnt/videos/*.mp4 --prefix onprem/2020-06
+    python -m tools.ingest big.mov --block-size 16 --max-concurrency 16 --notify queue
+    python -m tools.ingest big.mov --verify
+
+Committing the blob fires the UploadVideo blob trigger like any other
+upload. --notify queue also sends the putvideo-jobs message UploadVideo
+would send, skipping the blob trigger polling delay; the tracker job
+keyed on the blob MD5 makes the trigger a no-op. Run the same command
+again after a failure to resume, staged blocks are kept by the service
+for a week.
+'''
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from shared_code import clients
+from shared_code.vi_client import SUPPORTED_FORMATS
+
+
+def getFileFingerprint(file_path, block_size):
+    '''
+    '''
+    # Block ids of a file embed its size, mtime and the block size, so
+    # blocks staged for a different version of the file are never reused
+    stat = os.stat(file_path)
+
+    return hashlib.sha1('{0}|{1}|{2}|{3}'.format(
+        os.path.basename(file_path), stat.st_size, stat.st_mtime_ns,
+        block_size).encode('utf-8')).hexdigest()[:16]
+
+
+def getBlockId(fingerprint, index, data):
+    '''
+    '''
+    # All block ids of a blob must have the same length, at most 64 bytes.
+    # The MD5 of the block makes a staged or committed block with this id
+    # hold these bytes, each block transfer is checked by the service
+    return '{0}-{1:08d}-{2}'.format(fingerprint, index,
+                                    hashlib.md5(data).hexdigest())
+
+
+def getBlockIds(file_path, block_size):
+    '''
+    Block ids of a local file and its MD5.
+    '''
+    fingerprint = getFileFingerprint(file_path, block_size)
+    block_ids = []
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for index, data in enumerate(iter(lambda: f.read(block_size), b'')):
+            md5.update(data)
+            block_ids.append(getBlockId(fingerprint, index, data))
+
+    return block_ids, md5.digest()
+
+
+def getBlocks(blob_client, block_list_type):
+    '''
+    Blocks of a blob, [(block id, size)], 'committed' or 'uncommitted'.
+    '''
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        committed, uncommitted = blob_client.get_block_list(block_list_type)
+    except ResourceNotFoundError:
+        return []
+    blocks = committed if block_list_type == 'committed' else uncommitted
+
+    return [(block.id, block.size) for block in blocks or []]
+
+
+def getStagedBlocks(blob_client):
+    '''
+    Sizes of the uncommitted blocks of a blob, {block id: size}.
+    '''
+    return dict(getBlocks(blob_client, 'uncommitted'))
+
+
+def downloadMd5(blob_client):
+    '''
+    '''
+    # MD5 of the blob content as downloaded
+    md5 = hashlib.md5()
+    for chunk in blob_client.download_blob().chunks():
+        md5.update(chunk)
+
+    return md5.digest()
+
+
+def uploadFile(file_path, blob_client, block_size, max_concurrency,
+               progress=None, verify=False):
+    '''
+    Upload a file as staged blocks, at most max_concurrency in flight,
+    skipping blocks already staged with the same content, commit it with
+    its MD5 and check the committed blocks. Returns a report of the
+    upload.
+    '''
+    from azure.storage.blob import BlobBlock, ContentSettings
+
+    file_size = os.path.getsize(file_path)
+    fingerprint = getFileFingerprint(file_path, block_size)
+    staged = getStagedBlocks(blob_client)
+
+    report = {'bytes': file_size, 'blocks': 0, 'resumed_blocks': 0,
+              'uploaded_bytes': 0}
+    start_time = time.time()
+    block_ids = []
+    md5 = hashlib.md5()
+    futures = set()
+
+    def stageBlock(block_id, data):
+        # Transactional MD5 of each block is checked by the service
+        blob_client.stage_block(block_id, data, length=len(data),
+                                validate_content=True)
+        return len(data)
+
+    # Read the file once, hashing it as blocks are handed to the pool, so
+    # memory is bounded by the blocks in flight
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        with open(file_path, 'rb') as f:
+            index = 0
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                md5.update(data)
+                block_id = getBlockId(fingerprint, index, data)
+                block_ids.append(block_id)
+                index += 1
+
+                if staged.get(block_id) == len(data):
+                    report['resumed_blocks'] += 1
+                else:
+                    futures.add(executor.submit(stageBlock, block_id, data))
+                if len(futures) >= 2 * max_concurrency:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        report['uploaded_bytes'] += future.result()
+                    if progress:
+                        progress(report)
+                if len(data) < block_size:
+                    break
+
+            for future in futures:
+                report['uploaded_bytes'] += future.result()
+    finally:
+        executor.shutdown(wait=True)
+
+    # Commit the blocks in file order with the MD5 of the whole file, the
+    # tracker keys jobs on it so identical files are indexed once
+    content_md5 = md5.digest()
+    blob_client.commit_block_list(
+        [BlobBlock(block_id=block_id) for block_id in block_ids],
+        content_settings=ContentSettings(content_type=getContentType(file_path),
+                                         content_md5=bytearray(content_md5)))
+
+    # Verify the blob is made of the blocks of the local file, in order,
+    # and optionally download it again to compare its MD5
+    committed = getBlocks(blob_client, 'committed')
+    if [block_id for block_id, _ in committed] != block_ids or \
+            sum(size for _, size in committed) != file_size:
+        raise RuntimeError('Failed: Verify {0}, committed {1} blocks of {2} bytes, expected {3} of {4}'.format(
+            file_path, len(committed), sum(size for _, size in committed),
+            len(block_ids), file_size))
+    if verify:
+        downloaded_md5 = downloadMd5(blob_client)
+        if downloaded_md5 != content_md5:
+            raise RuntimeError('Failed: Verify {0}, downloaded MD5 {1} expected {2}'.format(
+                file_path,
+                base64.b64encode(downloaded_md5).decode('ascii'),
+                base64.b64encode(content_md5).decode('ascii')))
+
+    elapsed = time.time() - start_time
+    report.update({'blocks': len(block_ids),
+                   'md5': base64.b64encode(content_md5).decode('ascii'),
+                   'verified': 'download' if verify else 'blocks',
+                   'seconds': round(elapsed, 3),
+                   'mb_per_sec': round(report['uploaded_bytes'] / 1048576.0 /
+                                       elapsed, 1) if elapsed else 0.0})
+
+    return report
+
+
+def getContentType(file_path):
+    '''
+    '''
+    import mimetypes
+
+    return mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+
+
+def isUploaded(file_path, blob_client, block_size):
+    '''
+    '''
+    # Committed from the blocks of the local file by an earlier run, block
+    # ids are only computed when the sizes match
+    committed = getBlocks(blob_client, 'committed')
+    if not committed or \
+            sum(size for _, size in committed) != os.path.getsize(file_path):
+        return False
+    block_ids, _ = getBlockIds(file_path, block_size)
+
+    return [block_id for block_id, _ in committed] == block_ids
+
+
+def notifyPutVideo(blob_container, blob_name, blob_uri):
+    '''
+    '''
+    # Same job message as UploadVideo sends
+    from shared_code.videos import JOB_QUEUE
+
+    blob_path = '{0}/{1}'.format(blob_container, blob_name)
+    clients.getQueueClient(JOB_QUEUE).send_message(json.dumps(
+        {'path': blob_path,
+         'name': Path(blob_path).stem,
+         'uri': blob_uri}))
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Upload large local videos with parallel block uploads')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--container', default='content')
+    parser.add_argument('--prefix', default='',
+                        help='Blob name prefix, e.g. a folder')
+    parser.add_argument('--block-size', type=float, default=8,
+                        help='Block size in MiB, at most 4000 (default: 8)')
+    parser.add_argument('--max-concurrency', type=int, default=8,
+                        help='Blocks uploaded in parallel per file (default: 8)')
+    parser.add_argument('--notify', choices=['trigger', 'queue'],
+                        default='trigger',
+                        help='Rely on the UploadVideo blob trigger, or also queue the PutVideo job')
+    parser.add_argument('--force', action='store_true',
+                        help='Upload even when an identical blob exists')
+    parser.add_argument('--verify', action='store_true',
+                        help='Download each uploaded blob again and compare its MD5')
+    args = parser.parse_args()
+
+    block_size = int(args.block_size * 1024 * 1024)
+    container_client = clients.getBlobServiceClient().get_container_client(
+        args.container)
+
+    failed = 0
+    for file_path in args.files:
+        if Path(file_path).suffix not in SUPPORTED_FORMATS:
+            print('Skipped: {0} unsupported file format in Video Indexer'.format(
+                file_path), file=sys.stderr)
+            continue
+
+        blob_name = '/'.join(part for part in (args.prefix.strip('/'),
+                                               os.path.basename(file_path))
+                             if part)
+        blob_client = container_client.get_blob_client(blob_name)
+        try:
+            if not args.force and isUploaded(file_path, blob_client,
+                                             block_size):
+                print('Skipped: {0} already uploaded as {1}'.format(
+                    file_path, blob_name))
+                continue
+
+            report = uploadFile(
+                file_path, blob_client, block_size, args.max_concurrency,
+                progress=lambda report: print('  {0}: {1:.1f} MiB uploaded'.format(
+                    blob_name, report['uploaded_bytes'] / 1048576.0),
+                    end='\r', file=sys.stderr),
+                verify=args.verify)
+            if args.notify == 'queue':
+                notifyPutVideo(args.container, blob_name, blob_client.url)
+            print('Uploaded {0} to {1}/{2} {3}'.format(
+                file_path, args.container, blob_name, json.dumps(report)))
+        except Exception as e:
+            failed += 1
+            print('Failed: Upload {0} {1}, run again to resume'.format(
+                file_path, e), file=sys.stderr)
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
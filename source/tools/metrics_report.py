@@ -0,0 +1,131 @@
+'''
+Summarize the structured metrics exported by the functions with
+METRICS_EXPORT=jsonl:<path>, or 'Metric: {...}' log lines, into per-stage
+latency percentiles and totals.
+
+Run from the function app root:
+
+    python -m tools.metrics_report metrics.jsonl
+    python -m tools.metrics_report metrics.jsonl --slowest 10
+'''
+import sys
+import json
+import argparse
+from shared_code.metrics import percentile, COUNTERS
+
+
+def readMetrics(paths):
+    '''
+    '''
+    # JSON lines, optionally prefixed by 'Metric: ' as logged, other lines
+    # are skipped
+    for path in paths:
+        with (sys.stdin if path == '-' else open(path)) as f:
+            for line in f:
+                start = line.find('{')
+                if start < 0:
+                    continue
+                try:
+                    record = json.loads(line[start:])
+                except ValueError:
+                    continue
+                if 'stage' in record and 'duration_ms' in record:
+                    yield record
+
+
+def summarizeStages(records):
+    '''
+    '''
+    stages = dict()
+    for record in records:
+        stage = stages.setdefault(record['stage'], {'durations': [],
+                                                    'statuses': dict(),
+                                                    'totals': dict()})
+        stage['durations'].append(record['duration_ms'])
+        stage['statuses'][record['status']] = stage['statuses'].get(
+            record['status'], 0) + 1
+        for name in COUNTERS:
+            if name in record:
+                stage['totals'][name] = stage['totals'].get(name, 0) + \
+                    record[name]
+
+    return stages
+
+
+def summarizeVideos(records):
+    '''
+    '''
+    # Total time and stages of each correlation id, to find stalled videos
+    videos = dict()
+    for record in records:
+        video = videos.setdefault(record.get('correlation_id'), {
+            'duration_ms': 0.0, 'stages': 0, 'failed': 0})
+        video['duration_ms'] += record['duration_ms']
+        video['stages'] += 1
+        if record['status'] != 'ok':
+            video['failed'] += 1
+
+    return videos
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Per-stage p50/p95/p99 of exported function metrics')
+    parser.add_argument('paths', nargs='*', default=['-'],
+                        help='JSON lines or log files, - for stdin')
+    parser.add_argument('--slowest', type=int, default=0,
+                        help='Also list the videos with the most stage time')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    records = list(readMetrics(args.paths))
+    stages = summarizeStages(records)
+
+    summary = dict()
+    for name, stage in sorted(stages.items()):
+        durations = stage['durations']
+        summary[name] = dict({'count': len(durations),
+                              'statuses': stage['statuses'],
+                              'p50_ms': percentile(durations, 50),
+                              'p95_ms': percentile(durations, 95),
+                              'p99_ms': percentile(durations, 99),
+                              'max_ms': max(durations)},
+                             **stage['totals'])
+
+    videos = summarizeVideos(records)
+    slowest = sorted(videos.items(), key=lambda item: -item[1]['duration_ms'])
+    slowest = slowest[:args.slowest]
+
+    if args.json:
+        print(json.dumps({'stages': summary,
+                          'slowest': [dict(video, correlation_id=key)
+                                      for key, video in slowest]},
+                         indent=2))
+        return
+
+    print('{0:<20}{1:>7}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}{7:>12}{8:>8}{9:>8}'.format(
+        'stage', 'calls', 'failed', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+        'bytes', 'retries', 'rows'))
+    for name, stats in summary.items():
+        print('{0:<20}{1:>7}{2:>8}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>10.1f}{7:>12}{8:>8}{9:>8}'.format(
+            name, stats['count'],
+            stats['count'] - stats['statuses'].get('ok', 0),
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['max_ms'], stats.get('bytes', 0), stats.get('retries', 0),
+            stats.get('rows', 0)))
+
+    if slowest:
+        print()
+        print('{0:<48}{1:>12}{2:>8}{3:>8}'.format('video', 'stage ms',
+                                                  'stages', 'failed'))
+        for key, video in slowest:
+            print('{0:<48}{1:>12.1f}{2:>8}{3:>8}'.format(
+                str(key), video['duration_ms'], video['stages'],
+                video['failed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+Rewrite tracker and insights table entities written to the legacy
+'examplekey' partition into the configured partitioning strategy.
+
+Run from the function app root with the same application settings:
+
+    python -m tools.migrate_partitions --table tracker
+    python -m tools.migrate_partitions --table insights --dry-run
+'''
+import os
+import argparse
+from azure.cosmosdb.table.tablebatch import TableBatch
+from shared_code import clients
+from shared_code.partitioning import (LEGACY_PARTITION_KEY,
+                                      getTrackerPartitionKey,
+                                      getInsightsPartitionKey)
+
+
+def getNewPartitionKey(table, entity):
+    '''
+    '''
+    if table == 'tracker':
+        return getTrackerPartitionKey(entity['RowKey'],
+                                      entity.get('VideoPath', ''),
+                                      entity.get('Timestamp'))
+
+    return getInsightsPartitionKey(entity['FileName'],
+                                   entity['FeatureType'])
+
+
+def commitBatches(table_service, table_name, batches, delete=False):
+    '''
+    '''
+    # Commit entities of each PartitionKey in groups of 100
+    for entities in batches.values():
+        for i in range(0, len(entities), 100):
+            batch = TableBatch()
+            for entity in entities[i:i + 100]:
+                if delete:
+                    batch.delete_entity(entity['PartitionKey'],
+                                        entity['RowKey'])
+                else:
+                    batch.insert_or_replace_entity(entity)
+            table_service.commit_batch(table_name, batch)
+
+
+def migrateTable(table_service, table, table_name, dry_run=False,
+                 page_size=1000):
+    '''
+    '''
+    moved = 0
+    kept = 0
+    while True:
+        # Page through the legacy partition, migrated entities leave it so
+        # every page starts from the beginning
+        entities = table_service.query_entities(
+            table_name,
+            filter="PartitionKey eq '{0}'".format(LEGACY_PARTITION_KEY),
+            num_results=page_size)
+        entities = list(entities)
+        if not entities:
+            break
+
+        inserts = dict()
+        deletes = dict()
+        for entity in entities:
+            partition_key = getNewPartitionKey(table, entity)
+            if partition_key == LEGACY_PARTITION_KEY:
+                kept += 1
+                continue
+
+            new_entity = {k: v for k, v in entity.items()
+                          if k not in ('etag', 'Timestamp')}
+            new_entity['PartitionKey'] = partition_key
+            inserts.setdefault(partition_key, []).append(new_entity)
+            deletes.setdefault(LEGACY_PARTITION_KEY, []).append(
+                {'PartitionKey': LEGACY_PARTITION_KEY,
+                 'RowKey': entity['RowKey']})
+
+        count = sum(len(v) for v in inserts.values())
+        if not dry_run and count:
+            # Write the new entities before deleting the legacy ones so an
+            # interrupted run can be resumed
+            commitBatches(table_service, table_name, inserts)
+            commitBatches(table_service, table_name, deletes, delete=True)
+        moved += count
+        print('{0}: migrated {1} entities, {2} kept in legacy partition'.format(
+            table_name, moved, kept))
+
+        if dry_run or count == 0:
+            break
+
+    return moved
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Migrate legacy examplekey table entities to the configured partitioning strategy')
+    parser.add_argument('--table', choices=['tracker', 'insights'],
+                        required=True)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report the first page of entities to migrate')
+    parser.add_argument('--page-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    table_service = clients.getTableService()
+    table_name = os.environ['SA_TABLE_TRACKER'
+                            if args.table == 'tracker'
+                            else 'SA_TABLE_INSIGHTS']
+
+    migrateTable(table_service, args.table, table_name, args.dry_run,
+                 args.page_size)
+
+
+if __name__ == '__main__':
+    main()
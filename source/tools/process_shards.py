@@ -0,0 +1,82 @@
+'''
+Run ProcessInsights shards on all cores of one machine instead of through
+the shard queue, for local testing of the fan-out mode.
+
+Run from the function app root with the same application settings, e.g.
+against Azurite:
+
+    python -m tools.process_shards --processes 8 --shards 16
+
+Shards are planned and their status recorded exactly as by
+ProcessInsights mode=fanout, then processed by the ProcessInsightsShard
+worker code in a multiprocessing pool. Use the table checkpoint store,
+the file store is not safe for concurrent processes.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from shared_code import sharding, checkpoint
+
+
+def runShard(shard):
+    '''
+    '''
+    # Imported in the worker process so each process creates its own
+    # pooled clients
+    from ProcessInsightsShard import processShard
+
+    return shard['shard'], processShard(shard)
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Process ProcessInsights shards with a local process pool')
+    parser.add_argument('--container', default='content')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--shards', type=int,
+                        help='Number of hash shards (default: PI_SHARD_COUNT)')
+    parser.add_argument('--by', choices=['hash', 'prefix'],
+                        help='Shard strategy (default: PI_SHARD_BY)')
+    parser.add_argument('--full', action='store_true',
+                        help='Rebuild every blob, ignoring the checkpoint')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.shards:
+        os.environ['PI_SHARD_COUNT'] = str(args.shards)
+    if args.by:
+        os.environ['PI_SHARD_BY'] = args.by
+    if checkpoint.getCheckpointStore().startswith('file:'):
+        print('Warning: the file checkpoint store is not safe for concurrent processes',
+              file=sys.stderr)
+
+    from shared_code.processing import listChangedBlobs
+    shards = sharding.planShards(listChangedBlobs(args.container, args.full),
+                                 blob_container=args.container,
+                                 full=args.full)
+    sharding.saveShards(shards)
+    shards = [sharding.getShardMessage(shard) for shard in shards]
+    print('Run {0}: {1} shards'.format(shards[0]['run'] if shards else None,
+                                       len(shards)))
+
+    start_time = time.time()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=args.processes) as pool:
+        for shard_index, report in pool.imap_unordered(runShard, shards):
+            print('shard {0}: {1}'.format(shard_index, report))
+
+    if shards:
+        status = sharding.getRunStatus(shards[0]['run'])
+        status['seconds'] = round(time.time() - start_time, 3)
+        print(json.dumps(status, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+Cold start benchmark of the function modules, each imported in a fresh
+interpreter as the Functions host does, reporting import time, RSS and
+the slowest imported packages.
+
+Run from the function app root:
+
+    python -m tools.startup_bench
+    python -m tools.startup_bench --repeat 5 --top 5 UploadVideo PutVideo
+
+Compare runs before and after a change to catch cold start regressions,
+--max-seconds fails the run when a module takes longer to import.
+'''
+import sys
+import json
+import argparse
+import subprocess
+from shared_code.metrics import percentile
+
+
+# Function modules of the app, in pipeline order
+FUNCTION_MODULES = ['UploadVideo', 'PutVideoQueue', 'PutVideo',
+                    'DownloadInsights', 'GetArtifact', 'ProcessVideoInsights',
+                    'ProcessInsights', 'ProcessInsightsShard', 'CompactExport',
+                    'QueryInsights']
+
+# Run in the fresh interpreter, azure.functions is loaded by the worker
+# before any function so it is not counted
+PROBE = '''
+import sys, json, time, resource
+import azure.functions
+before = set(sys.modules)
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start_time = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - start_time
+print(json.dumps({'seconds': seconds,
+                  'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+                  'modules': len(set(sys.modules) - before)}))
+'''
+
+
+def getPackage(name):
+    '''
+    '''
+    # Azure SDKs share the azure namespace, keep the SDK part of the name
+    parts = name.split('.')
+    if parts[0] == 'azure':
+        return '.'.join(parts[:3] if parts[1:2] == ['storage'] else parts[:2])
+
+    return parts[0]
+
+
+def probeModule(module, top=0):
+    '''
+    Import time, RSS growth and modules loaded by one module in a fresh
+    interpreter, with the top packages by import time when top is set.
+    '''
+    command = [sys.executable]
+    if top:
+        command += ['-X', 'importtime']
+    result = subprocess.run(command + ['-c', PROBE, module],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            check=True)
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+
+    if top:
+        # importtime lines are 'import time: self | cumulative | name' in
+        # completion order, sum the self time of each package imported
+        # after azure.functions
+        packages = dict()
+        counting = False
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) != 3 or not parts[0].startswith('import time:'):
+                continue
+            name = parts[2].strip()
+            if not counting:
+                counting = name == 'azure.functions'
+                continue
+            if name == module or not parts[0].split(':')[1].strip().isdigit():
+                continue
+            package = getPackage(name)
+            packages[package] = packages.get(package, 0) + int(
+                parts[0].split(':')[1])
+        probe['top'] = [(package, round(us / 1e6, 3)) for package, us in
+                        sorted(packages.items(), key=lambda item: -item[1])[:top]]
+
+    return probe
+
+
+def main():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='Import time and RSS of each function module')
+    parser.add_argument('modules', nargs='*', default=FUNCTION_MODULES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=0,
+                        help='Also list the packages taking the most import time')
+    parser.add_argument('--max-seconds', type=float,
+                        help='Fail when a median import takes longer')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    report = dict()
+    for module in args.modules:
+        probes = [probeModule(module) for _ in range(args.repeat)]
+        report[module] = {
+            'seconds': round(percentile([p['seconds'] for p in probes], 50), 3),
+            'rss_mb': round(percentile([p['rss_kb'] for p in probes], 50) / 1024.0, 1),
+            'modules': probes[0]['modules']}
+        if args.top:
+            report[module]['top'] = probeModule(module, args.top)['top']
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('{0:<24}{1:>10}{2:>10}{3:>10}'.format('module', 'import s',
+                                                   'rss mb', 'modules'))
+        for module, stats in report.items():
+            print('{0:<24}{1:>10.3f}{2:>10.1f}{3:>10}'.format(
+                module, stats['seconds'], stats['rss_mb'], stats['modules']))
+            for name, seconds in stats.get('top', []):
+                print('    {0:<28}{1:>10.3f}'.format(name, seconds))
+
+    slow = [module for module, stats in report.items()
+            if args.max_seconds and stats['seconds'] > args.max_seconds]
+    if slow:
+        raise SystemExit('Failed: Import slower than {0}s: {1}'.format(
+            args.max_seconds, ', '.join(slow)))
+
+
+if __name__ == '__main__':
+    main()